@@ -1,13 +1,26 @@
 """
-Author: Thanh Ta 
+Author: Thanh Ta
 Date: March, 2024
-Description: This script is used to invoke Flask APIs
+Description: This script is used to invoke Flask APIs.
+`python apicalls.py` calls the four endpoints concurrently and stores the
+responses into apireturns2.txt; `python apicalls.py --load` runs a load
+test instead: concurrent workers on a pooled HTTP session send weighted
+requests at a target rate, and throughput, error rate and p50/p95/p99
+latency are reported per endpoint.
 """
 
 import requests
+import argparse
 import json
+import math
 import os
+import threading
+import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+import configuration
 
 #Specify a URL that resolves to your workspace
 URL = "http://127.0.0.1:8000"
@@ -16,44 +29,177 @@ logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger()
 
-# API endpoints
-#default_endpoint = f"{URL}"
-prediction_endpoint = f"{URL}/prediction"
-scoring_endpoint = f"{URL}/scoring"
-summarystats_endpoint = f"{URL}/summarystats"
-diagnostics_endpoint = f"{URL}/diagnostics"
-
-#Call each API endpoint and store the responses
-prediction_response = requests.post(
-    url=prediction_endpoint,
-    headers={"Content-Type": "application/json"},
-    json={'filepath': "testdata/testdata.csv"}
-).json()
-logger.info(f"prediction_response: {prediction_response}\n")
-
-scoring_response = requests.get(scoring_endpoint).json()
-logger.info(f"scoring_response: {scoring_response}\n")
-
-summarystats_response = requests.get(summarystats_endpoint).json()
-logger.info(f"summarystats_response: {summarystats_response}\n")
-
-diagnostics_response = requests.get(diagnostics_endpoint).json()
-logger.info(f"diagnostics_response: {diagnostics_response}\n")
-
-#responses = #combine reponses here
-#combine all API responses
-responses = {
-    'Predictions': prediction_response,
-    'F1 Scoring': scoring_response,
-    'Summary Stats': summarystats_response,
-    'Diagnostics Results': diagnostics_response
+# API endpoints: method, path and requests arguments (json payload, query params) of each endpoint
+ENDPOINT_REQUESTS = {
+    'prediction': ('POST', '/prediction', {'json': {'filepath': "testdata/testdata.csv"}}),
+    'scoring': ('GET', '/scoring', {}),
+    'summarystats': ('GET', '/summarystats', {}),
+    # diagnostics run as a background job, wait for its result
+    'diagnostics': ('GET', '/diagnostics', {'params': {'wait': 'true'}}),
 }
+# under load, /diagnostics answers from its cache or with a 202 job
+# instead of each request waiting for a run
+LOAD_ENDPOINT_REQUESTS = dict(ENDPOINT_REQUESTS, diagnostics=('GET', '/diagnostics', {}))
+
+##################Functions to call the endpoints
+def make_session(pool_size=4):
+    """
+    Create an HTTP session keeping up to pool_size connections alive
+    Input: number of pooled connections
+    Output: requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def call_endpoint(session, name, url=URL, endpoint_requests=ENDPOINT_REQUESTS, timeout=300):
+    """
+    Call one endpoint
+    Input: session, endpoint name, base url, table of endpoint requests, timeout in seconds
+    Output: requests.Response
+    """
+    method, path, kwargs = endpoint_requests[name]
+    return session.request(method, f"{url}{path}", timeout=timeout, **kwargs)
+
+def main(url=URL):
+    """
+    Call each API endpoint concurrently and store the responses into apireturns2.txt
+    Input: base url of the API
+    Output: None
+    """
+    #Call each API endpoint and store the responses
+    session = make_session(len(ENDPOINT_REQUESTS))
+    with ThreadPoolExecutor(max_workers=len(ENDPOINT_REQUESTS)) as executor:
+        futures = {name: executor.submit(call_endpoint, session, name, url)
+                   for name in ENDPOINT_REQUESTS}
+        responses = {name: future.result().json() for name, future in futures.items()}
+    for name, response in responses.items():
+        logger.info(f"{name}_response: {response}\n")
+
+    #combine all API responses
+    responses = {
+        'Predictions': responses['prediction'],
+        'F1 Scoring': responses['scoring'],
+        'Summary Stats': responses['summarystats'],
+        'Diagnostics Results': responses['diagnostics']
+    }
+
+    #write the responses to your workspace
+    output_model_path = configuration.config_path('output_model_path')
+    with open(os.path.join(output_model_path, "apireturns2.txt"), "w") as file:
+        json.dump(responses, file)
+
+##################Functions to generate load
+def latency_percentiles(latencies, percentiles=(50, 95, 99)):
+    """
+    Nearest-rank percentiles of latencies
+    Input: list of latencies in seconds, percentiles to compute
+    Output: A dictionary of "p<percentile>_ms" to milliseconds, None without latencies
+    """
+    latencies = sorted(latencies)
+    return {f"p{p}_ms": (latencies[max(math.ceil(p / 100 * len(latencies)) - 1, 0)] * 1000
+                         if latencies else None)
+            for p in percentiles}
+
+def run_load(url=URL, weights=None, concurrency=8, rate=None, seconds=10.0,
+             endpoint_requests=LOAD_ENDPOINT_REQUESTS, timeout=30):
+    """
+    Send requests to the API from concurrent workers for a fixed duration.
+    With a target rate, request i is scheduled at i / rate seconds and its
+    latency counts from that time, so a server falling behind the schedule
+    shows in the percentiles instead of slowing the load down.
+    Input: base url, dictionary of endpoint name to integer weight (every
+    endpoint once by default), number of workers, target requests per second
+    (None for as fast as the workers go), duration in seconds, table of
+    endpoint requests, timeout of each request
+    Output: A dictionary of the totals and of the requests, requests per
+    second, errors, error rate and latency percentiles of each endpoint
+    """
+    weights = weights or {name: 1 for name in endpoint_requests}
+    # endpoints in a fixed weighted cycle, e.g. 8 predictions for 1 scoring
+    cycle = [name for name, weight in weights.items() for _ in range(weight)]
+    session = make_session(concurrency)
+    latencies = {name: [] for name in weights}
+    errors = {name: 0 for name in weights}
+    lock = threading.Lock()
+    next_request = iter(range(2 ** 62))
+    starttime = time.perf_counter()
+    deadline = starttime + seconds
+
+    def worker():
+        while True:
+            with lock:
+                index = next(next_request)
+            scheduled = starttime + index / rate if rate else time.perf_counter()
+            if scheduled >= deadline:
+                return
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            name = cycle[index % len(cycle)]
+            try:
+                ok = call_endpoint(session, name, url, endpoint_requests, timeout).ok
+            except requests.RequestException:
+                ok = False
+            latency = time.perf_counter() - scheduled
+            with lock:
+                latencies[name].append(latency)
+                errors[name] += not ok
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - starttime
+
+    def summary(values, error_count):
+        return dict({"requests": len(values),
+                     "requests_per_second": len(values) / elapsed,
+                     "errors": error_count,
+                     "error_rate": error_count / len(values) if values else 0.0},
+                    **latency_percentiles(values))
+
+    report = {"url": url, "concurrency": concurrency, "target_rate": rate, "seconds": elapsed,
+              "endpoints": {name: summary(latencies[name], errors[name]) for name in weights}}
+    report["total"] = summary([value for values in latencies.values() for value in values],
+                              sum(errors.values()))
+    return report
+
 
-with open('config.json','r') as f:
-    config = json.load(f)
-   
-#write the responses to your workspace
-output_model_path = os.path.join(os.getcwd(), config['output_model_path']) 
-with open(os.path.join(output_model_path, "apireturns2.txt"), "w") as file:
-    json.dump(responses, file)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', default=URL, help='base url of the API')
+    parser.add_argument('--load', action='store_true', help='run a load test instead of the four calls')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent workers')
+    parser.add_argument('--rate', type=float, help='target requests per second, unlimited by default')
+    parser.add_argument('--seconds', type=float, default=10, help='duration of the load test')
+    parser.add_argument('--endpoints', nargs='+', metavar='NAME[:WEIGHT]',
+                        help='endpoints to load, e.g. prediction:8 scoring:1; all by default')
+    parser.add_argument('--payloads', help='json file of endpoint name to requests arguments, '
+                        'e.g. {"prediction": {"json": {"records": [...]}}}')
+    parser.add_argument('--output', help='json file to write the load report to')
+    args = parser.parse_args()
 
+    if not args.load:
+        main(args.url)
+    else:
+        endpoint_requests = dict(LOAD_ENDPOINT_REQUESTS)
+        if args.payloads:
+            with open(args.payloads) as f:
+                for name, kwargs in json.load(f).items():
+                    method, path, _ = endpoint_requests[name]
+                    endpoint_requests[name] = (method, path, kwargs)
+        weights = None
+        if args.endpoints:
+            weights = {name: int(weight or 1) for name, _, weight in
+                       (endpoint.partition(':') for endpoint in args.endpoints)}
+            unknown = sorted(set(weights) - set(endpoint_requests))
+            if unknown:
+                parser.error(f"unknown endpoints {unknown}, expected {sorted(endpoint_requests)}")
+        report = run_load(args.url, weights, args.concurrency, args.rate, args.seconds,
+                          endpoint_requests)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(report, f, indent=2)
+        print(json.dumps(report, indent=2))
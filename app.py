@@ -1,73 +1,175 @@
 """
 Author: Thanh Ta 
 Date: March, 2024
-Description: This script is used to set up Flask APIs
+Description: This script is used to set up Flask APIs,
+built by create_app()
 """
 
-from flask import Flask, session, jsonify, request
-import pandas as pd
-import pickle
-import json
-import os
+from flask import Blueprint, Flask, Response, current_app, g, jsonify, request
 import logging
+import time
 from diagnostics import (
     missing_data,
     dataframe_summary,
     execution_time,
     model_predictions,
     outdated_packages_list,
+    run_diagnostics,
 )
-from scoring import score_model
+from scoring import score_metrics
+import dataset
+import metrics
+import profiling
+from diagnostics import get_production_model, model_predictions_batch
+from batching import MicroBatcher
+from jobs import BackgroundJobs
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger()
 
-######################Set up variables for use in our script
-app = Flask(__name__)
+REQUEST_SECONDS = metrics.histogram(
+    'http_request_duration_seconds', 'Latency of the API requests per route',
+    ('method', 'route', 'status'))
 
-app.config.from_pyfile('settings.py')
+######################Set up the application
+# routes are registered on the app built by create_app()
+api = Blueprint('api', __name__)
 
-with open('config.json','r') as f:
-    config = json.load(f) 
+def preload_resources():
+    """
+    Load the deployed model and the profile of the master dataset, e.g.
+    in the gunicorn master before the workers are forked, so every worker
+    shares their memory pages instead of loading its own copy
+    Input: None
+    Output: None
+    """
+    get_production_model().get()
+    if dataset.dataset_exists():
+        profiling.dataset_profile()
 
-dataset_csv_path = os.path.join(config['output_folder_path']) 
+def create_app(preload=None):
+    """
+    Build the Flask application
+    Input: whether to preload the model and dataset profile,
+    default to the PRELOAD_MODEL setting
+    Output: Flask application
+    """
+    app = Flask(__name__)
+    app.config.from_pyfile('settings.py')
+    
+    # the deployed model is loaded by the first request that needs it,
+    # or at startup with PRELOAD_MODEL so no request pays for unpickling
+    if app.config['PRELOAD_MODEL'] if preload is None else preload:
+        preload_resources()
+    
+    # optional micro-batching of small inline prediction requests;
+    # its thread starts on the first request, after any fork
+    app.extensions['prediction_batcher'] = None
+    if app.config['PREDICTION_BATCHING']:
+        app.extensions['prediction_batcher'] = MicroBatcher(
+            model_predictions_batch,
+            window_ms=app.config['PREDICTION_BATCH_WINDOW_MS'],
+            max_rows=app.config['PREDICTION_BATCH_MAX_ROWS'])
+    
+    # diagnostics run in the background, one run at a time, cached for a TTL
+    app.extensions['diagnostics_jobs'] = BackgroundJobs(
+        "diagnostics", run_diagnostics, ttl_seconds=app.config['DIAGNOSTICS_TTL_SECONDS'])
+    
+    app.register_blueprint(api)
+    return app
 
-prediction_model = None
+#######################Request metrics
+@api.before_app_request
+def start_request_timer():
+    g.request_starttime = time.perf_counter()
+
+@api.after_app_request
+def observe_request(response):
+    # the route pattern, not the path, so job ids do not each get a series
+    starttime = g.pop('request_starttime', None)
+    if starttime is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        REQUEST_SECONDS.observe(time.perf_counter() - starttime, method=request.method,
+                                route=route, status=response.status_code)
+    return response
+
+#######################Metrics Endpoint
+@api.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    #metrics of this process in the Prometheus text format
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
 
 #######################Default Endpoint
-@app.route('/')
+@api.route('/')
 def index():
     return "Welcome Risk Assessment APIs"
 
 #######################Prediction Endpoint
-@app.route("/prediction", methods=['POST','OPTIONS'])
+@api.route("/prediction", methods=['POST','OPTIONS'])
 def predict():        
     #call the prediction function you created in Step 3
     logger.info(f"Invoking predict()")
     
-    #filepath = request.json.get['filepath']
-    filepath = request.get_json()['filepath']
+    payload = request.get_json(silent=True)
+    if payload is None:
+        payload = {}
+    if not isinstance(payload, dict):
+        return jsonify({"error": "payload must be a json object"}), 400
 
-    df = pd.read_csv(filepath)
-    prediction_list = model_predictions(df)
-    
-    #return a list of prediction outputs
-    return jsonify({"predictions": prediction_list})
+    if 'filepath' in payload:
+        # csv file on the server's disk
+        try:
+            if not isinstance(payload['filepath'], str):
+                raise ValueError("it must be a string")
+            df = dataset.read_csv(payload['filepath'])
+            missing = [name for name in dataset.FEATURE_COLUMNS if name not in df.columns]
+            if missing:
+                raise ValueError(f"missing the features {missing}")
+        except (OSError, ValueError) as error:
+            return jsonify({"error": f"cannot read filepath {payload['filepath']!r}: {error}"}), 400
+        prediction_list = model_predictions(df)
+
+        #return a list of prediction outputs
+        return jsonify({"predictions": prediction_list})
+
+    # inline json batch of "records" or "columns", predicted without touching disk
+    try:
+        with dataset.DATA_LOAD_SECONDS.time(source='payload'):
+            features = dataset.features_from_payload(payload)
+    except ValueError as error:
+        return jsonify({"error": str(error)}), 400
+    prediction_batcher = current_app.extensions['prediction_batcher']
+    if prediction_batcher is not None and len(features) < prediction_batcher.max_rows:
+        prediction_list, probability_list = prediction_batcher.submit(features)
+    else:
+        prediction_list, probability_list = model_predictions_batch(features)
+    return jsonify({"predictions": prediction_list,
+                    "probabilities": probability_list})
+
+#######################Prediction Batcher Metrics Endpoint
+@api.route("/prediction/batcher", methods=['GET','OPTIONS'])
+def batcher_metrics():
+    #queue depth and batch sizes of the prediction micro-batcher
+    prediction_batcher = current_app.extensions['prediction_batcher']
+    if prediction_batcher is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(prediction_batcher.metrics(), enabled=True))
 
 #######################Scoring Endpoint
-@app.route("/scoring", methods=['GET','OPTIONS'])
+@api.route("/scoring", methods=['GET','OPTIONS'])
 def score():        
     #check the score of the deployed model
     logger.info(f"Invoking score()")
-    f1_score = score_model()
-    logger.info(f"From API --- f1_score: {f1_score}")
+    scores = score_metrics()
+    logger.info(f"From API --- f1_score: {scores['f1']}")
     
-    #F1 score number
-    return jsonify({"f1_score": f1_score})
+    #F1 score number, with the other metrics of the same predictions
+    return jsonify({"f1_score": scores["f1"], "precision": scores["precision"],
+                    "recall": scores["recall"], "auc": scores["auc"]})
  
 #######################Summary Statistics Endpoint
-@app.route("/summarystats", methods=['GET','OPTIONS'])
+@api.route("/summarystats", methods=['GET','OPTIONS'])
 def stats():        
     #check means, medians, and modes for each column
     logger.info(f"Invoking stats()")    
@@ -77,25 +179,50 @@ def stats():
     return jsonify(stats_list)
 
 #######################Diagnostics Endpoint
-@app.route("/diagnostics", methods=['GET','OPTIONS'])
+@api.route("/diagnostics", methods=['GET','OPTIONS'])
 def diagnostics():        
     #check timing and percent NA values
     logger.info(f"Invoking diagnostics()")
-    # Check precent missing data
-    precent_missing_data = missing_data()
-    # Check execution timings
-    durations = execution_time()
-    # Check outdated_packages_list
-    dependancies_check = outdated_packages_list().to_dict()
-    #return value for all diagnostics
-    diagnostics = {
-            "missing_data_percentage": precent_missing_data,
-            "execution_durations": durations,
-            "outdated_dependencies": dependancies_check ,
-        }
-    
-    return jsonify(diagnostics)
+    diagnostics_jobs = current_app.extensions['diagnostics_jobs']
+    # serve the cached result while it is fresh
+    job = diagnostics_jobs.cached()
+    if job is not None:
+        return jsonify(job["result"])
+
+    # otherwise start a run, or join the one in flight
+    job = diagnostics_jobs.submit()
+    if request.args.get('wait', 'false').lower() == 'true':
+        job_id = job["job_id"]
+        job = diagnostics_jobs.wait(job_id)
+        if job is None:
+            # the record was pruned while waiting
+            return jsonify({"error": f"diagnostics job {job_id} is no longer kept"}), 500
+        if job["status"] == "succeeded":
+            return jsonify(job["result"])
+        return jsonify(job), 500
+    return jsonify(dict(job, status_url=f"/diagnostics/jobs/{job['job_id']}")), 202
+
+@api.route("/diagnostics/jobs", methods=['POST'])
+def submit_diagnostics_job():
+    #start a diagnostics run in the background, or join the one in flight
+    job = current_app.extensions['diagnostics_jobs'].submit()
+    return jsonify(dict(job, status_url=f"/diagnostics/jobs/{job['job_id']}")), 202
+
+@api.route("/diagnostics/jobs/<job_id>", methods=['GET'])
+def diagnostics_job(job_id):
+    #poll a diagnostics run, its result is included once it succeeded
+    job = current_app.extensions['diagnostics_jobs'].get(job_id)
+    if job is None:
+        return jsonify({"error": f"unknown job id {job_id}"}), 404
+    return jsonify(job)
+
+@api.route("/diagnostics/status", methods=['GET'])
+def diagnostics_status():
+    #running job, age of the cached result and its TTL
+    return jsonify(current_app.extensions['diagnostics_jobs'].status())
 
 
 if __name__ == "__main__":    
+    # development server; see wsgi.py and gunicorn.conf.py for production
+    app = create_app()
     app.run(host='0.0.0.0', port=8000, debug=True, threaded=True)
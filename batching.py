@@ -0,0 +1,149 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to micro-batch concurrent prediction
+requests into one vectorised model call
+"""
+
+import os
+import logging
+import threading
+import time
+
+import numpy as np
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger()
+
+# upper bounds of the batch size histogram, in rows
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096]
+
+##################Class to batch prediction requests
+class _PendingRequest:
+    def __init__(self, features):
+        self.features = features
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher:
+    """
+    Queue concurrent prediction requests for up to window_ms milliseconds
+    or max_rows rows, run one vectorised predict over the whole batch,
+    and hand each request back its own slice of the results.
+    The worker thread is started on first use in each process,
+    so a batcher created before a server forks its workers stays usable.
+    """
+
+    def __init__(self, predict_batch, window_ms=5, max_rows=256):
+        self.predict_batch = predict_batch
+        self.window = window_ms / 1000
+        self.max_rows = max_rows
+        self._condition = threading.Condition()
+        self._queue = []
+        self._queued_rows = 0
+        self._worker_pid = None
+        # metrics
+        self._batches = 0
+        self._rows = 0
+        self._requests = 0
+        self._max_batch_rows = 0
+        self._batch_size_counts = [0] * (len(BATCH_SIZE_BUCKETS) + 1)
+
+    def _ensure_worker(self):
+        if self._worker_pid == os.getpid():
+            return
+        self._worker_pid = os.getpid()
+        threading.Thread(target=self._run, name="prediction-batcher", daemon=True).start()
+
+    def submit(self, features):
+        """
+        Queue the rows of one request and wait for their predictions
+        Input: numpy array of features, one row per record
+        Output: A list of predictions, a list of probabilities
+        """
+        request = _PendingRequest(features)
+        with self._condition:
+            self._ensure_worker()
+            self._queue.append(request)
+            self._queued_rows += len(features)
+            self._condition.notify()
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def _take_batch(self):
+        with self._condition:
+            while not self._queue:
+                self._condition.wait()
+            # wait for more requests until the window closes or the batch is full
+            deadline = time.monotonic() + self.window
+            while self._queued_rows < self.max_rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            batch, rows = [], 0
+            while self._queue and (not batch or
+                                   rows + len(self._queue[0].features) <= self.max_rows):
+                request = self._queue.pop(0)
+                batch.append(request)
+                rows += len(request.features)
+            self._queued_rows -= rows
+            return batch, rows
+
+    def _run(self):
+        while True:
+            batch, rows = self._take_batch()
+            try:
+                predictions, probabilities = self.predict_batch(
+                    np.concatenate([request.features for request in batch]))
+            except Exception as error:
+                logger.exception("Batched prediction failed")
+                for request in batch:
+                    request.error = error
+                    request.done.set()
+                continue
+
+            start = 0
+            for request in batch:
+                end = start + len(request.features)
+                request.result = (predictions[start:end], probabilities[start:end])
+                start = end
+                request.done.set()
+            self._record(len(batch), rows)
+
+    def _record(self, requests, rows):
+        with self._condition:
+            self._batches += 1
+            self._requests += requests
+            self._rows += rows
+            self._max_batch_rows = max(self._max_batch_rows, rows)
+            bucket = int(np.searchsorted(BATCH_SIZE_BUCKETS, rows))
+            self._batch_size_counts[bucket] += 1
+
+    def metrics(self):
+        """
+        Get the queue depth and batch size metrics of the batcher
+        Input: None
+        Output: A dictionary of metrics
+        """
+        with self._condition:
+            labels = [f"<={bound}" for bound in BATCH_SIZE_BUCKETS]
+            labels.append(f">{BATCH_SIZE_BUCKETS[-1]}")
+            return {
+                "window_ms": self.window * 1000,
+                "max_rows": self.max_rows,
+                "queue_depth_requests": len(self._queue),
+                "queue_depth_rows": self._queued_rows,
+                "batches": self._batches,
+                "requests": self._requests,
+                "rows": self._rows,
+                "mean_batch_rows": self._rows / self._batches if self._batches else 0,
+                "max_batch_rows": self._max_batch_rows,
+                "batch_rows_histogram": dict(zip(labels, self._batch_size_counts)),
+            }
@@ -0,0 +1,240 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to benchmark the pipeline stages
+in-process on synthetic datasets: merge_multiple_dataframe(), train_model(),
+score_model() and model_predictions(). Results are written as json,
+so a run can be compared against a previous one.
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak RSS is then not reported
+    resource = None
+
+import dataset
+import diagnostics
+import ingestion
+import scoring
+import training
+from benchmark_ingestion import synthetic_dataframe, write_synthetic_sources
+from modelcache import ModelCache
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger()
+
+STAGES = ['ingestion', 'training', 'scoring', 'predictions']
+# rows of the synthetic test data used by score_model()
+TEST_ROWS = 10000
+
+#############Functions to measure a stage
+def peak_rss_mb():
+    """
+    Get the peak resident set size of this process
+    Input: None
+    Output: peak RSS in MiB, None where it cannot be measured
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+def summarize_timings(timings):
+    """
+    Summarize the timings of the repetitions of a stage
+    Input: list of durations in seconds
+    Output: A dictionary of the repetitions, mean, p50, p95 and max
+    """
+    timings = np.asarray(timings)
+    return {
+        "repetitions": len(timings),
+        "mean_seconds": float(timings.mean()),
+        "p50_seconds": float(np.percentile(timings, 50)),
+        "p95_seconds": float(np.percentile(timings, 95)),
+        "max_seconds": float(timings.max()),
+        "timings_seconds": timings.tolist(),
+    }
+
+def measure(func, setup=None, warmup=1, repetitions=5):
+    """
+    Time a function in-process after warmup runs, then run it once more
+    under tracemalloc to get its peak of Python allocations
+    Input: function to time, untimed setup before each run,
+    number of warmup runs, number of timed runs
+    Output: A dictionary of timing percentiles and memory peaks
+    """
+    setup = setup or (lambda: None)
+    for _ in range(warmup):
+        setup()
+        func()
+
+    timings = []
+    for _ in range(repetitions):
+        setup()
+        starttime = timeit.default_timer()
+        func()
+        timings.append(timeit.default_timer() - starttime)
+
+    # tracing slows allocations down, so the traced run is not timed
+    setup()
+    tracemalloc.start()
+    try:
+        func()
+        _, traced_peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return dict(summarize_timings(timings),
+                tracemalloc_peak_mb=traced_peak / (1 << 20),
+                peak_rss_mb=peak_rss_mb())
+
+#############Function to benchmark the stages
+def benchmark_stages(rows, warmup=1, repetitions=5, files=4, seed=0, stages=STAGES):
+    """
+    Benchmark the pipeline stages on a synthetic dataset in a temporary
+    folder, leaving the workspace data and models untouched
+    Input: number of rows, warmup runs, timed runs, number of source files,
+    random seed, list of stages to benchmark
+    Output: A dictionary of the benchmark results per stage
+    """
+    files = max(1, min(files, rows))
+    results = {"rows": rows, "files": files, "stages": {}}
+    with tempfile.TemporaryDirectory() as workdir:
+        source_folder = os.path.join(workdir, 'sourcedata')
+        output_folder = os.path.join(workdir, 'ingesteddata')
+        model_folder = os.path.join(workdir, 'model')
+        test_folder = os.path.join(workdir, 'testdata')
+        for folder in (output_folder, model_folder, test_folder):
+            os.makedirs(folder)
+
+        logger.info(f"Generating {rows} synthetic rows in {files} files")
+        write_synthetic_sources(source_folder, files, rows // files, seed)
+        test_df = synthetic_dataframe(min(rows, TEST_ROWS), seed + files)
+        test_df.to_csv(os.path.join(test_folder, 'testdata.csv'), index=False)
+
+        def reset_output():
+            shutil.rmtree(output_folder)
+            os.makedirs(output_folder)
+
+        def ingest():
+            ingestion.merge_multiple_dataframe(input_folder=source_folder,
+                                               output_folder=output_folder)
+
+        if 'ingestion' in stages:
+            results["stages"]["ingestion"] = measure(ingest, reset_output,
+                                                     warmup, repetitions)
+        if not dataset.dataset_exists(output_folder):
+            ingest()
+
+        def train():
+            training.train_model(output_folder, model_folder)
+
+        if 'training' in stages:
+            results["stages"]["training"] = measure(train, None, warmup, repetitions)
+        if not os.path.exists(os.path.join(model_folder, 'trainedmodel.pkl')):
+            train()
+
+        if 'scoring' in stages:
+            # time the scoring itself, not the score cache
+            results["stages"]["scoring"] = measure(
+                lambda: scoring.score_model(test_folder, model_folder),
+                lambda: scoring.clear_score_cache(model_folder), warmup, repetitions)
+
+        if 'predictions' in stages:
+            # predict the whole master dataset with the synthetic model
+            master_df = dataset.load_dataframe(folder_path=output_folder)
+            production_model = diagnostics.production_model
+            diagnostics.production_model = ModelCache(
+                os.path.join(model_folder, 'trainedmodel.pkl'))
+            try:
+                results["stages"]["predictions"] = measure(
+                    lambda: diagnostics.model_predictions(master_df),
+                    None, warmup, repetitions)
+            finally:
+                diagnostics.production_model = production_model
+
+    return results
+
+def run_benchmarks(row_counts, warmup=1, repetitions=5, files=4, seed=0, stages=STAGES):
+    """
+    Benchmark the pipeline stages for each dataset size
+    Input: list of numbers of rows, warmup runs, timed runs,
+    number of source files, random seed, list of stages
+    Output: A json-serializable dictionary of the run
+    """
+    return {
+        "created_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "warmup": warmup,
+        "repetitions": repetitions,
+        "results": [benchmark_stages(rows, warmup, repetitions, files, seed, stages)
+                    for rows in row_counts],
+    }
+
+def compare_runs(previous, current):
+    """
+    Compare the median timings of two benchmark runs
+    Input: previous and current outputs of run_benchmarks()
+    Output: A list of dictionaries with the p50 of both runs and their ratio
+    """
+    previous_p50 = {(result["rows"], stage): summary["p50_seconds"]
+                    for result in previous["results"]
+                    for stage, summary in result["stages"].items()}
+    comparison = []
+    for result in current["results"]:
+        for stage, summary in result["stages"].items():
+            before = previous_p50.get((result["rows"], stage))
+            if before is None:
+                continue
+            comparison.append({
+                "rows": result["rows"],
+                "stage": stage,
+                "previous_p50_seconds": before,
+                "current_p50_seconds": summary["p50_seconds"],
+                "ratio": summary["p50_seconds"] / before if before else None,
+            })
+    return comparison
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='dataset sizes, from 10^3 up to 10^7 rows')
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repetitions', type=int, default=5)
+    parser.add_argument('--files', type=int, default=4, help='source files per dataset')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--output', help='json file to write the results to')
+    parser.add_argument('--compare', help='json file of a previous run to compare with')
+    args = parser.parse_args()
+
+    # keep the per-stage logs out of the timings
+    logger.setLevel(logging.WARNING)
+    run = run_benchmarks(args.rows, args.warmup, args.repetitions, args.files,
+                         stages=args.stages)
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            run["comparison"] = compare_runs(json.load(f), run)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(run, f, indent=2)
+    print(json.dumps(run, indent=2))
@@ -0,0 +1,118 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to benchmark serial against parallel
+preparation of source files in ingestion, for a growing number of files.
+A worker costs a process start and the pickling of its results, so the
+speedup is below 1 on a single cpu or with few small files
+"""
+
+import argparse
+import filecmp
+import json
+import logging
+import os
+import tempfile
+import timeit
+
+import numpy as np
+import pandas as pd
+
+import ingestion
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger()
+
+#############Function to generate synthetic source files
+def synthetic_dataframe(rows, seed=0):
+    """
+    Generate a synthetic dataset with the columns of the source files
+    Input: number of rows, random seed
+    Output: dataframe of synthetic records
+    """
+    rng = np.random.default_rng(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    corporation = [''.join(word) for word in rng.choice(letters, size=(rows, 4))]
+    return pd.DataFrame({
+        'corporation': corporation,
+        'lastmonth_activity': rng.integers(0, 100000, rows),
+        'lastyear_activity': rng.integers(0, 20000, rows),
+        'number_of_employees': rng.integers(1, 5000, rows),
+        'exited': rng.integers(0, 2, rows),
+    })
+
+def write_synthetic_sources(folder_path, files, rows_per_file, seed=0):
+    """
+    Write synthetic source csv files into a folder
+    Input: folder, number of files, number of rows per file, random seed
+    Output: list of the written csv files
+    """
+    os.makedirs(folder_path, exist_ok=True)
+    csv_files = []
+    for i in range(files):
+        filepath = os.path.join(folder_path, f'dataset{i:05d}.csv')
+        synthetic_dataframe(rows_per_file, seed + i).to_csv(filepath, index=False)
+        csv_files.append(filepath)
+    return csv_files
+
+#############Function to benchmark ingestion
+def time_ingestion(input_folder, output_folder, workers):
+    """
+    Time a full ingestion of input_folder into an empty output_folder
+    Input: source folder, output folder, number of worker processes
+    Output: ingestion time in seconds
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    starttime = timeit.default_timer()
+    ingestion.merge_multiple_dataframe(chunksize=None, export_csv=True, workers=workers,
+                                       input_folder=input_folder,
+                                       output_folder=output_folder)
+    return timeit.default_timer() - starttime
+
+def benchmark_parallel_ingestion(file_counts, rows_per_file, workers):
+    """
+    Compare serial and parallel ingestion for each number of source files,
+    and check that both write byte-identical master datasets
+    Input: list of numbers of files, number of rows per file, number of workers
+    Output: A list of dictionaries with the timings and speedup per number of files
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for files in file_counts:
+            input_folder = os.path.join(workdir, f'source{files}')
+            write_synthetic_sources(input_folder, files, rows_per_file)
+
+            serial_folder = os.path.join(workdir, f'serial{files}')
+            parallel_folder = os.path.join(workdir, f'parallel{files}')
+            serial_time = time_ingestion(input_folder, serial_folder, 1)
+            parallel_time = time_ingestion(input_folder, parallel_folder, workers)
+
+            identical = filecmp.cmp(os.path.join(serial_folder, 'finaldata.csv'),
+                                    os.path.join(parallel_folder, 'finaldata.csv'),
+                                    shallow=False)
+            results.append({
+                'files': files,
+                'rows_per_file': rows_per_file,
+                'workers': workers,
+                'cpus': os.cpu_count(),
+                'serial_seconds': serial_time,
+                'parallel_seconds': parallel_time,
+                'speedup': serial_time / parallel_time,
+                'identical_output': identical,
+            })
+            logger.info(f"benchmark result: {results[-1]}")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--files', type=int, nargs='+', default=[1, 4, 16, 64])
+    parser.add_argument('--rows-per-file', type=int, default=20000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    # keep the per-file ingestion logs out of the benchmark output
+    logger.setLevel(logging.WARNING)
+    results = benchmark_parallel_ingestion(args.files, args.rows_per_file, args.workers)
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,109 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to compare the throughput and latency of
+/prediction served by the Flask development server (`python app.py`)
+and by gunicorn with the preloaded, forked workers of gunicorn.conf.py,
+e.g. `python benchmark_serving.py --concurrency 16 --seconds 10`
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import requests
+
+import apicalls
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger()
+
+DEV_SERVER_PORT = 8000
+GUNICORN_PORT = 8001
+
+# one inline record per request, the common online prediction
+RECORD = {"lastmonth_activity": 234, "lastyear_activity": 3461, "number_of_employees": 10}
+
+#############Functions to start the servers
+def server_commands(workers, threads):
+    """
+    Input: number of gunicorn workers and threads per worker
+    Output: dictionary of server name to (command, environment, port)
+    """
+    gunicorn_env = dict(os.environ, GUNICORN_WORKERS=str(workers), GUNICORN_THREADS=str(threads),
+                        GUNICORN_BIND=f'127.0.0.1:{GUNICORN_PORT}')
+    return {
+        'dev_server': ([sys.executable, 'app.py'], dict(os.environ), DEV_SERVER_PORT),
+        'gunicorn': ([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:application'],
+                     gunicorn_env, GUNICORN_PORT),
+    }
+
+def wait_until_ready(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if requests.get(url, timeout=1).ok:
+                return
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not answer within {timeout} seconds")
+
+def benchmark(concurrency=8, seconds=10, rows=1, workers=None, threads=4):
+    """
+    Start each server in turn, load it and stop it
+    Input: number of client threads, seconds of load per server, records
+    per request, gunicorn workers (default to the cpu count) and threads
+    Output: list of results, one per server
+    """
+    workers = workers or os.cpu_count() or 1
+    endpoint_requests = {'prediction': ('POST', '/prediction',
+                                        {'json': {"records": [RECORD] * rows}})}
+    results = []
+    for name, (command, env, port) in server_commands(workers, threads).items():
+        logger.info(f"Starting {name}: {' '.join(command)}")
+        # own process group, so the dev server reloader child is stopped too
+        process = subprocess.Popen(command, env=env, start_new_session=True,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_until_ready(f'http://127.0.0.1:{port}/')
+            url = f'http://127.0.0.1:{port}'
+            # warm up the model and the connections
+            apicalls.run_load(url, {'prediction': 1}, concurrency, seconds=1,
+                              endpoint_requests=endpoint_requests)
+            report = apicalls.run_load(url, {'prediction': 1}, concurrency, seconds=seconds,
+                                       endpoint_requests=endpoint_requests)
+            result = dict(report['endpoints']['prediction'], server=name,
+                          concurrency=concurrency, rows_per_request=rows)
+            if name == 'gunicorn':
+                result.update(workers=workers, threads=threads)
+            logger.info(f"{name}: {result['requests_per_second']:.0f} requests/s, "
+                        f"p50 {result['p50_ms']:.1f} ms, p99 {result['p99_ms']:.1f} ms")
+            results.append(result)
+        finally:
+            os.killpg(process.pid, signal.SIGTERM)
+            process.wait()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--rows', type=int, default=1, help='records per request')
+    parser.add_argument('--workers', type=int, help='gunicorn workers, default to the cpu count')
+    parser.add_argument('--threads', type=int, default=4, help='gunicorn threads per worker')
+    parser.add_argument('--output', help='json file to write the results to')
+    args = parser.parse_args()
+
+    results = benchmark(args.concurrency, args.seconds, args.rows, args.workers, args.threads)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,124 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to benchmark the startup of the API and
+of each command line script with `python -X importtime`: the import time of
+each module is measured in a fresh interpreter and compared with a budget,
+so an import of pandas, sklearn or matplotlib (or config/data loading)
+creeping back to import time is caught.
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger()
+
+# import time budget of each entry point, in milliseconds.
+# fullprocess only checks for new data when it starts, so it must stay
+# free of pandas, sklearn and matplotlib; the others need pandas and numpy
+# but defer sklearn and matplotlib to the functions using them
+STARTUP_BUDGETS_MS = {
+    'fullprocess': 150,
+    'apicalls': 400,
+    'app': 1500,
+    'ingestion': 1000,
+    'training': 1000,
+    'scoring': 1000,
+    'deployment': 150,
+    'diagnostics': 1000,
+    'reporting': 1000,
+}
+# modules which must not be imported when an entry point starts
+DEFERRED_MODULES = ['sklearn', 'matplotlib']
+
+IMPORTTIME_PATTERN = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+#############Functions to measure the startup
+def parse_importtime(stderr):
+    """
+    Parse the output of `python -X importtime`
+    Input: stderr of the interpreter
+    Output: list of (module, self microseconds, cumulative microseconds, depth)
+    """
+    imports = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if match:
+            imports.append((match.group(4), int(match.group(1)), int(match.group(2)),
+                            len(match.group(3)) // 2))
+    return imports
+
+def measure_startup(module, repetitions=3, top=5):
+    """
+    Import a module in fresh interpreters and keep the fastest run,
+    without the imports of the interpreter startup
+    Input: module name, number of runs, number of slowest imports to report
+    Output: A dictionary of the import time, the slowest top-level imports
+    and the deferred modules which were imported anyway
+    """
+    best = None
+    for _ in range(repetitions):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                                 capture_output=True, text=True, cwd=os.getcwd())
+        if process.returncode != 0:
+            raise RuntimeError(f"import {module} failed:\n{process.stderr[-2000:]}")
+        imports = parse_importtime(process.stderr)
+        # cumulative time of `import module` only: the interpreter imports
+        # site and its .pth hooks before, which vary with the environment
+        total_us = next(cumulative_us for name, _, cumulative_us, depth in reversed(imports)
+                        if name == module and depth == 0)
+        if best is None or total_us < best[0]:
+            best = (total_us, imports)
+
+    total_us, imports = best
+    top_level = sorted((entry for entry in imports if entry[3] == 0),
+                       key=lambda entry: entry[2], reverse=True)
+    imported = {name.split('.')[0] for name, _, _, _ in imports}
+    return {
+        "module": module,
+        "import_ms": total_us / 1000,
+        "slowest_imports_ms": {name: cumulative / 1000
+                               for name, _, cumulative, _ in top_level[:top]},
+        "deferred_modules_imported": [name for name in DEFERRED_MODULES if name in imported],
+    }
+
+def check_budgets(modules=None, repetitions=3):
+    """
+    Measure the startup of the entry points against their budgets
+    Input: list of modules (all of STARTUP_BUDGETS_MS if None), number of runs
+    Output: A list of results, with "budget_ms" and "within_budget"
+    """
+    results = []
+    for module in modules or STARTUP_BUDGETS_MS:
+        result = measure_startup(module, repetitions)
+        result["budget_ms"] = STARTUP_BUDGETS_MS.get(module)
+        result["within_budget"] = (
+            not result["deferred_modules_imported"]
+            and (result["budget_ms"] is None or result["import_ms"] <= result["budget_ms"]))
+        logger.info(f"import {module}: {result['import_ms']:.0f} ms "
+                    f"(budget {result['budget_ms']} ms)")
+        results.append(result)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--modules', nargs='+', help='entry points to measure')
+    parser.add_argument('--repetitions', type=int, default=3)
+    parser.add_argument('--output', help='json file to write the results to')
+    args = parser.parse_args()
+
+    results = check_budgets(args.modules, args.repetitions)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
+    # a non-zero exit status fails a CI step when a budget is exceeded
+    sys.exit(0 if all(result["within_budget"] for result in results) else 1)
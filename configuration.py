@@ -0,0 +1,42 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to load config.json on first use
+instead of at import time, once per process and working directory
+"""
+
+import json
+import os
+
+CONFIG_FILE = 'config.json'
+
+# working directory -> config dictionary
+_configs = {}
+
+def load_config():
+    """
+    Load config.json of the working directory, cached after the first call
+    Input: None
+    Output: config dictionary
+    """
+    cwd = os.getcwd()
+    if cwd not in _configs:
+        with open(os.path.join(cwd, CONFIG_FILE), 'r') as f:
+            _configs[cwd] = json.load(f)
+    return _configs[cwd]
+
+def config_path(key):
+    """
+    Get a folder of config.json as an absolute path
+    Input: key of the folder, e.g. "output_folder_path"
+    Output: path of the folder under the working directory
+    """
+    return os.path.join(os.getcwd(), load_config()[key])
+
+def config_value(key, default=None):
+    """
+    Get an optional setting of config.json
+    Input: key of the setting, value when it is not set
+    Output: value of the setting
+    """
+    return load_config().get(key, default)
@@ -0,0 +1,490 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to store the master dataset as a typed,
+columnar artifact: one memory-mappable .npy file per column and a
+schema.json which records the column order, roles and dtypes
+"""
+
+import pandas as pd
+import numpy as np
+import hashlib
+import io
+import os
+import json
+import logging
+import uuid
+from itertools import islice
+from json.encoder import encode_basestring_ascii
+
+import configuration
+import metrics
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger()
+
+DATA_LOAD_SECONDS = metrics.histogram(
+    'data_load_seconds', 'Seconds spent loading data, from a csv file or the master dataset',
+    ('source',))
+
+DATASET_FOLDER = 'finaldata'
+SCHEMA_FILE = 'schema.json'
+
+# column roles of the master dataset
+ID_COLUMN = 'corporation'
+FEATURE_COLUMNS = ['lastmonth_activity', 'lastyear_activity', 'number_of_employees']
+TARGET_COLUMN = 'exited'
+
+# smallest safe dtypes of the columns, applied when csv files are parsed.
+# activities reach ~1e5 and employee counts can pass the int16 range,
+# corporation is a short string id which is dropped for modeling
+COLUMN_DTYPES = {
+    'corporation': 'category',
+    'lastmonth_activity': 'int32',
+    'lastyear_activity': 'int32',
+    'number_of_employees': 'int32',
+    'exited': 'int8',
+}
+# integer columns with missing values cannot be parsed as integers,
+# they are parsed as floats and narrowed back by _narrow_columns
+NULLABLE_COLUMN_DTYPES = {
+    name: ('float64' if dtype.startswith('int') else dtype)
+    for name, dtype in COLUMN_DTYPES.items()
+}
+
+#############Functions to parse csv files with the declared dtypes
+def _narrow_columns(df, filepath):
+    """
+    Give the integer columns parsed as floats their declared dtype back,
+    except the columns which do hold missing or non-integer values
+    Input: dataframe parsed with NULLABLE_COLUMN_DTYPES, path of the csv file
+    Output: dataframe; raise a ValueError if the target is one of those columns
+    """
+    widened = []
+    for name, dtype in COLUMN_DTYPES.items():
+        if name not in df.columns or NULLABLE_COLUMN_DTYPES[name] == dtype:
+            continue
+        values = df[name].to_numpy()
+        if np.isnan(values).any() or (values % 1 != 0).any():
+            widened.append(name)
+        else:
+            df[name] = values.astype(dtype)
+    if TARGET_COLUMN in widened:
+        # a float target would change the type of the labels and predictions
+        raise ValueError(f"{filepath} has missing or non-integer {TARGET_COLUMN} values")
+    if widened:
+        logger.warning(f"Missing or non-integer values in the columns {widened} "
+                       f"of {filepath}, parsing them as floats")
+    return df
+
+def read_csv(filepath, **kwargs):
+    """
+    Parse a csv file with the declared column dtypes
+    Input: path of the csv file, extra arguments of pd.read_csv
+    Output: dataframe with compact dtypes, float64 for the integer
+    columns with missing values
+    """
+    with DATA_LOAD_SECONDS.time(source='csv'):
+        try:
+            return pd.read_csv(filepath, dtype=COLUMN_DTYPES, **kwargs)
+        except ValueError:
+            return _narrow_columns(
+                pd.read_csv(filepath, dtype=NULLABLE_COLUMN_DTYPES, **kwargs), filepath)
+
+def read_csv_chunks(filepath, chunksize):
+    """
+    Parse a csv file in chunks with the declared column dtypes
+    Input: path of the csv file, number of rows per chunk
+    Output: generator of dataframes with compact dtypes, float64 for the
+    integer columns with missing values in the chunk
+    """
+    rows = 0
+    try:
+        for chunk in pd.read_csv(filepath, dtype=COLUMN_DTYPES, chunksize=chunksize):
+            rows += len(chunk)
+            yield chunk
+    except ValueError:
+        for chunk in pd.read_csv(filepath, dtype=NULLABLE_COLUMN_DTYPES,
+                                 chunksize=chunksize, skiprows=range(1, rows + 1)):
+            yield _narrow_columns(chunk, filepath)
+
+def validate_columns(df, filepath):
+    """
+    Check that a parsed csv file holds every declared column
+    Input: dataframe, path of the parsed file
+    Output: None, raise a ValueError if a declared column is missing
+    """
+    missing = [name for name in COLUMN_DTYPES if name not in df.columns]
+    if missing:
+        raise ValueError(f"{filepath} is missing the columns {missing}")
+
+def features_from_payload(payload):
+    """
+    Build the feature matrix of a json prediction batch, either
+    "records": a list of {column: value} objects, or
+    "columns": a {column: list of values} object
+    Input: decoded json payload
+    Output: float64 numpy array of shape (rows, len(FEATURE_COLUMNS))
+    Raise a ValueError describing why the payload is invalid
+    """
+    if not isinstance(payload, dict):
+        raise ValueError('payload must be a json object')
+    if 'records' in payload:
+        records = payload['records']
+        if not isinstance(records, list):
+            raise ValueError('"records" must be a list of objects')
+        missing = {name for record in records for name in FEATURE_COLUMNS
+                   if not isinstance(record, dict) or name not in record}
+        if missing:
+            raise ValueError(f"records are missing the features {sorted(missing)}")
+        rows = [[record[name] for name in FEATURE_COLUMNS] for record in records]
+        features = np.array(rows, dtype=object).reshape(len(rows), len(FEATURE_COLUMNS))
+    elif 'columns' in payload:
+        columns = payload['columns']
+        if not isinstance(columns, dict):
+            raise ValueError('"columns" must be an object of column -> values')
+        missing = [name for name in FEATURE_COLUMNS if name not in columns]
+        if missing:
+            raise ValueError(f"columns are missing the features {missing}")
+        not_lists = [name for name in FEATURE_COLUMNS if not isinstance(columns[name], list)]
+        if not_lists:
+            raise ValueError(f"columns {not_lists} must be lists of values")
+        if len({len(columns[name]) for name in FEATURE_COLUMNS}) > 1:
+            raise ValueError("feature columns have different lengths")
+        features = np.array([columns[name] for name in FEATURE_COLUMNS], dtype=object).T
+    else:
+        raise ValueError('payload needs "filepath", "records" or "columns"')
+
+    # json true/false would otherwise be cast to 1.0/0.0
+    if any(isinstance(value, bool) for value in features.flat):
+        raise ValueError("feature values must be numbers")
+    try:
+        features = features.astype(np.float64)
+    except (TypeError, ValueError):
+        raise ValueError("feature values must be numbers")
+    if np.isnan(features).any():
+        raise ValueError("feature values must not be missing")
+    # numbers like 1e400 parse to inf
+    if not np.isfinite(features).all():
+        raise ValueError("feature values must be finite numbers")
+    return features.reshape(-1, len(FEATURE_COLUMNS))
+
+def memory_usage(df):
+    """
+    Measure the memory of a dataframe against the default int64/float64/object
+    dtypes pandas would have parsed it into
+    Input: dataframe
+    Output: bytes used by df, bytes used with the default dtypes
+    """
+    default = 0
+    for name in df.columns:
+        if pd.api.types.is_numeric_dtype(df[name]):
+            default += len(df) * 8
+        else:
+            default += df[name].astype(object).memory_usage(deep=True, index=False)
+    return int(df.memory_usage(deep=True, index=False).sum()), int(default)
+
+#############Functions for the dataset layout
+def output_folder(folder_path=None):
+    """
+    Get the folder holding the master dataset
+    Input: folder holding the dataset, None for output_folder_path of config.json
+    Output: path of the folder
+    """
+    return folder_path or configuration.config_path('output_folder_path')
+
+def dataset_path(folder_path=None):
+    """
+    Get the folder of the columnar master dataset
+    Input: folder holding the dataset, defaults to output_folder_path
+    Output: path of the columnar dataset folder
+    """
+    return os.path.join(output_folder(folder_path), DATASET_FOLDER)
+
+def dataset_exists(folder_path=None):
+    """
+    Check whether the columnar master dataset has been written
+    Input: folder holding the dataset, defaults to output_folder_path
+    Output: True if the dataset exists
+    """
+    return os.path.exists(os.path.join(dataset_path(folder_path), SCHEMA_FILE))
+
+def read_schema(folder_path=None):
+    """
+    Read the schema of the columnar master dataset
+    Input: folder holding the dataset, defaults to output_folder_path
+    Output:
+    A dictionary of "columns" (name, role, dtype and number of categories),
+    "rows", "generation" and "content_hash"
+    """
+    with open(os.path.join(dataset_path(folder_path), SCHEMA_FILE), 'r') as f:
+        return json.load(f)
+
+def _write_schema(schema, folder_path=None):
+    # the schema is written last and atomically, so readers never see
+    # rows which are not fully appended to every column yet
+    schema_path = os.path.join(dataset_path(folder_path), SCHEMA_FILE)
+    tmp_path = schema_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(schema, f, indent=2)
+    os.replace(tmp_path, schema_path)
+
+def _column_role(name):
+    if name == ID_COLUMN:
+        return 'id'
+    if name == TARGET_COLUMN:
+        return 'target'
+    return 'feature'
+
+#############Functions for the column files
+def _column_file(name, folder_path=None):
+    return os.path.join(dataset_path(folder_path), f'{name}.npy')
+
+def _categories_file(name, folder_path=None):
+    return os.path.join(dataset_path(folder_path), f'{name}.categories')
+
+# category lookups of the string columns, so appending a chunk
+# does not re-read every category ever seen
+_categories_cache = {}
+
+def read_categories(column, generation, folder_path=None):
+    """
+    Read the categories of a string column, one json value per line
+    Input: column of the schema, dataset generation, folder holding the dataset
+    Output: list of category values, dictionary of value -> code
+    """
+    filepath = _categories_file(column['name'], folder_path)
+    cached = _categories_cache.get(filepath)
+    if cached is None or cached[0] != generation or len(cached[1]) != column['categories']:
+        with open(filepath, 'r') as f:
+            values = [json.loads(line) for line in islice(f, column['categories'])]
+        cached = (generation, values, {value: code for code, value in enumerate(values)})
+        _categories_cache[filepath] = cached
+    return cached[1], cached[2]
+
+def _encode_column(series, column, generation, folder_path=None):
+    """
+    Convert a column of a dataframe to the array stored on disk.
+    String columns are stored as int32 codes into the categories file,
+    which is extended with the values never seen before.
+    """
+    if column['dtype'] != 'category':
+        return series.to_numpy()
+    values, lookup = read_categories(column, generation, folder_path)
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        # already factorized, e.g. parsed by read_csv: map the categories
+        # present in the rows, in order of first appearance like factorize
+        codes = series.cat.codes.to_numpy()
+        present, first = np.unique(codes, return_index=True)
+        order = present[np.argsort(first)]
+        order = order[order >= 0]
+        uniques = series.cat.categories.to_numpy(dtype=object)[order]
+        mapping = np.empty(len(series.cat.categories) + 1, dtype=np.int32)
+    else:
+        # factorize once, then only map the distinct values to stored codes
+        codes, uniques = pd.factorize(series.to_numpy(dtype=object))
+        order = np.arange(len(uniques))
+        mapping = np.empty(len(uniques) + 1, dtype=np.int32)
+    mapping[-1] = -1
+    new_values = []
+    for i, value in zip(order.tolist(), uniques):
+        value = str(value)
+        if value not in lookup:
+            lookup[value] = len(values)
+            values.append(value)
+            new_values.append(value)
+        mapping[i] = lookup[value]
+
+    if new_values:
+        # drop any tail left over by an interrupted append, then append
+        with open(_categories_file(column['name'], folder_path), 'r+b') as f:
+            f.seek(column['categories_bytes'])
+            # same lines as json.dumps, without its per-call overhead
+            data = ''.join(encode_basestring_ascii(value) + '\n' for value in new_values).encode()
+            f.write(data)
+            f.truncate()
+        column['categories'] += len(new_values)
+        column['categories_bytes'] += len(data)
+    return mapping[codes]
+
+def append_npy(filepath, values):
+    """
+    Append values to a 1-d .npy file in place. Only the header is rewritten
+    when it keeps its length, which numpy's header padding makes the common
+    case; otherwise the whole file is rewritten.
+    """
+    with open(filepath, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            write_header = np.lib.format.write_array_header_1_0
+        elif version == (2, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            write_header = np.lib.format.write_array_header_2_0
+        else:
+            write_header = None
+        data_offset = f.tell()
+
+        if write_header is not None:
+            header = io.BytesIO()
+            write_header(header, {'descr': np.lib.format.dtype_to_descr(dtype),
+                                  'fortran_order': fortran_order,
+                                  'shape': (shape[0] + len(values),)})
+            header = header.getvalue()
+            if len(header) == data_offset:
+                f.seek(data_offset + shape[0] * dtype.itemsize)
+                f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+                f.truncate()
+                f.seek(0)
+                f.write(header)
+                return
+
+    existing = np.load(filepath)
+    tmp_path = filepath[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_path, np.concatenate([existing, values.astype(existing.dtype)]))
+    os.replace(tmp_path, filepath)
+
+def _chain_hash(previous_hash, arrays):
+    digest = hashlib.sha256(previous_hash.encode())
+    for values in arrays:
+        digest.update(np.ascontiguousarray(values).tobytes())
+    return digest.hexdigest()
+
+#############Functions to write the dataset
+def write_dataset(df, folder_path=None):
+    """
+    Write a dataframe as a new columnar master dataset,
+    replacing the previous one
+    Input: dataframe, folder holding the dataset
+    Output: one .npy file per column and schema.json
+    """
+    os.makedirs(dataset_path(folder_path), exist_ok=True)
+    columns = []
+    for name in df.columns:
+        dtype = ('category' if not pd.api.types.is_numeric_dtype(df[name])
+                 else str(df[name].dtype))
+        columns.append({'name': name, 'role': _column_role(name), 'dtype': dtype})
+        if dtype == 'category':
+            columns[-1].update(categories=0, categories_bytes=0)
+            open(_categories_file(name, folder_path), 'w').close()
+
+    generation = uuid.uuid4().hex
+    arrays = [_encode_column(df[column['name']], column, generation, folder_path)
+              for column in columns]
+    for column, values in zip(columns, arrays):
+        np.save(_column_file(column['name'], folder_path), values)
+
+    _write_schema({'columns': columns,
+                   'rows': len(df),
+                   'generation': generation,
+                   'content_hash': _chain_hash('', arrays)}, folder_path)
+    logger.info(f"Saved {len(df)} rows to {dataset_path(folder_path)}")
+
+def append_rows(df, folder_path=None):
+    """
+    Append the rows of a dataframe to the columnar master dataset,
+    writing only the new rows
+    Input: dataframe with the dataset columns, folder holding the dataset
+    Output: rows appended to each .npy file and schema.json updated
+    """
+    if not dataset_exists(folder_path):
+        write_dataset(df, folder_path)
+        return
+    schema = read_schema(folder_path)
+    if len(df) == 0:
+        return
+
+    arrays = []
+    for column in schema['columns']:
+        values = _encode_column(df[column['name']], column, schema['generation'],
+                                folder_path)
+        if column['dtype'] != 'category':
+            dtype = np.result_type(np.dtype(column['dtype']), values.dtype)
+            if dtype != np.dtype(column['dtype']):
+                # e.g. missing values in an integer column, promote the stored column
+                filepath = _column_file(column['name'], folder_path)
+                stored = np.load(filepath)[:schema['rows']]
+                np.save(filepath, stored.astype(dtype))
+                column['dtype'] = str(dtype)
+            values = values.astype(column['dtype'])
+        arrays.append(values)
+
+    for column, values in zip(schema['columns'], arrays):
+        filepath = _column_file(column['name'], folder_path)
+        # drop any tail left over by an interrupted append
+        if len(np.load(filepath, mmap_mode='r')) != schema['rows']:
+            np.save(filepath, np.load(filepath)[:schema['rows']])
+        append_npy(filepath, values)
+
+    schema['rows'] += len(df)
+    schema['content_hash'] = _chain_hash(schema['content_hash'], arrays)
+    _write_schema(schema, folder_path)
+
+def truncate_rows(rows, folder_path=None):
+    """
+    Keep only the first rows of the columnar master dataset, e.g. to drop
+    the rows of an ingestion interrupted before it recorded them
+    Input: number of rows to keep, folder holding the dataset
+    Output: .npy files truncated and schema.json updated, with a new
+    generation so the readers caching rows start over
+    """
+    schema = read_schema(folder_path)
+    if rows >= schema['rows']:
+        return
+    arrays = []
+    for column in schema['columns']:
+        filepath = _column_file(column['name'], folder_path)
+        values = np.load(filepath)[:rows]
+        tmp_path = filepath[:-len('.npy')] + '.tmp.npy'
+        np.save(tmp_path, values)
+        os.replace(tmp_path, filepath)
+        arrays.append(values)
+    logger.info(f"Truncated {dataset_path(folder_path)} from {schema['rows']} to {rows} rows")
+    schema.update(rows=rows, generation=uuid.uuid4().hex,
+                  content_hash=_chain_hash('', arrays))
+    _write_schema(schema, folder_path)
+
+#############Functions to read the dataset
+def load_column(name, folder_path=None, mmap=True):
+    """
+    Load one column of the master dataset without parsing or copying
+    Input: column name, folder holding the dataset, whether to memory-map
+    Output:
+    numpy array of the column values,
+    int32 codes into read_categories() for string columns
+    """
+    schema = read_schema(folder_path)
+    values = np.load(_column_file(name, folder_path),
+                     mmap_mode='r' if mmap else None)
+    return values[:schema['rows']]
+
+def load_dataframe(columns=None, folder_path=None):
+    """
+    Load the master dataset as a dataframe with its recorded dtypes
+    Input: list of column names (all columns if None), folder holding the dataset
+    Output: dataframe of the master dataset
+    """
+    with DATA_LOAD_SECONDS.time(source='dataset'):
+        schema = read_schema(folder_path)
+        data = {}
+        for column in schema['columns']:
+            if columns is not None and column['name'] not in columns:
+                continue
+            values = np.load(_column_file(column['name'], folder_path), mmap_mode='r')
+            values = values[:schema['rows']]
+            if column['dtype'] == 'category':
+                categories, _ = read_categories(column, schema['generation'], folder_path)
+                values = pd.Categorical.from_codes(values, categories=categories)
+            data[column['name']] = values
+        df = pd.DataFrame(data)
+        return df if columns is None else df[columns]
+
+def load_features_and_target(folder_path=None):
+    """
+    Load the model features and the target of the master dataset
+    Input: folder holding the dataset
+    Output: dataframe of the feature columns, series of the target column
+    """
+    df = load_dataframe(FEATURE_COLUMNS + [TARGET_COLUMN], folder_path)
+    return df[FEATURE_COLUMNS], df[TARGET_COLUMN]
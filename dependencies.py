@@ -0,0 +1,199 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to check the installed and latest
+versions of the project dependencies in-process, without running pip.
+Installed versions come from importlib.metadata, latest versions from
+a pluggable source (a local package index folder or a snapshot file)
+cached with a TTL.
+"""
+
+import json
+import logging
+import os
+import re
+import time
+from importlib import metadata
+
+try:
+    from packaging.version import InvalidVersion, Version
+except ImportError:
+    Version = None
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger()
+
+# distribution files of a package index: wheels and source archives
+DISTRIBUTION_PATTERN = re.compile(
+    r'^(?P<name>.+?)-(?P<version>\d[^-]*?)(-.*\.whl|\.tar\.gz|\.tar\.bz2|\.zip)$')
+
+#############Functions for package names and versions
+def normalize_name(name):
+    """
+    Normalize a package name as in PEP 503, e.g. Flask_Cors -> flask-cors
+    Input: package name
+    Output: normalized package name
+    """
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+def version_key(version):
+    """
+    Sort key of a version string, with packaging if it is installed
+    Input: version string
+    Output: comparable key
+    """
+    if Version is not None:
+        try:
+            return (1, Version(version))
+        except InvalidVersion:
+            pass
+    return (0, tuple(int(part) if part.isdigit() else -1
+                     for part in re.split(r'[.+-]', version)))
+
+def read_requirements(requirements_path='requirements.txt'):
+    """
+    Read the pinned requirements of the project
+    Input: path of requirements.txt
+    Output: list of (package, required version)
+    """
+    requirements = []
+    with open(requirements_path, 'r') as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            package, _, version = line.partition('==')
+            requirements.append((package.strip(), version.strip() or None))
+    return requirements
+
+def installed_version(package):
+    """
+    Get the installed version of a package from its metadata
+    Input: package name
+    Output: installed version, None if it is not installed
+    """
+    try:
+        return metadata.version(package)
+    except metadata.PackageNotFoundError:
+        return None
+
+#############Classes for the sources of latest versions
+class LocalIndexSource:
+    """
+    Latest versions from a folder of distribution files, either flat
+    (e.g. filled by `pip download`) or with one sub-folder per package
+    as in a PEP 503 simple index mirror
+    """
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+
+    def latest_versions(self):
+        latest = {}
+        for root, _, files in os.walk(self.index_path):
+            for filename in files:
+                match = DISTRIBUTION_PATTERN.match(filename)
+                if match is None:
+                    continue
+                package = normalize_name(match.group('name'))
+                version = match.group('version')
+                if package not in latest or version_key(version) > version_key(latest[package]):
+                    latest[package] = version
+        return latest
+
+
+class SnapshotFileSource:
+    """
+    Latest versions from a json snapshot of a mirror: {"package": "version"}
+    """
+
+    def __init__(self, snapshot_path):
+        self.snapshot_path = snapshot_path
+
+    def latest_versions(self):
+        with open(self.snapshot_path, 'r') as f:
+            snapshot = json.load(f)
+        return {normalize_name(package): version for package, version in snapshot.items()}
+
+
+class CachedSource:
+    """
+    Cache the latest versions of another source in memory and in a json
+    file, for ttl_seconds. A stale cache is still used when the source fails.
+    """
+
+    def __init__(self, source, cache_path, ttl_seconds=86400):
+        self.source = source
+        self.cache_path = cache_path
+        self.ttl_seconds = ttl_seconds
+        self._cache = None
+
+    def _read_cache(self):
+        if self._cache is None and os.path.exists(self.cache_path):
+            with open(self.cache_path, 'r') as f:
+                self._cache = json.load(f)
+        return self._cache
+
+    def latest_versions(self):
+        cache = self._read_cache()
+        if cache is not None and time.time() - cache['fetched_at'] < self.ttl_seconds:
+            return cache['versions']
+        try:
+            versions = self.source.latest_versions()
+        except OSError:
+            if cache is None:
+                raise
+            logger.warning(f"Latest versions unavailable, using the cache of "
+                           f"{time.ctime(cache['fetched_at'])}")
+            return cache['versions']
+
+        self._cache = {'fetched_at': time.time(), 'versions': versions}
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._cache, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.cache_path)
+        return versions
+
+
+def source_from_config(config):
+    """
+    Build the cached source of latest versions configured in config.json:
+    "package_index" is a folder of distribution files or a json snapshot,
+    "package_index_ttl_seconds" is the cache TTL
+    Input: config dictionary
+    Output: a CachedSource, None when no package index is configured
+    """
+    index_path = config.get('package_index')
+    if not index_path:
+        return None
+    index_path = os.path.join(os.getcwd(), index_path)
+    source = (LocalIndexSource(index_path) if os.path.isdir(index_path)
+              else SnapshotFileSource(index_path))
+    return CachedSource(source, os.path.join(os.getcwd(), 'package_index_cache.json'),
+                        config.get('package_index_ttl_seconds', 86400))
+
+#############Function to check the dependencies
+def dependency_versions(requirements_path='requirements.txt', source=None):
+    """
+    Compare the required, installed and latest version of each requirement
+    Input: path of requirements.txt, source of latest versions (None to skip)
+    Output: list of dictionaries of "Package", "Requirement Version",
+    "Installed Version" and "Latest Version"
+    """
+    latest = {}
+    if source is not None:
+        try:
+            latest = source.latest_versions()
+        except (OSError, ValueError) as error:
+            logger.warning(f"Latest versions unavailable: {error}")
+
+    rows = []
+    for package, required in read_requirements(requirements_path):
+        rows.append({
+            "Package": package.lower(),
+            "Requirement Version": required,
+            "Installed Version": installed_version(package),
+            "Latest Version": latest.get(normalize_name(package)),
+        })
+    return rows
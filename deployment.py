@@ -3,54 +3,82 @@ Author: Thanh Ta
 Date: March, 2024
 Description: 
 This script is used to deploy the latest pickle file, 
-the latestscore.txt value and 
-the ingestfiles.txt file into the deployment directory
+its trainedmodel.json artifact, the latestscore.txt value and 
+the ingestfiles.txt file into the deployment directory, as an immutable
+release of registry.py; `--rollback` switches back to an earlier release
+and pins it until `--unpin`
 """
 
 
-import pandas as pd
 import os
 import json
+import argparse
 import logging
-import shutil
+import sys
+
+import configuration
+import registry
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger()
 
-##################Load config.json and correct path variable
-with open('config.json','r') as f:
-    config = json.load(f) 
-
-dataset_csv_path = os.path.join(os.getcwd(), config['output_folder_path']) 
-prod_deployment_path = os.path.join(os.getcwd(), config['prod_deployment_path'])
-output_model_path = os.path.join(os.getcwd(), config['output_model_path']) 
-
 ####################function for deployment
 def store_model_into_pickle():
     """
-    This function copy the pickle file, the latestscore.txt value, 
-    and the ingestfiles.txt file into the deployment directory
+    This function publishes the pickle file, its trainedmodel.json artifact,
+    the latestscore.txt value, referenceprofile.json and the ingestfiles.txt
+    file as a new release of the deployment directory, and makes it current.
+    Readers see the whole previous release or the whole new one.
     Input: None
-    Output: 
-    copy the pickle file, the latestscore.txt value, 
-    and the ingestfiles.txt file into the deployment directory
+    Output: id of the release, stored in prod_deployment_path/releases
     """
     logger.info(f"Starting store_model_into_pickle")
+    dataset_csv_path = configuration.config_path('output_folder_path')
+    prod_deployment_path = configuration.config_path('prod_deployment_path')
+    output_model_path = configuration.config_path('output_model_path')
     
-    logger.info(f"copy the ingestfiles.txt file into {prod_deployment_path}")
-    shutil.copy(os.path.join(dataset_csv_path,'ingestedfiles.txt'),
-                prod_deployment_path)
-                
-    logger.info(f"copy the pickle file into {prod_deployment_path}")
-    shutil.copy(os.path.join(output_model_path,'trainedmodel.pkl'),
-                prod_deployment_path)
+    files = [os.path.join(dataset_csv_path, 'ingestedfiles.txt'),
+             os.path.join(output_model_path, 'trainedmodel.pkl'),
+             os.path.join(output_model_path, 'latestscore.txt')]
+    # NumPy artifact of the same model, read instead of the pickle by the
+    # API and the drift check, and the reference of the feature drift screening
+    for filename in ('trainedmodel.json', 'referenceprofile.json'):
+        if os.path.exists(os.path.join(output_model_path, filename)):
+            files.append(os.path.join(output_model_path, filename))
     
-    logger.info(f"copy the latestscore.txt file into {prod_deployment_path}")
-    shutil.copy(os.path.join(output_model_path,'latestscore.txt'),
-                prod_deployment_path)
+    with open(os.path.join(output_model_path, 'latestscore.txt')) as f:
+        latest_score = float(f.readline().split("=")[1].strip())
+    
+    # a release pinned by a rollback stays current, the new release is only stored
+    logger.info(f"publish {[os.path.basename(path) for path in files]} as a release of {prod_deployment_path}")
+    release_id = registry.publish_release(files, prod_deployment_path,
+                                          metadata={"latest_score": latest_score})
+    return release_id
     
 if __name__ == "__main__":
-    logger.info("Invoking deployment.py")
-    store_model_into_pickle()    
-
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--rollback', nargs='?', const='previous', metavar='RELEASE',
+                        help='make an earlier release current, the previous one by default')
+    parser.add_argument('--unpin', action='store_true',
+                        help='let the next deployment replace the release pinned by a rollback')
+    parser.add_argument('--list', action='store_true', help='list the releases')
+    args = parser.parse_args()
+    
+    prod_deployment_path = configuration.config_path('prod_deployment_path')
+    if args.list:
+        current = registry.current_release(prod_deployment_path)
+        for release in registry.list_releases(prod_deployment_path):
+            print(('* ' if release["id"] == current else '  ') + json.dumps(release))
+    elif args.rollback:
+        release_id = None if args.rollback == 'previous' else args.rollback
+        try:
+            registry.rollback(prod_deployment_path, release_id)
+        except ValueError as error:
+            print(f"Cannot roll back: {error}", file=sys.stderr)
+            sys.exit(1)
+    elif args.unpin:
+        registry.unpin_release(prod_deployment_path)
+    else:
+        logger.info("Invoking deployment.py")
+        store_model_into_pickle()
@@ -13,20 +13,69 @@ import os
 import json
 import logging
 import pickle
+import subprocess
+import sys
+import tempfile
+
+import configuration
+import dataset
+import dependencies
+import linearmodel
+import metrics
+import profiling
+from modelcache import ReleaseModelCache
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger()
-##################Load config.json and get environment variables
-with open('config.json','r') as f:
-    config = json.load(f) 
 
-dataset_csv_path = os.path.join(os.getcwd(), config['output_folder_path']) 
-test_data_path = os.path.join(os.getcwd(), config['test_data_path']) 
-prod_deployment_path = os.path.join(os.getcwd(), config['prod_deployment_path'])
+PREDICT_SECONDS = metrics.histogram(
+    'predict_seconds', 'Seconds spent predicting with the deployed model', ('function',))
+ROWS_SCORED = metrics.counter(
+    'rows_scored', 'Rows predicted with the deployed model', ('function',))
+
+##################Deployed model, test data and package index, set up on first use
+# deployed model, loaded once per process and reloaded when another release is current
+production_model = None
+# optional local package index or mirror snapshot for the latest dependency versions
+package_index_source = None
+
+def get_production_model():
+    """
+    Get the holder of the deployed model, created on first use
+    Input: None
+    Output: ReleaseModelCache of the current release of prod_deployment_path,
+    loading trainedmodel.json, scored with NumPy only, or trainedmodel.pkl
+    when the release has no artifact
+    """
+    global production_model
+    if production_model is None:
+        production_model = ReleaseModelCache(
+            configuration.config_path('prod_deployment_path'),
+            loaders=[(linearmodel.LINEAR_MODEL_FILE, linearmodel.load_linear_model),
+                     ("trainedmodel.pkl", pickle.load)])
+    return production_model
+
+def load_test_data():
+    """
+    Read testdata.csv of test_data_path
+    Input: None
+    Output: test dataframe
+    """
+    test_data_path = configuration.config_path('test_data_path')
+    logger.info(f"Retrieving testdata.csv from {test_data_path}")
+    return dataset.read_csv(os.path.join(test_data_path, "testdata.csv"))
 
-logger.info(f"Retrieving testdata.csv from {test_data_path}")
-test_df = pd.read_csv(os.path.join(test_data_path, "testdata.csv"))
+def get_package_index_source():
+    """
+    Get the cached source of latest dependency versions, created on first use
+    Input: None
+    Output: the source configured in config.json, None if there is none
+    """
+    global package_index_source
+    if package_index_source is None:
+        package_index_source = dependencies.source_from_config(configuration.load_config())
+    return package_index_source
 
 ##################Function to get model predictions
 def model_predictions(test_df):
@@ -38,17 +87,31 @@ def model_predictions(test_df):
     """
     logger.info(f"Starting model_predictions")
     
-    logger.info(f"Loading trainedmodel.pkl from {prod_deployment_path}")
-    model_path = os.path.join(prod_deployment_path, "trainedmodel.pkl")
-    model = pickle.load(open(model_path, "rb"))
+    model = get_production_model().get()
     
-    #features = ["lastmonth_activity", "lastyear_activity", "number_of_employees"]
-    # Pick all rows starting from 1st column and 
-    # exclude the last column (which is the target variable)
-    x_test_df = test_df.iloc[:, 1:-1]
-    predicted = model.predict(x_test_df)
+    # Pick the feature columns by name from the dataset schema
+    x_test_df = test_df[dataset.FEATURE_COLUMNS]
+    with PREDICT_SECONDS.time(function='model_predictions'):
+        predicted = model.predict(x_test_df)
+    ROWS_SCORED.inc(len(x_test_df), function='model_predictions')
     return predicted.tolist()
 
+def model_predictions_batch(features):
+    """
+    This function read the deployed model and a feature matrix,
+    to calculate predictions and probabilities in one vectorised pass
+    Input: numpy array of the FEATURE_COLUMNS values, one row per record
+    Output: A list of predictions, a list of probabilities of the positive class
+    """
+    model = get_production_model().get()
+    if len(features) == 0:
+        return [], []
+    with PREDICT_SECONDS.time(function='model_predictions_batch'):
+        probabilities = model.predict_proba(features)[:, 1]
+        predicted = model.classes_[(probabilities > 0.5).astype(int)]
+    ROWS_SCORED.inc(len(features), function='model_predictions_batch')
+    return predicted.tolist(), probabilities.tolist()
+
 ##################Function to get summary statistics
 def dataframe_summary():
     """
@@ -58,15 +121,10 @@ def dataframe_summary():
     """
     logger.info(f"Starting dataframe_summary")
     
-    logger.info(f"Retrieving finaldata.csv from {dataset_csv_path}")
-    df = pd.read_csv(os.path.join(dataset_csv_path, "finaldata.csv"))
-    
-    # Pick all rows starting from 1st column and exclude the last column 
-    # (which is the target variable)
-    X = df.iloc[:, 1:-1]
-    stats = X.agg(["mean", "median", "std"]).to_dict(
-        orient="index"
-    )
+    logger.info(f"Retrieving the profile of the master dataset from {dataset.output_folder()}")
+    columns = profiling.dataset_profile()["columns"]
+    stats = {stat: {name: columns[name][stat] for name in dataset.FEATURE_COLUMNS}
+             for stat in ["mean", "median", "std"]}
     return stats
 ##################Function to get missing data
 def missing_data():
@@ -79,13 +137,14 @@ def missing_data():
 
     logger.info(f"Starting missing_data")
     
-    logger.info(f"Retrieving finaldata.csv from {dataset_csv_path}")
-    df = pd.read_csv(os.path.join(dataset_csv_path, "finaldata.csv"))
+    logger.info(f"Retrieving the profile of the master dataset from {dataset.output_folder()}")
+    profile = profiling.dataset_profile()
     
     # compute missing data per column
-    missing_data = df.isna().sum(axis=0)
-    precent_missing_data = (missing_data / len(df) ) *100
-    return precent_missing_data.tolist()
+    rows = profile["rows"]
+    precent_missing_data = [column["nulls"] / rows * 100 if rows else 0.0
+                            for column in profile["columns"].values()]
+    return precent_missing_data
 
 ##################Function to get timings
 def measure_ingestion_time():
@@ -116,16 +175,34 @@ def measure_training_time():
     training_time = timeit.default_timer() - starttime
     return training_time 
          
-def execution_time():
+def execution_time(in_process=False, rows=10000):
     """
     This function is used to calculate average timing of 
     ingestion.py and training.py 
-    Input: None
+    Input:
+    in_process: time merge_multiple_dataframe() and train_model() in-process
+    with the benchmark harness on synthetic data, instead of running the
+    scripts in subprocesses which mostly measures interpreter startup.
+    The harness itself runs in one subprocess, so the synthetic work does
+    not count in the metrics of the calling process, e.g. the API
+    rows: number of synthetic rows of the in-process benchmark
     Output: A list containing summary statistics
     of average ingestion time and average training time
     """
     logger.info(f"Starting execution_time")
     time_index = 10
+
+    if in_process:
+        with tempfile.TemporaryDirectory() as workdir:
+            output_path = os.path.join(workdir, 'benchmark.json')
+            subprocess.run([sys.executable, 'benchmark.py', '--rows', str(rows),
+                            '--warmup', '1', '--repetitions', str(time_index),
+                            '--stages', 'ingestion', 'training', '--output', output_path],
+                           check=True, stdout=subprocess.DEVNULL)
+            with open(output_path, 'r') as f:
+                results = json.load(f)["results"][0]
+        return [results["stages"]["ingestion"]["mean_seconds"],
+                results["stages"]["training"]["mean_seconds"]]
     
     logging.info(
         f"Calculating excute time for ingestion in a range of time: {time_index}")
@@ -150,37 +227,50 @@ def outdated_packages_list():
     all the modules that your scripts use 
     Input: None
     Output: 
-    A dataframe of "Package", "Installed Current Version", "Latest Version"
+    A dataframe of "Package", "Requirement Version",
+    "Installed Version", "Latest Version"
     """
     logger.info(f"Starting outdated_packages_list")
-   
-    # current version of dependencies
-    with open('requirements.txt', 'r') as f:
-        requirements = f.read().split('\n')
-    requirements = [r.split('==') for r in requirements if r]
-    requirements_df = pd.DataFrame(requirements, columns=["Package", "Requirement Version"])
-    requirements_df["Package"] = requirements_df["Package"].str.lower()
-    
-    # Get outdated dependencies using PIP
-    logger.info('Check outdated dependencies versions using PIP commands')
-    os.system("pip list --outdated > out_dated_pip_list.txt")  
-    outdated_df = pd.read_csv("out_dated_pip_list.txt", sep=r"\s+", skiprows=[1])
-    outdated_df = outdated_df.drop(columns=['Type'])
-    outdated_df["Package"] = outdated_df["Package"].str.lower()
-    outdated_df.columns = ["Package", "Installed Version","Latest Version"]
-    
-    # Merge requirements_df and outdated_df
-    packages_df = requirements_df.merge(outdated_df, how="left", on="Package")
+
+    # required versions from requirements.txt, installed versions from the
+    # package metadata and latest versions from the cached package index
+    logger.info('Check dependencies versions with importlib.metadata')
+    packages_df = pd.DataFrame(
+        dependencies.dependency_versions('requirements.txt', get_package_index_source()),
+        columns=["Package", "Requirement Version", "Installed Version", "Latest Version"])
     
-    # If we're already using the latest version of a module, we fill latest with the requirements version:
-    packages_df['Latest Version'].fillna(packages_df['Requirement Version'], inplace=True)
+    # If the latest version is unknown, we fill latest with the installed or requirements version:
+    packages_df['Latest Version'] = (packages_df['Latest Version']
+                                     .fillna(packages_df['Installed Version'])
+                                     .fillna(packages_df['Requirement Version']))
     
     packages_df.to_csv("package_version.csv", index=False)
     return packages_df
 
+##################Function to run all diagnostics
+def run_diagnostics():
+    """
+    This function is used to run the data, timing and dependency diagnostics
+    Input: None
+    Output: A dictionary of "missing_data_percentage", "execution_durations"
+    and "outdated_dependencies"
+    """
+    logger.info(f"Starting run_diagnostics")
+    # Check precent missing data
+    precent_missing_data = missing_data()
+    # Check execution timings
+    durations = execution_time(in_process=True)
+    # Check outdated_packages_list
+    dependancies_check = outdated_packages_list().to_dict()
+    return {
+        "missing_data_percentage": precent_missing_data,
+        "execution_durations": durations,
+        "outdated_dependencies": dependancies_check,
+    }
+
 if __name__ == "__main__":
     logger.info("Invoking diagnostics.py")
-    predictions = model_predictions(test_df)
+    predictions = model_predictions(load_test_data())
     logger.info(f'predictions =  {predictions}')
     stats = dataframe_summary()
     logger.info(f'stats =  {stats}')
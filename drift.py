@@ -0,0 +1,292 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to check model drift incrementally:
+only the rows ingested since the last check are predicted with the
+deployed model, and the F1 score is updated from accumulated
+confusion-matrix counts, for the whole dataset or a sliding window
+of recent ingests. New source files are also screened without labels
+for feature drift (PSI, KS, Jensen-Shannon) against reference
+histograms and quantiles stored at training time.
+"""
+
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import dataset
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger()
+
+DRIFT_STATE_FILE = 'driftstate.json'
+PREDICTIONS_FILE = 'driftpredictions.npy'
+# ingest batches kept for sliding-window scores
+MAX_BATCHES_KEPT = 100
+# rows predicted at once, bounding memory on large ingests
+PREDICTION_CHUNK_ROWS = 1 << 20
+
+REFERENCE_FILE = 'referenceprofile.json'
+# quantile-bin count of the reference histograms and resolution
+# of the reference quantile table used for the KS statistic
+REFERENCE_BINS = 10
+REFERENCE_QUANTILES = 101
+# floor of the bin proportions so PSI and JS stay finite on empty bins
+MIN_PROPORTION = 1e-4
+# a feature has drifted when any statistic passes its threshold;
+# PSI above 0.2 is the usual "significant shift" rule of thumb
+DRIFT_THRESHOLDS = {"psi": 0.2, "ks": 0.1, "js": 0.1}
+
+#############Functions for the drift state
+def _empty_state(model_sha256, generation):
+    return {"model_sha256": model_sha256, "generation": generation, "rows": 0,
+            "counts": {"tp": 0, "fp": 0, "fn": 0, "tn": 0}, "batches": []}
+
+def load_drift_state(folder_path=None):
+    """
+    Load the drift state saved next to the master dataset
+    Input: folder holding the dataset, defaults to output_folder_path
+    Output: A dictionary of the model hash, dataset generation, scored rows,
+    confusion counts and ingest batches, None if no check ran yet
+    """
+    state_path = os.path.join(dataset.output_folder(folder_path), DRIFT_STATE_FILE)
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, 'r') as f:
+        return json.load(f)
+
+def _save_drift_state(state, folder_path=None):
+    state_path = os.path.join(dataset.output_folder(folder_path), DRIFT_STATE_FILE)
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+def load_predictions(folder_path=None):
+    """
+    Load the predictions of the deployed model for the scored rows
+    Input: folder holding the dataset
+    Output: memory-mapped numpy array, one prediction per scored row
+    """
+    folder_path = dataset.output_folder(folder_path)
+    state = load_drift_state(folder_path)
+    if state is None or state["rows"] == 0:
+        return np.empty(0, dtype=np.int8)
+    return np.load(os.path.join(folder_path, PREDICTIONS_FILE), mmap_mode='r')[:state["rows"]]
+
+def _save_predictions(predicted, state, folder_path):
+    predictions_path = os.path.join(folder_path, PREDICTIONS_FILE)
+    if state["rows"] == 0 or not os.path.exists(predictions_path):
+        np.save(predictions_path, predicted)
+        return
+    saved = np.load(predictions_path, mmap_mode='r')
+    if len(saved) != state["rows"]:
+        # a previous check stopped between the predictions and the state
+        kept = np.array(saved[:state["rows"]])
+        del saved
+        np.save(predictions_path, kept)
+    else:
+        del saved
+    dataset.append_npy(predictions_path, predicted)
+
+def confusion_counts(y_true, y_pred):
+    """
+    Count the confusion matrix of binary predictions
+    Input: numpy arrays of the targets and of the predictions
+    Output: A dictionary of "tp", "fp", "fn" and "tn"
+    """
+    y_true = np.asarray(y_true) == 1
+    y_pred = np.asarray(y_pred) == 1
+    return {"tp": int((y_true & y_pred).sum()), "fp": int((~y_true & y_pred).sum()),
+            "fn": int((y_true & ~y_pred).sum()), "tn": int((~y_true & ~y_pred).sum())}
+
+def f1_from_counts(counts):
+    """
+    F1 score from confusion counts, 0 when there is no positive at all
+    as sklearn's f1_score does
+    Input: A dictionary of "tp", "fp" and "fn"
+    Output: F1 score
+    """
+    denominator = 2 * counts["tp"] + counts["fp"] + counts["fn"]
+    return 2 * counts["tp"] / denominator if denominator else 0.0
+
+#############Function to update the drift state
+def update_drift_state(model_cache=None, folder_path=None):
+    """
+    Predict the rows ingested since the last check with the deployed model
+    and add them to the confusion counts, as one ingest batch.
+    The state starts over when the deployed model or the dataset generation
+    (a rebuild of the dataset) changed.
+    Input: ModelCache of the deployed model, defaults to the one of
+    diagnostics.py, folder holding the dataset
+    Output: updated drift state
+    """
+    if model_cache is None:
+        from diagnostics import get_production_model
+        model_cache = get_production_model()
+    folder_path = dataset.output_folder(folder_path)
+    model = model_cache.get()
+    schema = dataset.read_schema(folder_path)
+
+    state = load_drift_state(folder_path)
+    if (state is None or state["model_sha256"] != model_cache.sha256
+            or state["generation"] != schema["generation"] or state["rows"] > schema["rows"]):
+        logger.info("Deployed model or dataset changed, drift counts start over")
+        state = _empty_state(model_cache.sha256, schema["generation"])
+
+    start, stop = state["rows"], schema["rows"]
+    if start == stop:
+        logger.info("No new rows since the last drift check")
+        return state
+
+    logger.info(f"Predicting {stop - start} new rows for the drift check")
+    columns = {name: dataset.load_column(name, folder_path)
+               for name in dataset.FEATURE_COLUMNS + [dataset.TARGET_COLUMN]}
+    counts = {"tp": 0, "fp": 0, "fn": 0, "tn": 0}
+    predictions = []
+    for chunk_start in range(start, stop, PREDICTION_CHUNK_ROWS):
+        chunk_stop = min(chunk_start + PREDICTION_CHUNK_ROWS, stop)
+        x_df = pd.DataFrame({name: columns[name][chunk_start:chunk_stop]
+                             for name in dataset.FEATURE_COLUMNS})
+        predicted = model.predict(x_df).astype(np.int8)
+        chunk_counts = confusion_counts(columns[dataset.TARGET_COLUMN][chunk_start:chunk_stop],
+                                        predicted)
+        counts = {key: counts[key] + chunk_counts[key] for key in counts}
+        predictions.append(predicted)
+
+    _save_predictions(np.concatenate(predictions), state, folder_path)
+    state["rows"] = stop
+    state["counts"] = {key: state["counts"][key] + counts[key] for key in counts}
+    state["batches"] = (state["batches"] +
+                        [dict(counts, start=start, stop=stop, scored_at=time.time())]
+                        )[-MAX_BATCHES_KEPT:]
+    _save_drift_state(state, folder_path)
+    return state
+
+def drift_score(window=None, model_cache=None, folder_path=None):
+    """
+    Get the F1 score of the deployed model on the master dataset,
+    predicting only the rows ingested since the last check
+    Input: number of most recent ingest batches to score (None for all rows),
+    ModelCache of the deployed model, folder holding the dataset
+    Output: F1 score
+    """
+    state = update_drift_state(model_cache, folder_path)
+    if window is None:
+        return f1_from_counts(state["counts"])
+    batches = state["batches"][-window:]
+    return f1_from_counts({key: sum(batch[key] for batch in batches)
+                           for key in ("tp", "fp", "fn")})
+
+#############Functions for feature drift
+def reference_profile(x_df):
+    """
+    Build the reference distributions of the features of a training set:
+    a quantile table, and proportions of rows per quantile bin
+    Input: dataframe of the FEATURE_COLUMNS, or dictionary of feature name
+    to numpy array, e.g. the memory-mapped columns of the master dataset
+    Output: A dictionary of "rows" and of the reference per feature
+    """
+    probabilities = np.linspace(0, 1, REFERENCE_QUANTILES)
+    features = {}
+    rows = 0
+    for name in dataset.FEATURE_COLUMNS:
+        values = x_df[name]
+        rows = len(values)
+        if isinstance(values, pd.Series):
+            values = values.to_numpy(dtype=np.float64, na_value=np.nan)
+        # one column is converted and sorted at a time
+        values = np.asarray(values, dtype=np.float64)
+        values = np.sort(values[~np.isnan(values)])
+        if len(values) == 0:
+            continue
+        quantiles = np.quantile(values, probabilities)
+        # inner edges at the quantile bins, duplicates merged for discrete values
+        edges = np.unique(np.quantile(values, np.linspace(0, 1, REFERENCE_BINS + 1)[1:-1]))
+        counts = np.diff(np.searchsorted(values, edges, side='right'),
+                         prepend=0, append=len(values))
+        features[name] = {"quantiles": quantiles.tolist(),
+                          "bin_edges": edges.tolist(),
+                          "bin_proportions": (counts / len(values)).tolist()}
+    return {"rows": rows, "probabilities": probabilities.tolist(), "features": features}
+
+def save_reference_profile(x_df, model_folder):
+    """
+    Store the reference distributions of a training set next to its model
+    Input: dataframe or dictionary of the FEATURE_COLUMNS, folder of the model
+    Output: referenceprofile.json written into model_folder
+    """
+    reference_path = os.path.join(model_folder, REFERENCE_FILE)
+    tmp_path = reference_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(reference_profile(x_df), f, indent=2)
+    os.replace(tmp_path, reference_path)
+
+def load_reference_profile(model_folder):
+    """
+    Load the reference distributions stored next to a model
+    Input: folder of the model
+    Output: reference profile, None if the model has none
+    """
+    reference_path = os.path.join(model_folder, REFERENCE_FILE)
+    if not os.path.exists(reference_path):
+        return None
+    with open(reference_path, 'r') as f:
+        return json.load(f)
+
+def distribution_drift(values, reference, probabilities):
+    """
+    Compare a sample of a feature against its reference distribution
+    with bin and quantile lookups: PSI and Jensen-Shannon divergence over
+    the reference quantile bins, KS over the reference quantile table
+    Input: numpy array of the feature, reference of the feature,
+    probabilities of the reference quantile table
+    Output: A dictionary of "psi", "ks" and "js"
+    """
+    values = np.sort(values[~np.isnan(values)])
+    if len(values) == 0:
+        return {"psi": None, "ks": None, "js": None}
+    counts = np.diff(np.searchsorted(values, reference["bin_edges"], side='right'),
+                     prepend=0, append=len(values))
+    expected = np.maximum(np.asarray(reference["bin_proportions"]), MIN_PROPORTION)
+    actual = np.maximum(counts / len(values), MIN_PROPORTION)
+    psi = np.sum((actual - expected) * np.log(actual / expected))
+
+    middle = (actual + expected) / 2
+    js = (np.sum(actual * np.log2(actual / middle)) +
+          np.sum(expected * np.log2(expected / middle))) / 2
+
+    # share of the sample at or below each reference quantile,
+    # against the probability of that quantile
+    sample_cdf = np.searchsorted(values, reference["quantiles"], side='right') / len(values)
+    ks = np.max(np.abs(sample_cdf - np.asarray(probabilities)))
+    return {"psi": float(psi), "ks": float(ks), "js": float(js)}
+
+def feature_drift(files, reference, thresholds=None):
+    """
+    Screen new source files for feature drift against the reference
+    of the deployed model, without labels or predictions
+    Input: list of csv files, reference profile, thresholds per statistic
+    Output: A dictionary of the statistics per file and feature, and
+    "drifted", True if any statistic of any file passed its threshold
+    """
+    thresholds = thresholds or DRIFT_THRESHOLDS
+    report = {"files": {}, "drifted": False}
+    for filepath in files:
+        df = dataset.read_csv(filepath, usecols=dataset.FEATURE_COLUMNS)
+        report["files"][filepath] = {}
+        for name, feature_reference in reference["features"].items():
+            stats = distribution_drift(df[name].to_numpy(dtype=np.float64, na_value=np.nan),
+                                       feature_reference, reference["probabilities"])
+            stats["drifted"] = any(stats[key] is not None and stats[key] > threshold
+                                   for key, threshold in thresholds.items())
+            report["files"][filepath][name] = stats
+            if stats["drifted"]:
+                logger.info(f"Feature drift of {name} in {filepath}: {stats}")
+                report["drifted"] = True
+    return report
@@ -0,0 +1,65 @@
+"""
+Author: Thanh Ta 
+Date: March, 2024
+Description: This script is used to fingerprint files by their
+size, modification time and content hash
+"""
+
+import hashlib
+import os
+
+# Read files in 1 MiB blocks so hashing large csv files stays bounded in memory
+HASH_BLOCK_SIZE = 1 << 20
+
+def file_sha256(filepath):
+    """
+    This function is used to calculate the sha256 content hash of a file
+    Input: path of the file
+    Output: hex digest of the sha256 content hash
+    """
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def file_signature(filepath):
+    """
+    This function is used to get the cheap identity of a file
+    from its metadata, without reading its content
+    Input: path of the file
+    Output: A dictionary of "size" and "mtime_ns" of the file
+    """
+    stat = os.stat(filepath)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def path_fingerprint(path, known=None):
+    """
+    This function is used to fingerprint the content of a file or of
+    every file under a folder. Files whose size and mtime match the
+    known ones are not hashed again.
+    Input: path of a file or folder,
+    dictionary of file path -> [size, mtime_ns, sha256], updated in place
+    Output: hex digest of the content, "missing" if the path does not exist
+    """
+    known = {} if known is None else known
+    if os.path.isfile(path):
+        filepaths = [path]
+    elif os.path.isdir(path):
+        filepaths = sorted(os.path.join(root, filename)
+                           for root, _, filenames in os.walk(path)
+                           for filename in filenames)
+    else:
+        return "missing"
+
+    digest = hashlib.sha256()
+    for filepath in filepaths:
+        # files under a symlinked folder are known by their real path
+        realpath = os.path.realpath(filepath)
+        signature = file_signature(filepath)
+        recorded = known.get(realpath)
+        if recorded is None or recorded[:2] != [signature["size"], signature["mtime_ns"]]:
+            recorded = [signature["size"], signature["mtime_ns"], file_sha256(filepath)]
+            known[realpath] = recorded
+        digest.update(f"{os.path.relpath(filepath, path)}\n{recorded[2]}\n".encode())
+    return digest.hexdigest()
@@ -6,30 +6,38 @@ This script is used to automate ML model scoring, monitoring,
 and re-deployment process.
 """
 import os
-import json
-import ingestion
-import training
-import scoring
-import deployment
-import diagnostics
-import reporting
+import sys
 import subprocess
 import logging
-import pandas as pd
-from sklearn import metrics
+from contextlib import contextmanager
+
+import configuration
+import registry
+import sourcemanifest
+from pipeline import STAGE_ROWS, PipelineRunner, Stage
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger()
 
-###############Load config.json and get path variables
-with open('config.json','r') as f:
-    config = json.load(f) 
+#lock file held while the pipeline runs, in the working directory
+PIPELINE_LOCK_FILE = 'fullprocess.lock'
 
-prod_deployment_path = os.path.join(os.getcwd(), config['prod_deployment_path'])
-input_folder_path = os.path.join(os.getcwd(), config['input_folder_path']) 
-output_folder_path = os.path.join(os.getcwd(), config['output_folder_path']) 
-output_model_path = os.path.join(os.getcwd(), config['output_model_path'])
+#outcome of a run stopped by each gate stage
+GATE_OUTCOMES = {
+    "ingestion": "no_new_data",
+    "feature_drift": "no_feature_drift",
+    "model_drift": "no_model_drift",
+}
+
+#the pipeline steps import pandas, sklearn and matplotlib when they run,
+#so a run without new data only reads the manifest and the source folder
 
 ##################Check and read new data
 def check_new_data():
@@ -41,22 +49,13 @@ def check_new_data():
     Return False if there are NO new ingested data files
     """
     logger.info(f"Check if any new ingested file")
-    
-    #first, read ingestedfiles.txt
-    ingested_filepath = os.path.join(prod_deployment_path,'ingestedfiles.txt')
-    # Skip the fisrt line because it is recorded the timestamp 
-    # where the files are previously ingested
-    with open(ingested_filepath) as f:
-        ingested_files = {line.strip('\n') for line in f.readlines()[1:]}
-    logger.info(
-        f"ingested files from ingestedfiles.txt: {ingested_files}\
-          from ingested_filepath: {ingested_filepath}")
-
-    #second, determine whether the source data folder has files that 
-    #aren't listed in ingestedfiles.txt
-    input_source_files = set(os.listdir(input_folder_path))
-    logger.info(f"input_source_files: {input_source_files}")
-    if len(input_source_files.difference(ingested_files)) == 0:
+
+    #compare the source data folder against the manifest of ingested files,
+    #by full path, size, mtime and content hash
+    new_files, changed_files, _ = sourcemanifest.find_new_files(
+        configuration.config_path('input_folder_path'))
+    logger.info(f"new files: {new_files}, changed files: {changed_files}")
+    if not new_files and not changed_files:
         logging.info("No new data found!")
         return False
     else:
@@ -73,18 +72,24 @@ def check_model_drift():
     """
     #check whether the score from the deployed model is different from the score 
     #from the model that uses the newest ingested data
+    import dataset
+    import diagnostics
+    import drift
+    
     logger.info(f"Checking for model drift")
+    prod_deployment_path = registry.deployed_folder(configuration.config_path('prod_deployment_path'))
     latest_score_filepath = os.path.join(prod_deployment_path,'latestscore.txt')
     with open(latest_score_filepath) as f:
         latest_score = float(f.readline().split("=")[1].strip())
     logger.info(f"latest_score:  {latest_score}")
 
-    output_folder_filepath = os.path.join(output_folder_path, 'finaldata.csv')
-    new_data_df = pd.read_csv(output_folder_filepath)
-    y_pred = diagnostics.model_predictions(new_data_df)
-    y_df = new_data_df["exited"]
-    new_score = metrics.f1_score(y_pred, y_df)
+    #number of recent ingests the drift check scores, all rows when unset
+    drift_window = configuration.config_value('drift_window_ingests')
+    #predict only the rows ingested since the last check, the F1 score
+    #comes from the confusion counts accumulated over the checks
+    new_score = drift.drift_score(drift_window, diagnostics.get_production_model())
     logger.info(f"new_score:  {new_score}")
+    STAGE_ROWS.set(dataset.read_schema()['rows'], stage="model_drift")
 
     if(new_score >= latest_score):
         logger.info("No model drift occurred !")
@@ -92,48 +97,256 @@ def check_model_drift():
     else:
         logger.info("Model drift occurred !")
         return True
-##################Check for new data
-# check for new data, 
-# if no new data, the process end here
-# if new data exists, combine all of the data files
-# into one dataset
-if (check_new_data() == False):
-    exit()
+
+def check_feature_drift(files):
+    """
+    check if the features of newly ingested files have drifted from
+    the training data of the deployed model (PSI, KS, Jensen-Shannon)
+    Input: list of ingested csv files
+    Output:
+    Return True if any feature has drifted, or if the deployed model
+    has no reference distributions to compare with
+    Return False if no feature has drifted
+    """
+    import drift
     
-logger.info(f"Ingest new data files into one dataset")
-ingestion.merge_multiple_dataframe()
+    logger.info(f"Screening ingested files for feature drift")
+    reference = drift.load_reference_profile(
+        registry.deployed_folder(configuration.config_path('prod_deployment_path')))
+    if reference is None:
+        logger.info("No reference distributions deployed, skipping the screening")
+        return True
+    
+    report = drift.feature_drift(files, reference)
+    STAGE_ROWS.set(ingested_rows(files), stage="feature_drift")
+    if report["drifted"]:
+        logger.info("Feature drift occurred !")
+    else:
+        logger.info("No feature drift, skipping the model drift check !")
+    return report["drifted"]
 
-##################Checking for model drift
-# if no model drift, the process end here
-# if the model has drifted,
-# Deploy the best model
-# Get Diagnostics and reports
+##################Stages of the pipeline
+def ingested_rows(files):
+    """
+    Input: list of ingested source files
+    Output: number of rows appended from them, from the manifest
+    """
+    manifest = sourcemanifest.load_manifest(configuration.config_path('output_folder_path'))
+    return sum(manifest.get(file, {}).get('rows', 0) for file in files)
 
-if (check_model_drift() == False):
-    exit()
+def ingest_new_data(results):
+    """
+    Ingest the new source files into the master dataset
+    Input: results of the earlier stages
+    Output: list of the ingested files, empty if there is no new data
+    """
+    if (check_new_data() == False):
+        return []
+    import ingestion
+    
+    logger.info(f"Ingest new data files into one dataset")
+    files = ingestion.merge_multiple_dataframe()
+    STAGE_ROWS.set(ingested_rows(files), stage="ingestion")
+    return files
 
-##################Re-deployment
-#Now, model has drifted, we need:
-# Re-training
-# Calulate new score
-# Deploy the new model
-logger.info("Model drift has occurred !!!")
+def retrain_model(results):
+    """
+    Re-train the model on the master dataset
+    Input: results of the earlier stages
+    Output: None
+    """
+    logger.info("Model drift has occurred !!!")
+    import dataset
+    import training
+    
+    logger.info("Re-training model")
+    training.train_model()
+    STAGE_ROWS.set(dataset.read_schema()['rows'], stage="training")
 
-logger.info("Re-training model")
-training.train_model()
+def rescore_model(results):
+    """
+    Score the re-trained model on the test data
+    Input: results of the earlier stages
+    Output: F1 score
+    """
+    import scoring
+    
+    logger.info("Re-scoring model")
+    return scoring.score_model()
 
-logger.info("Re-scoring model")
-scoring.score_model()
+def redeploy_model(results):
+    """
+    Copy the re-trained model and its score to the production deployment
+    Input: results of the earlier stages
+    Output: A dictionary of the id of the published release and whether
+    it was activated, False while a rollback pins another release
+    """
+    import deployment
+    
+    logger.info("Re-deploying model")
+    release_id = deployment.store_model_into_pickle()
+    current = registry.current_release(configuration.config_path('prod_deployment_path'))
+    return {"release_id": release_id, "activated": current == release_id}
+
+def report_model(results):
+    """
+    Plot the confusion matrix of the re-deployed model
+    Input: results of the earlier stages
+    Output: None
+    """
+    import reporting
+    
+    logger.info("Invoking score_model to generate and store confusionmatrix2.png")
+    reporting.score_model()
+
+def call_apis(results):
+    """
+    Call the API endpoints of the re-deployed model, as a best-effort
+    stage: the API server is usually not running under cron, which does
+    not fail the run but makes the next run call them again
+    Input: results of the earlier stages
+    Output: exit status of apicalls.py, raise a RuntimeError if it is not 0
+    """
+    logger.info("Invoking apicalls.py")
+    returncode = subprocess.run([sys.executable, "apicalls.py"]).returncode
+    if returncode != 0:
+        raise RuntimeError(f"apicalls.py exited with status {returncode}, is the API server running?")
+    return returncode
+
+def pipeline_stages():
+    """
+    Declare the stages of the pipeline, with their inputs and outputs
+    Input: None
+    Output: list of pipeline.Stage
+    """
+    input_folder_path = configuration.config_path('input_folder_path')
+    output_folder_path = configuration.config_path('output_folder_path')
+    output_model_path = configuration.config_path('output_model_path')
+    prod_deployment_path = configuration.config_path('prod_deployment_path')
+    test_data_path = configuration.config_path('test_data_path')
+    dataset_folder = os.path.join(output_folder_path, 'finaldata')
+    manifest_path = os.path.join(output_folder_path, sourcemanifest.MANIFEST_FILE)
+    ingested_files_path = os.path.join(output_folder_path, 'ingestedfiles.txt')
+    # files of the current release, through the `current` pointer of the registry
+    deployed_release = os.path.join(prod_deployment_path, registry.CURRENT_LINK)
+
+    def model_files(folder_path):
+        return [os.path.join(folder_path, filename) for filename in
+                ('trainedmodel.pkl', 'trainedmodel.json', 'latestscore.txt',
+                 'referenceprofile.json')]
+
+    return [
+        ##################Check for new data
+        # if no new data, the process end here
+        # if new data exists, combine all of the data files into one dataset
+        Stage("ingestion", ingest_new_data, gate=True,
+              inputs=[input_folder_path],
+              outputs=[dataset_folder, manifest_path]),
+        ##################Screening for feature drift
+        # compare the feature distributions of the ingested files against
+        # the reference of the deployed model, without labels;
+        # if no feature has moved, the process end here
+        # the drift checks only re-run on newly ingested data, not when
+        # the re-deployment changes the deployed model, so a run which failed
+        # after the deployment resumes instead of checking drift again
+        Stage("feature_drift", lambda results: check_feature_drift(results["ingestion"]),
+              gate=True, after=["ingestion"], inputs=[manifest_path]),
+        ##################Checking for model drift
+        # if no model drift, the process end here
+        Stage("model_drift", lambda results: check_model_drift(),
+              gate=True, after=["feature_drift"], inputs=[dataset_folder]),
+        ##################Re-deployment
+        #Now, model has drifted, we need:
+        # Re-training
+        # Calulate new score
+        # Deploy the new model
+        Stage("training", retrain_model, after=["model_drift"],
+              inputs=[dataset_folder],
+              outputs=[path for path in model_files(output_model_path)
+                       if not path.endswith('latestscore.txt')]),
+        Stage("scoring", rescore_model, after=["training"],
+              inputs=[os.path.join(output_model_path, 'trainedmodel.pkl'), test_data_path],
+              outputs=[os.path.join(output_model_path, 'latestscore.txt')]),
+        # the published release id is the result of the stage; the `current`
+        # pointer is not an output, so a rollback does not make it run again
+        Stage("deployment", redeploy_model, after=["scoring"],
+              inputs=model_files(output_model_path) + [ingested_files_path]),
+        ##################Diagnostics and reporting
+        #run reporting.py and apicalls.py for the re-deployed model, concurrently
+        Stage("reporting", report_model, after=["deployment"],
+              inputs=[deployed_release, test_data_path],
+              outputs=[os.path.join(output_model_path, 'confusionmatrix2.png')]),
+        Stage("apicalls", call_apis, after=["deployment"], best_effort=True,
+              inputs=[deployed_release, dataset_folder, test_data_path],
+              outputs=[os.path.join(output_model_path, 'apireturns2.txt')]),
+    ]
 
-logger.info("Re-deploying model")
-deployment.store_model_into_pickle()
+##################Function to run the pipeline
+@contextmanager
+def pipeline_lock():
+    """
+    Hold the pipeline lock file without waiting, so a cron run and the
+    daemon never run the pipeline at the same time
+    Input: None
+    Output: context yielding True if the lock was taken,
+    False if another run holds it
+    """
+    if fcntl is None:
+        # no advisory locks on this platform, runs are not serialized
+        yield True
+        return
+    with open(PIPELINE_LOCK_FILE, 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-##################Diagnostics and reporting
-#run diagnostics.py and reporting.py for the re-deployed model
-logger.info("Invoking score_model to generate and store confusionmatrix2.png")
-reporting.score_model()
+def run_pipeline():
+    """
+    Run the pipeline once: ingest new data, check for drift, and retrain,
+    redeploy and report when the model has drifted
+    Input: None
+    Output: name of the step the run ended at
+    """
+    with pipeline_lock() as locked:
+        if not locked:
+            logger.info("The pipeline is already running, skipping this run")
+            return "locked"
+        return _run_pipeline()
 
-logger.info("Invoking apicalls.py")
-os.system("python apicalls.py")
+def _run_pipeline():
+    # stages whose inputs and outputs are unchanged since their last
+    # successful run are skipped, so a failed run resumes where it failed
+    stages = pipeline_stages()
+    run = PipelineRunner(stages).run()
+    if run["failed"] is not None:
+        return "failed"
+    if run["stopped_at"] is not None:
+        return GATE_OUTCOMES[run["stopped_at"]]
+    # a best-effort stage failing again does not make the run a redeployment
+    best_effort = {stage.name for stage in stages if stage.best_effort}
+    if all(record["status"] == "skipped"
+           or (name in best_effort and record["status"] == "failed")
+           for name, record in run["stages"].items()):
+        return "unchanged"
+    if run["stages"]["deployment"]["status"] == "succeeded" and not run["results"]["deployment"]["activated"]:
+        # the new release is stored, the release pinned by a rollback stays current
+        return "published (pinned, not activated)"
+    return "redeployed"
 
+def main():
+    """
+    Entry point of `python fullprocess.py` and of the cron job
+    Input: None
+    Output: None
+    """
+    outcome = run_pipeline()
+    logger.info(f"Pipeline run ended with: {outcome}")
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This file is used to configure gunicorn to serve wsgi.py:
+the application and the deployed model are loaded once in the master
+(preload_app), frozen out of the garbage collector, and shared
+copy-on-write by the forked workers. When the `current` release of the
+model registry moves, the master loads the new model and gracefully
+replaces its workers (SIGHUP), which finish their requests first.
+Usage: gunicorn -c gunicorn.conf.py wsgi:application
+"""
+
+import gc
+import os
+import signal
+import threading
+import time
+from os import environ
+
+bind = environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(environ.get('GUNICORN_WORKERS', os.cpu_count() or 1))
+threads = int(environ.get('GUNICORN_THREADS', 4))
+timeout = int(environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+preload_app = True
+
+# seconds between two checks of the `current` pointer of the registry, 0 to disable
+MODEL_RELOAD_POLL_SECONDS = float(environ.get('MODEL_RELOAD_POLL_SECONDS', 5))
+
+
+def _watch_release(server):
+    # runs in a thread of the master; the reload itself happens in the
+    # master's main loop, so no worker is forked while a model loads
+    import configuration
+    import registry
+    
+    registry_folder = configuration.config_path('prod_deployment_path')
+    release_id = registry.current_release(registry_folder)
+    while True:
+        time.sleep(MODEL_RELOAD_POLL_SECONDS)
+        current = registry.current_release(registry_folder)
+        if current != release_id:
+            server.log.info(f"Release {current} deployed, reloading the workers")
+            release_id = current
+            os.kill(os.getpid(), signal.SIGHUP)
+
+
+def when_ready(server):
+    # the preloaded objects will never be freed, keep the collector from
+    # touching (and so copying) their pages in every worker
+    gc.freeze()
+    if MODEL_RELOAD_POLL_SECONDS > 0:
+        threading.Thread(target=_watch_release, args=(server,),
+                         name="release-watcher", daemon=True).start()
+
+
+def on_reload(server):
+    # load the model of the new release before the new workers are forked
+    from app import preload_resources
+    
+    preload_resources()
+    gc.freeze()
@@ -5,60 +5,401 @@ Description: This script is used to ingest data from input_folder_path
 """
 
 import pandas as pd
+import numpy as np
 import glob
 import os
-import json
 import logging
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from itertools import islice
+
+import configuration
+import dataset
+import profiling
+from fingerprint import file_sha256, file_signature
+from sourcemanifest import find_new_files, load_manifest, save_manifest
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger()
 
-#############Load config.json and get input and output paths
-with open('config.json','r') as f:
-    config = json.load(f) 
+ROW_HASHES_FILE = 'rowhashes.npy'
+# default of the ingestion settings, read from config.json when called:
+# optional "ingestion_chunksize" switches ingestion to streaming mode,
+# "export_csv" (default true) keeps finaldata.csv next to the columnar
+# master dataset, "ingestion_workers" prepares whole source files on a process pool
+FROM_CONFIG = object()
+
+#############Functions for the row dedup index
+def row_hashes(df):
+    """
+    Hash every row of a dataframe independently of its dtypes,
+    so the same record hashes identically whichever file it came from
+    Input: dataframe
+    Output: numpy array of uint64 row hashes
+    """
+    canonical = pd.DataFrame({
+        col: (df[col].astype('float64')
+              if pd.api.types.is_numeric_dtype(df[col])
+              else df[col].astype(str))
+        for col in df.columns})
+    return pd.util.hash_pandas_object(canonical, index=False).to_numpy()
+
+def load_row_hashes(folder_path=None):
+    """
+    Load the sorted hashes of every row in the master dataset
+    Input: folder holding the index, defaults to output_folder_path
+    Output: sorted numpy array of uint64 row hashes
+    """
+    index_path = os.path.join(dataset.output_folder(folder_path), ROW_HASHES_FILE)
+    if not os.path.exists(index_path):
+        return np.empty(0, dtype=np.uint64)
+    return np.load(index_path)
 
-input_folder_path = os.path.join(os.getcwd(), config['input_folder_path'])
-output_folder_path = os.path.join(os.getcwd(), config['output_folder_path'])
+def save_row_hashes(hashes, folder_path=None):
+    """
+    Save the sorted hashes of every row in the master dataset
+    Input: sorted numpy array of uint64 row hashes, folder holding the index
+    Output: index written to rowhashes.npy
+    """
+    index_path = os.path.join(dataset.output_folder(folder_path), ROW_HASHES_FILE)
+    # np.save appends .npy to names that lack it, so keep the suffix on the tmp file
+    tmp_path = index_path[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_path, hashes)
+    os.replace(tmp_path, index_path)
+
+def truncate_csv(filepath, rows):
+    """
+    Keep only the header and the first rows of a csv file
+    Input: path of the csv file, number of rows to keep
+    Output: None
+    """
+    with open(filepath, 'r+b') as f:
+        for _ in range(rows + 1):
+            if not f.readline():
+                return
+        f.truncate()
+
+def drop_unrecorded_rows(manifest, seen_hashes, export_csv=True, folder_path=None):
+    """
+    Drop the rows which an interrupted ingestion appended to the master
+    dataset before recording their source file in the manifest, so the
+    file is ingested again from its first row without duplicating them
+    Input: manifest, sorted array of known row hashes, whether
+    finaldata.csv is exported, folder holding the dataset
+    Output: sorted array of the row hashes of the rows kept
+    """
+    if any('rows' not in entry for entry in manifest.values()):
+        # rows of every file are needed to know where the recorded rows end
+        return seen_hashes
+    rows = sum(entry['rows'] for entry in manifest.values())
+    if dataset.read_schema(folder_path)['rows'] > rows:
+        logger.warning(f"Dropping the rows after row {rows} of the master dataset, "
+                       f"appended by an interrupted ingestion")
+        dataset.truncate_rows(rows, folder_path)
+        if export_csv:
+            truncate_csv(os.path.join(dataset.output_folder(folder_path), 'finaldata.csv'), rows)
+    if len(seen_hashes) != rows:
+        # every row of the master dataset is distinct, so the index
+        # was saved with rows of a file missing from the manifest
+        seen_hashes = np.sort(row_hashes(dataset.load_dataframe(folder_path=folder_path)))
+        save_row_hashes(seen_hashes, folder_path)
+    return seen_hashes
+
+def seen_rows(hashes, seen_hashes):
+    """
+    Find the rows already in a sorted index of row hashes
+    Input: array of row hashes, sorted array of known row hashes
+    Output: boolean array, True for the rows already known
+    """
+    # binary search against the sorted index, O(len(hashes) * log(index))
+    positions = np.searchsorted(seen_hashes, hashes)
+    found = positions < len(seen_hashes)
+    found[found] = seen_hashes[positions[found]] == hashes[found]
+    return found
+
+def add_row_hashes(seen_hashes, hashes):
+    """
+    Input: sorted array of known row hashes, array of new distinct row hashes
+    Output: sorted array of the known and new row hashes
+    """
+    # merging two sorted runs with a stable sort is linear
+    return np.sort(np.concatenate([seen_hashes, np.sort(hashes)]), kind='stable')
+
+def drop_seen_rows(df, seen_hashes):
+    """
+    Drop the rows already in the master dataset or repeated within df
+    Input: dataframe of candidate rows, sorted array of known row hashes
+    Output:
+    dataframe of the surviving rows
+    sorted array of known row hashes including the surviving rows
+    """
+    hashes = row_hashes(df)
+    keep = ~pd.Series(hashes).duplicated().to_numpy()
+    keep &= ~seen_rows(hashes, seen_hashes)
+    return df[keep], add_row_hashes(seen_hashes, hashes[keep])
+
+#############Functions to read and prepare source files
+def parse_source_file(filepath):
+    """
+    Parse and validate a whole source csv file with the declared column dtypes
+    Input: path of the csv file
+    Output: dataframe of the file
+    """
+    df = dataset.read_csv(filepath)
+    dataset.validate_columns(df, filepath)
+    return df
+
+def read_source_chunks(filepath, chunksize=None):
+    """
+    Read a source csv file whole, or in chunks of chunksize rows,
+    with the declared column dtypes
+    Input: path of the csv file, number of rows per chunk
+    Output: generator of dataframes
+    """
+    if chunksize is None:
+        yield parse_source_file(filepath)
+    else:
+        for chunk in dataset.read_csv_chunks(filepath, chunksize):
+            dataset.validate_columns(chunk, filepath)
+            yield chunk
+
+def prepare_rows(df, export_csv=True):
+    """
+    Do the work of ingestion which only depends on the rows themselves:
+    memory accounting, row hashes and the dedup of rows repeated within df,
+    the profile partial and the csv export text of the distinct rows
+    Input: dataframe of parsed rows, whether to format the csv export
+    Output: A dictionary of "columns" (name -> numpy array, or Categorical
+    for string columns), "hashes", "bytes" (parsed, default dtypes),
+    "partial" and "csv" (None without export) of the distinct rows
+    """
+    parsed, default = dataset.memory_usage(df)
+    hashes = row_hashes(df)
+    keep = ~pd.Series(hashes).duplicated().to_numpy()
+    if not keep.all():
+        df, hashes = df[keep], hashes[keep]
+    columns = {}
+    for name in df.columns:
+        if pd.api.types.is_numeric_dtype(df[name]) or isinstance(df[name].dtype, pd.CategoricalDtype):
+            columns[name] = df[name].array
+        else:
+            # codes and distinct values, compact to send between processes
+            columns[name] = pd.Categorical(df[name])
+    return {"columns": columns, "hashes": hashes, "bytes": (parsed, default),
+            "partial": profiling.dataframe_partial(df),
+            "csv": df.to_csv(index=False, header=False) if export_csv else None}
+
+def prepare_source_file(filepath, sha256=None, export_csv=True, output_folder=None):
+    """
+    Parse a whole source file and prepare its rows, saving their profile
+    partial. Runs in the worker processes of parallel ingestion, so only
+    the dedup against the master dataset and the appends stay serial.
+    Input: path of the csv file, its content hash (computed if None),
+    whether to format the csv export, folder of the master dataset
+    Output: prepare_rows() of the file, with its "sha256" and
+    "partial_saved" (True, the partial is saved under partial_key())
+    """
+    record = prepare_rows(parse_source_file(filepath), export_csv)
+    record["sha256"] = sha256 or file_sha256(filepath)
+    profiling.save_partial(profiling.partial_key(filepath, record["sha256"]),
+                           record["partial"], output_folder)
+    record["partial_saved"] = True
+    return record
+
+def prepare_source_files(csv_files, fingerprints, chunksize=None, workers=1,
+                         export_csv=True, output_folder=None):
+    """
+    Read and prepare source csv files in order. Whole files are prepared
+    by prepare_source_file(); with several workers on a process pool, a few
+    files ahead of the one being merged, handed back in the order of csv_files.
+    With chunksize, each file is streamed in chunks prepared in this process.
+    Input: list of csv files, dictionary of file -> fingerprint (with
+    "sha256"), number of rows per chunk, number of worker processes,
+    whether to format the csv export, folder of the master dataset
+    Output: generator of (file, iterable of prepared records) in the order of csv_files
+    """
+    if chunksize is not None:
+        for file in csv_files:
+            yield file, (dict(prepare_rows(df, export_csv), partial_saved=False)
+                         for df in read_source_chunks(file, chunksize))
+        return
+
+    def sha256(file):
+        return (fingerprints.get(file) or {}).get('sha256')
+
+    if workers <= 1 or len(csv_files) <= 1:
+        for file in csv_files:
+            yield file, [prepare_source_file(file, sha256(file), export_csv, output_folder)]
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        files = iter(csv_files)
+
+        def submit(file):
+            pending.append((file, executor.submit(prepare_source_file, file, sha256(file),
+                                                  export_csv, output_folder)))
+
+        # keep a bounded number of prepared files in flight, so memory does not
+        # grow with the backlog when merging is slower than preparing
+        for file in islice(files, 2 * workers):
+            submit(file)
+        while pending:
+            file, future = pending.popleft()
+            record = future.result()
+            for next_file in islice(files, 1):
+                submit(next_file)
+            yield file, [record]
 
 #############Function for data ingestion
-def merge_multiple_dataframe():
+def merge_multiple_dataframe(chunksize=FROM_CONFIG, export_csv=FROM_CONFIG,
+                             workers=FROM_CONFIG,
+                             input_folder=None, output_folder=None):
     """
-    check for datasets, compile them together, and write to an output file
-    Input: None
-    Output: 
-    Master dataset and list of ingested files stored into output_folder_path
+    check for datasets, compile them together, and write to an output file.
+    Only new source files are parsed and their rows appended to the master
+    dataset; the master is rebuilt when an ingested file has changed.
+    With chunksize set, each file is streamed in chunks of that many rows,
+    and the rows which survive the dedup index are written straight to
+    the output, so memory use does not grow with the number of files.
+    With several workers, whole files are parsed, hashed, deduplicated
+    within the file, profiled and formatted for the csv export in parallel,
+    and merged in file order, so the output is identical to the serial path.
+    Workers are capped at the number of cpus and of files, as the pool only
+    costs time beyond them; streaming is serial, workers are ignored when
+    chunksize is set.
+    Input:
+    number of rows per chunk, None to read each file whole
+    whether to also export the master dataset to finaldata.csv
+    number of worker processes preparing whole source files
+    (the three default to the settings of config.json)
+    input and output folders, default to input_folder_path and output_folder_path
+    Output:
+    Columnar master dataset, optional finaldata.csv export
+    and list of ingested files stored into output_folder
+    Return the list of source files parsed in this run
     """
-   
+
     logger.info(f"Starting merge_multiple_dataframe():")
-    
-    # master dataframe placeholder
-    final_df = pd.DataFrame()
-    
-    logger.info(f"Retrieve files from: {input_folder_path}") 
-    # compile datasets together and store ingested file names
-    csv_files = glob.glob(f'{input_folder_path}/*.csv')
+    input_folder = input_folder or configuration.config_path('input_folder_path')
+    output_folder = dataset.output_folder(output_folder)
+    if chunksize is FROM_CONFIG:
+        chunksize = configuration.config_value('ingestion_chunksize')
+    if export_csv is FROM_CONFIG:
+        export_csv = configuration.config_value('export_csv', True)
+    if workers is FROM_CONFIG:
+        workers = configuration.config_value('ingestion_workers', 1)
+
+    logger.info(f"Retrieve files from: {input_folder}")
+    manifest = load_manifest(output_folder)
+    final_data_path = os.path.join(output_folder, 'finaldata.csv')
+    new_files, changed_files, fingerprints = find_new_files(input_folder, manifest)
+
+    rebuild = (bool(changed_files)
+               or not dataset.dataset_exists(output_folder)
+               or (export_csv and not os.path.exists(final_data_path))
+               or not os.path.exists(os.path.join(output_folder, ROW_HASHES_FILE)))
+    if rebuild:
+        # rows of a changed file cannot be retracted from the master dataset,
+        # so compile every source file again
+        logger.info(f"changed files: {changed_files}, rebuilding the master dataset")
+        csv_files = sorted(glob.glob(f'{input_folder}/*.csv'))
+        manifest, seen_hashes = {}, np.empty(0, dtype=np.uint64)
+        columns = None
+    else:
+        csv_files = new_files
+        # rows appended by an interrupted run are ingested again with their file
+        seen_hashes = drop_unrecorded_rows(manifest, load_row_hashes(output_folder),
+                                           export_csv, output_folder)
+        columns = [column['name'] for column in dataset.read_schema(output_folder)['columns']]
     logger.info(f"csv_files: {csv_files}")
-    
-    df = pd.concat(map(pd.read_csv, csv_files))
-    final_df = df.reset_index(drop=True) 
-    final_df.drop_duplicates(inplace=True)
-    #logger.info(f"final_df: {final_df}")
-
-    
-    # write master dataset to an output file
-    logger.info(f"Saving ingested dataframe to finaldata.csv")
-    final_df.to_csv(os.path.join(output_folder_path,'finaldata.csv'), index=False)
-    
+
+    if not csv_files:
+        logger.info("No new files to ingest")
+        save_manifest(manifest, output_folder)
+        return []
+
+    if chunksize is None and workers > 1:
+        # a worker costs a process start, a pandas import and pickling its
+        # results back, which only pays off with more cpus and files than one
+        usable = max(min(workers, len(csv_files), os.cpu_count() or 1), 1)
+        if usable < workers:
+            logger.info(f"Using {usable} of {workers} ingestion workers for "
+                        f"{len(csv_files)} files on {os.cpu_count()} cpus")
+            workers = usable
+
+    # compile datasets together, drop rows already ingested
+    # and write the surviving rows to the master dataset
+    logger.info(f"Writing ingested rows to the master dataset, "
+                f"chunksize: {chunksize}, workers: {workers}")
+    if chunksize is not None and workers > 1:
+        logger.warning(f"ingestion_workers: {workers} is ignored with ingestion_chunksize, "
+                       f"files are streamed one at a time")
+    parsed_bytes, default_bytes = 0, 0
+    for file, records in prepare_source_files(csv_files, fingerprints, chunksize, workers,
+                                              export_csv, output_folder):
+        rows, partial, partial_saved, sha256 = 0, None, False, None
+        for record in records:
+            parsed_bytes += record["bytes"][0]
+            default_bytes += record["bytes"][1]
+            df = pd.DataFrame(record["columns"])
+            csv_text, record_partial = record["csv"], record["partial"]
+            partial_saved = record["partial_saved"]
+            sha256 = record.get("sha256")
+            # the records are already free of repeated rows,
+            # only the dedup against the earlier files is left
+            found = seen_rows(record["hashes"], seen_hashes)
+            seen_hashes = add_row_hashes(seen_hashes, record["hashes"][~found])
+            if found.any():
+                df = df[~found]
+                csv_text, partial_saved = None, False
+                record_partial = profiling.dataframe_partial(df)
+            if columns is None:
+                columns = list(df.columns)
+                dataset.write_dataset(df, output_folder)
+                if export_csv:
+                    df.iloc[:0].to_csv(final_data_path, index=False)
+            else:
+                if list(df.columns) != columns:
+                    df, csv_text = df[columns], None
+                dataset.append_rows(df, output_folder)
+            if export_csv:
+                with open(final_data_path, 'a', newline='') as f:
+                    f.write(df.to_csv(index=False, header=False) if csv_text is None else csv_text)
+            rows += len(df)
+            partial = profiling.merge_partials(partial, record_partial)
+        logger.info(f"Appended {rows} new rows from {file}")
+
+        # record progress after each file, so an interrupted run
+        # resumes from the first file which was not fully written
+        manifest[file] = dict(fingerprints.get(file) or
+                              dict(file_signature(file), sha256=sha256 or file_sha256(file)),
+                              rows=rows)
+        # profile aggregates of the new rows, merged by profiling.dataset_profile();
+        # a whole file prepared by a worker has saved it already
+        if not partial_saved:
+            profiling.save_partial(profiling.partial_key(file, manifest[file]['sha256']),
+                                   partial, output_folder)
+        save_row_hashes(seen_hashes, output_folder)
+        save_manifest(manifest, output_folder)
+
+    logger.info(
+        f"Parsed source files into {parsed_bytes} bytes instead of "
+        f"{default_bytes} bytes with default dtypes "
+        f"({parsed_bytes / max(default_bytes, 1):.0%} of the default size)")
+
      # write ingested filenames to an output file
     logger.info(f"Saving ingested file names to ingestedfiles.txt")
-    with open(os.path.join(output_folder_path, 'ingestedfiles.txt'), "w") as f:
+    with open(os.path.join(output_folder, 'ingestedfiles.txt'), "w") as f:
         f.write(
             f"Ingestion date: {datetime.now().strftime('%d/%m/%Y %H:%M:%S')}\n")
-        for file in csv_files:
+        for file in sorted(manifest):
             f.write(file + "\n")
 
+    return csv_files
+
 
 if __name__ == '__main__':
     logger.info("Execute ingestion.py")
@@ -0,0 +1,219 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to run a slow function as background
+jobs, with job ids, coalesced submissions and a TTL cache of the result.
+Job records and results are files under the working directory, guarded
+by a file lock, so every gunicorn worker answers polls of any job and
+joins the one run in flight.
+"""
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows
+    fcntl = None
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger()
+
+# folder of the job records, one sub folder per job name, in the working directory
+JOBS_FOLDER = 'jobs'
+STATE_FILE = 'state.json'
+LOCK_FILE = 'lock'
+# number of finished jobs kept for polling
+MAX_JOBS_KEPT = 50
+# seconds between two reads of a job record while waiting for it
+WAIT_POLL_SECONDS = 0.2
+
+JOB_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+##################Class to run background jobs
+class BackgroundJobs:
+    """
+    Run a function in a background thread, at most one run in flight
+    across the processes sharing folder_path.
+    A submit() while a job is running returns that job instead
+    of starting another one. The result of the last successful job is
+    served from cache until it is older than ttl_seconds.
+    A job whose process exited before finishing is reported as failed.
+    """
+
+    def __init__(self, name, func, ttl_seconds=600, folder_path=None):
+        self.name = name
+        self.func = func
+        self.ttl_seconds = ttl_seconds
+        self.folder_path = folder_path or os.path.join(JOBS_FOLDER, name)
+
+    @staticmethod
+    def _public(job):
+        return {key: value for key, value in job.items() if not key.startswith('_')}
+
+    ##################Files of the jobs
+    @contextmanager
+    def _locked(self):
+        os.makedirs(self.folder_path, exist_ok=True)
+        if fcntl is None:
+            # no advisory locks on this platform, runs are coalesced per process only
+            yield
+            return
+        with open(os.path.join(self.folder_path, LOCK_FILE), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write_json(self, filename, data):
+        path = os.path.join(self.folder_path, filename)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def _read_json(self, filename):
+        path = os.path.join(self.folder_path, filename)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def _read_state(self):
+        return self._read_json(STATE_FILE) or {"running": None, "last_success": None}
+
+    def _read_job(self, job_id):
+        if not isinstance(job_id, str) or not JOB_ID_PATTERN.fullmatch(job_id):
+            return None
+        job = self._read_json(f"{job_id}.json")
+        if job is not None and job["status"] == "running" and not _process_alive(job["_pid"]):
+            job.update(status="failed", error=f"process {job['_pid']} exited before the job finished")
+        return job
+
+    def _prune(self):
+        job_files = sorted((entry for entry in os.scandir(self.folder_path)
+                            if JOB_ID_PATTERN.fullmatch(entry.name[:-5]) and entry.name.endswith('.json')),
+                           key=lambda entry: entry.stat().st_mtime_ns)
+        for entry in job_files[:max(len(job_files) - MAX_JOBS_KEPT, 0)]:
+            os.remove(entry.path)
+
+    ##################Jobs
+    def submit(self):
+        """
+        Start a job, or join the job already in flight
+        Input: None
+        Output: A dictionary describing the job
+        """
+        with self._locked():
+            state = self._read_state()
+            running = state["running"] and self._read_job(state["running"])
+            if running and running["status"] == "running":
+                return self._public(running)
+            job = {
+                "job_id": uuid.uuid4().hex,
+                "name": self.name,
+                "status": "running",
+                "submitted_at": time.time(),
+                "finished_at": None,
+                "_pid": os.getpid(),
+            }
+            self._write_json(f"{job['job_id']}.json", job)
+            self._write_json(STATE_FILE, dict(state, running=job["job_id"]))
+            self._prune()
+        threading.Thread(target=self._run, args=(job,),
+                         name=f"{self.name}-job", daemon=True).start()
+        logger.info(f"Started {self.name} job {job['job_id']}")
+        return self._public(job)
+
+    def _run(self, job):
+        try:
+            result = self.func()
+        except Exception:
+            logger.exception(f"{self.name} job {job['job_id']} failed")
+            update = {"status": "failed", "error": traceback.format_exc()}
+        else:
+            update = {"status": "succeeded", "result": result}
+        job = dict(job, **update, finished_at=time.time())
+        with self._locked():
+            self._write_json(f"{job['job_id']}.json", job)
+            state = self._read_state()
+            if state["running"] == job["job_id"]:
+                state["running"] = None
+            if job["status"] == "succeeded":
+                state["last_success"] = job["job_id"]
+            self._write_json(STATE_FILE, state)
+
+    def get(self, job_id):
+        """
+        Get a job by id
+        Input: job id
+        Output: A dictionary describing the job, None for unknown ids
+        """
+        job = self._read_job(job_id)
+        return None if job is None else self._public(job)
+
+    def wait(self, job_id, timeout=None):
+        """
+        Wait for a job to finish
+        Input: job id, timeout in seconds
+        Output: A dictionary describing the job, None for unknown ids
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            if job is None or job["status"] != "running":
+                return job
+            if deadline is not None and time.monotonic() >= deadline:
+                return job
+            time.sleep(WAIT_POLL_SECONDS)
+
+    def _last_success(self, state):
+        job = state["last_success"] and self.get(state["last_success"])
+        return job if job and job["status"] == "succeeded" else None
+
+    def cached(self):
+        """
+        Get the last successful job if its result is still fresh
+        Input: None
+        Output: A dictionary describing the job, None if stale or missing
+        """
+        job = self._last_success(self._read_state())
+        if job is None or time.time() - job["finished_at"] > self.ttl_seconds:
+            return None
+        return job
+
+    def status(self):
+        """
+        Get the state of the job runner
+        Input: None
+        Output: A dictionary of the running job, the cache age and the TTL
+        """
+        state = self._read_state()
+        running = state["running"] and self.get(state["running"])
+        last = self._last_success(state)
+        return {
+            "name": self.name,
+            "running_job_id": running["job_id"] if running and running["status"] == "running" else None,
+            "last_success_job_id": last["job_id"] if last else None,
+            "cache_age_seconds": time.time() - last["finished_at"] if last else None,
+            "ttl_seconds": self.ttl_seconds,
+        }
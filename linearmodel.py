@@ -0,0 +1,124 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to export a trained linear model (the
+LogisticRegression, or the Pipeline of the out-of-core trainer) to a small
+versioned trainedmodel.json of its coefficients, intercept, feature order,
+threshold and classes, and to score it with NumPy only: a dot product and
+a sigmoid, without unpickling or importing sklearn.
+"""
+
+import json
+import os
+import logging
+import numpy as np
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger()
+
+LINEAR_MODEL_FILE = 'trainedmodel.json'
+FORMAT_VERSION = 1
+
+#############Functions to export a model
+def linear_coefficients(model):
+    """
+    Get the coefficients of a binary linear model on the unscaled features
+    Input: A LogisticRegression or SGDClassifier, or a Pipeline of a
+    StandardScaler ("scaler") and one of them ("model")
+    Output: numpy array of the coefficients, intercept; the scaler is
+    folded into both
+    """
+    if hasattr(model, 'named_steps'):
+        scaler, linear = model.named_steps['scaler'], model.named_steps['model']
+        coef = linear.coef_[0] / scaler.scale_
+        return coef, float(linear.intercept_[0] - coef @ scaler.mean_)
+    return np.asarray(model.coef_[0], dtype=np.float64), float(model.intercept_[0])
+
+def export_linear_model(model, model_folder, threshold=0.5):
+    """
+    Write the compact artifact of a trained binary linear model
+    Input: trained model, folder of the model, probability threshold
+    of the positive class
+    Output: trainedmodel.json written into model_folder
+    """
+    import dataset
+    
+    coef, intercept = linear_coefficients(model)
+    features = getattr(model, 'feature_names_in_', dataset.FEATURE_COLUMNS)
+    artifact = {
+        "format_version": FORMAT_VERSION,
+        "estimator": type(model).__name__,
+        "features": [str(name) for name in features],
+        "coef": coef.tolist(),
+        "intercept": intercept,
+        "threshold": threshold,
+        "classes": np.asarray(model.classes_).tolist(),
+    }
+    model_path = os.path.join(model_folder, LINEAR_MODEL_FILE)
+    tmp_path = model_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(artifact, f, indent=2)
+    os.replace(tmp_path, model_path)
+
+#############Class to score an exported model
+class LinearModel:
+    """
+    NumPy scorer of an exported binary linear model, with the predict,
+    predict_proba and classes_ of the sklearn estimator it was exported from
+    """
+
+    def __init__(self, features, coef, intercept, classes, threshold=0.5):
+        self.features = list(features)
+        self.coef = np.asarray(coef, dtype=np.float64)
+        self.intercept = float(intercept)
+        self.classes_ = np.asarray(classes)
+        self.threshold = float(threshold)
+        # compare decision values instead of probabilities, exact at 0.5
+        self._decision_threshold = float(np.log(threshold / (1 - threshold)))
+
+    def _features(self, x):
+        # dataframes are reordered by feature name, arrays are in feature order
+        if hasattr(x, 'columns'):
+            x = x[self.features].to_numpy(dtype=np.float64, na_value=np.nan)
+        x = np.asarray(x, dtype=np.float64)
+        if x.ndim != 2 or x.shape[1] != len(self.coef):
+            raise ValueError(f"Expected {len(self.coef)} features, got shape {x.shape}")
+        if np.isnan(x).any():
+            raise ValueError("Input contains NaN")
+        return x
+
+    def decision_function(self, x):
+        """
+        Input: dataframe of the features, or 2d array in feature order
+        Output: numpy array of the decision values
+        """
+        return self._features(x) @ self.coef + self.intercept
+
+    def predict_proba(self, x):
+        """
+        Input: dataframe of the features, or 2d array in feature order
+        Output: numpy array of the probabilities of each class, one row per record
+        """
+        probabilities = 1.0 / (1.0 + np.exp(-self.decision_function(x)))
+        return np.column_stack([1.0 - probabilities, probabilities])
+
+    def predict(self, x):
+        """
+        Input: dataframe of the features, or 2d array in feature order
+        Output: numpy array of the predicted classes
+        """
+        return self.classes_[(self.decision_function(x) > self._decision_threshold).astype(int)]
+
+
+def load_linear_model(f):
+    """
+    Load an exported model, e.g. as the loader of a ModelCache
+    Input: file object of trainedmodel.json
+    Output: LinearModel
+    """
+    artifact = json.load(f)
+    if artifact.get("format_version") != FORMAT_VERSION:
+        raise ValueError(f"Unsupported linear model format {artifact.get('format_version')}")
+    return LinearModel(artifact["features"], artifact["coef"], artifact["intercept"],
+                       artifact["classes"], artifact["threshold"])
@@ -0,0 +1,216 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to instrument the API and the pipeline
+with counters, gauges and latency histograms, kept in memory by a
+process-wide registry and rendered in the Prometheus text format, e.g.
+on the /metrics endpoint or appended to a metrics file by cron runs.
+Each process keeps its own metrics: every gunicorn worker exposes the
+requests it served.
+"""
+
+import bisect
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger()
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# upper bounds in seconds, from a cached prediction to a retraining
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+#############Functions to format samples
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _sample_line(name, labels, value, timestamp_ms=None):
+    line = name
+    if labels:
+        line += '{' + ','.join(f'{key}="{_escape(val)}"' for key, val in labels) + '}'
+    line += f' {_format_value(value)}'
+    if timestamp_ms is not None:
+        line += f' {timestamp_ms}'
+    return line
+
+#############Classes of the metrics
+class _Metric:
+    """
+    Values of a metric, one per combination of label values
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, "
+                             f"got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key):
+        return list(zip(self.labelnames, key))
+
+    def render(self, timestamp_ms=None):
+        """
+        Input: optional timestamp of the samples in milliseconds
+        Output: lines of the metric in the Prometheus text format
+        """
+        lines = [f'# HELP {self.name} {_escape(self.documentation)}',
+                 f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.extend(_sample_line(name, labels, sample, timestamp_ms)
+                             for name, labels, sample in self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value):
+        yield self.name, self._labels(key), value
+
+
+class Counter(_Metric):
+    """
+    Monotonic count, e.g. requests served or rows scored
+    """
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("Counters can only increase")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self, key, value):
+        yield f'{self.name}_total', self._labels(key), value
+
+
+class Gauge(_Metric):
+    """
+    Last value of a measure, e.g. the duration of the last pipeline stage run
+    """
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values, e.g. request latencies, in cumulative
+    buckets with their sum and count
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * len(self.buckets), 0.0)
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the seconds spent in a with block, also when it raises
+        """
+        starttime = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - starttime, **labels)
+
+    def _samples(self, key, value):
+        counts, total = value
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            yield f'{self.name}_bucket', self._labels(key) + [('le', _format_value(bound))], cumulative
+        yield f'{self.name}_sum', self._labels(key), total
+        yield f'{self.name}_count', self._labels(key), cumulative
+
+#############Class of the registry
+class Registry:
+    """
+    Named metrics of a process. Metrics are declared at import time by the
+    modules they measure; declaring a name again returns the same metric.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_or_create(self, cls, name, documentation, labelnames, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif type(metric) is not cls or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"Metric {name} is already declared as another "
+                                 f"{metric.kind} with labels {metric.labelnames}")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self, timestamp_ms=None):
+        """
+        Render every metric in the Prometheus text format
+        Input: optional timestamp of the samples in milliseconds
+        Output: text of the metrics
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        return ''.join(line + '\n' for _, metric in metrics
+                       for line in metric.render(timestamp_ms))
+
+    def append_to(self, metrics_path):
+        """
+        Append the metrics, timestamped, to a file, e.g. at the end of
+        a cron run whose process does not live long enough to be scraped
+        Input: path of the metrics file
+        Output: None
+        """
+        with open(metrics_path, 'a') as f:
+            f.write(self.render(timestamp_ms=int(time.time() * 1000)))
+        logger.info(f"Appended metrics to {metrics_path}")
+
+
+# registry of the process, rendered by /metrics
+REGISTRY = Registry()
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.counter(name, documentation, labelnames)
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.gauge(name, documentation, labelnames)
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.histogram(name, documentation, labelnames, buckets)
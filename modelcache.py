@@ -0,0 +1,146 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to hold a deployed model in memory,
+and to reload it only when a new model file or release has been published
+"""
+
+import os
+import logging
+import pickle
+import threading
+
+import metrics
+import registry
+from fingerprint import file_sha256
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger()
+
+MODEL_LOAD_SECONDS = metrics.histogram(
+    'model_load_seconds', 'Seconds spent loading a deployed model file', ('file',))
+
+##################Class to cache a model file
+class ModelCache:
+    """
+    Process-wide holder of a model loaded from a file.
+    Each get() only stats the file; the model is unpickled again when the
+    inode, size or mtime moved and the content hash differs from the
+    loaded one. Safe to share between the threads of a Flask server.
+    """
+
+    def __init__(self, model_path, loader=pickle.load):
+        self.model_path = model_path
+        self.loader = loader
+        self._lock = threading.Lock()
+        # (file identity, content hash, model), replaced as a whole
+        # so readers never see a model paired with another file's identity
+        self._state = (None, None, None)
+
+    @staticmethod
+    def _identity(stat):
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def get(self):
+        """
+        Get the model, reloading it if the file has been replaced
+        Input: None
+        Output: the loaded model
+        """
+        identity = self._identity(os.stat(self.model_path))
+        state = self._state
+        if state[0] == identity:
+            return state[2]
+
+        with self._lock:
+            state = self._state
+            if state[0] == identity:
+                return state[2]
+            sha256 = file_sha256(self.model_path)
+            if sha256 == state[1]:
+                # same content published again, keep the loaded model
+                self._state = (identity, sha256, state[2])
+                return state[2]
+
+            logger.info(f"Loading model from {self.model_path}")
+            with open(self.model_path, "rb") as f, \
+                    MODEL_LOAD_SECONDS.time(file=os.path.basename(self.model_path)):
+                model = self.loader(f)
+            self._state = (identity, sha256, model)
+            return model
+
+    @property
+    def sha256(self):
+        """Content hash of the loaded model, None before the first get()"""
+        return self._state[1]
+
+
+class ReleaseModelCache:
+    """
+    Process-wide holder of the model of the current release of a registry.
+    Each get() only reads the `current` pointer; the model is loaded again
+    when the pointer moved to another release. Before the first release,
+    the model file copied into the registry folder is held by a ModelCache.
+    """
+
+    def __init__(self, registry_folder, loaders=(('trainedmodel.pkl', pickle.load),)):
+        # loaders: (file name, loader) pairs, the first file found in a release is loaded
+        self.registry_folder = registry_folder
+        self.loaders = list(loaders)
+        self._lock = threading.Lock()
+        self._legacy = None
+        # (release id, content hash, model), replaced as a whole
+        self._state = (None, None, None)
+
+    def _model_file(self, folder_path):
+        for filename, loader in self.loaders:
+            if os.path.exists(os.path.join(folder_path, filename)):
+                return filename, loader
+        return self.loaders[-1]
+
+    @property
+    def model_path(self):
+        """Path of the model file of the current release"""
+        folder_path = registry.deployed_folder(self.registry_folder)
+        return os.path.join(folder_path, self._model_file(folder_path)[0])
+
+    def get(self):
+        """
+        Get the model of the current release, loading it if the pointer moved
+        Input: None
+        Output: the loaded model
+        """
+        release_id = registry.current_release(self.registry_folder)
+        state = self._state
+        if release_id is not None and state[0] == release_id:
+            return state[2]
+
+        with self._lock:
+            if release_id is None:
+                # deployment made before the registry
+                if self._legacy is None:
+                    filename, loader = self._model_file(self.registry_folder)
+                    self._legacy = ModelCache(os.path.join(self.registry_folder, filename), loader)
+                model = self._legacy.get()
+                self._state = (None, self._legacy.sha256, model)
+                return model
+
+            state = self._state
+            if state[0] == release_id:
+                return state[2]
+            # releases are immutable, their recorded hashes are not recomputed
+            folder_path = registry.release_folder(self.registry_folder, release_id)
+            filename, loader = self._model_file(folder_path)
+            sha256 = registry.read_release(self.registry_folder, release_id)["files"][filename]
+            logger.info(f"Loading model of release {release_id} from {folder_path}")
+            with open(os.path.join(folder_path, filename), "rb") as f, \
+                    MODEL_LOAD_SECONDS.time(file=filename):
+                model = loader(f)
+            self._state = (release_id, sha256, model)
+            return model
+
+    @property
+    def sha256(self):
+        """Content hash of the loaded model, None before the first get()"""
+        return self._state[1]
@@ -0,0 +1,205 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to run the pipeline as a small DAG of
+stages. Each stage declares its input and output files or folders, which
+are fingerprinted by content hash: a stage whose inputs and outputs are
+unchanged since its last successful run is skipped, so a failed run
+resumes from the stage that failed. Stages whose dependencies are done
+run concurrently, and the timings of every stage are recorded per run
+and as metrics, appended to a metrics file at the end of each run.
+"""
+
+import json
+import logging
+import os
+import time
+import timeit
+import traceback
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import metrics
+from fingerprint import path_fingerprint
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger()
+
+STATE_FILE = 'pipelinestate.json'
+RUNS_FILE = 'pipelineruns.jsonl'
+METRICS_FILE = 'pipelinemetrics.prom'
+
+STAGE_SECONDS = metrics.gauge(
+    'pipeline_stage_duration_seconds', 'Seconds of the last run of each pipeline stage', ('stage',))
+STAGE_RUNS = metrics.counter(
+    'pipeline_stage_runs', 'Runs of each pipeline stage by status', ('stage', 'status'))
+# set by the stages themselves, e.g. the rows ingested or trained on
+STAGE_ROWS = metrics.gauge(
+    'pipeline_stage_rows', 'Rows processed by the last run of each pipeline stage', ('stage',))
+
+##################Class to declare a stage
+class Stage:
+    """
+    A step of the pipeline. func is called with the dictionary of the
+    results of the earlier stages and returns a json-serializable result.
+    A gate stage stops every stage depending on it when its result is
+    falsy, e.g. no new data or no drift.
+    A best-effort stage which fails does not fail the run; it is not
+    recorded as succeeded, so the next run tries it again.
+    Stages without inputs always run.
+    """
+
+    def __init__(self, name, func, inputs=(), outputs=(), after=(), gate=False,
+                 best_effort=False):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.after = list(after)
+        self.gate = gate
+        self.best_effort = best_effort
+
+##################Class to run the stages
+class PipelineRunner:
+    """
+    Run stages in dependency order, skipping the unchanged ones.
+    The state of each stage (status, result, input and output fingerprints)
+    is saved after every stage, and a record of each run with the status
+    and duration of every stage is appended to the runs file. The metrics
+    of the process are appended to the metrics file, unless it is None.
+    """
+
+    def __init__(self, stages, state_path=STATE_FILE, runs_path=RUNS_FILE,
+                 metrics_path=METRICS_FILE, max_workers=2):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_path = state_path
+        self.runs_path = runs_path
+        self.metrics_path = metrics_path
+        self.max_workers = max_workers
+        for stage in stages:
+            for dependency in stage.after:
+                if dependency not in self.stages:
+                    raise ValueError(f"Stage {stage.name} depends on unknown stage {dependency}")
+
+    def _load_state(self):
+        if not os.path.exists(self.state_path):
+            return {"stages": {}, "files": {}}
+        with open(self.state_path, 'r') as f:
+            return json.load(f)
+
+    def _save_state(self, state):
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, self.state_path)
+
+    @staticmethod
+    def _fingerprints(paths, known):
+        return {path: path_fingerprint(path, known) for path in paths}
+
+    def _is_unchanged(self, stage, state):
+        recorded = state["stages"].get(stage.name)
+        if not stage.inputs or recorded is None or recorded["status"] != "succeeded":
+            return False
+        return (recorded["inputs"] == self._fingerprints(stage.inputs, state["files"])
+                and recorded["outputs"] == self._fingerprints(stage.outputs, state["files"]))
+
+    def _run_stage(self, stage, results, known):
+        # runs in a worker thread; fingerprints go to a private dictionary
+        # which is merged into the state by the main thread
+        inputs = self._fingerprints(stage.inputs, known)
+        starttime = timeit.default_timer()
+        try:
+            result = stage.func(results)
+        except Exception:
+            logger.exception(f"Stage {stage.name} failed")
+            return {"status": "failed", "error": traceback.format_exc(),
+                    "seconds": timeit.default_timer() - starttime}
+        return {"status": "succeeded", "result": result, "inputs": inputs,
+                "outputs": self._fingerprints(stage.outputs, known),
+                "seconds": timeit.default_timer() - starttime}
+
+    def run(self):
+        """
+        Run the stages whose inputs or outputs changed, or which did not
+        succeed last time, and the stages depending on them
+        Input: None
+        Output: A dictionary of the run: id, per-stage status and duration,
+        "stopped_at" (gate which stopped the run) and "failed" (failed stage,
+        other than a best-effort one), and the "results" of the stages which
+        succeeded or were skipped (not kept in the runs file)
+        """
+        state = self._load_state()
+        run = {"run_id": uuid.uuid4().hex, "started_at": time.time(),
+               "stages": {}, "stopped_at": None, "failed": None}
+        results = {}
+        pending = dict(self.stages)
+        running = {}
+
+        def settle(name, record):
+            # record the outcome of a stage, stop or cancel its dependents
+            stage = self.stages[name]
+            run["stages"][name] = {"status": record["status"], "seconds": record["seconds"]}
+            STAGE_SECONDS.set(record["seconds"], stage=name)
+            STAGE_RUNS.inc(stage=name, status=record["status"])
+            if record["status"] in ("succeeded", "skipped"):
+                results[name] = record["result"]
+                if stage.gate and not record["result"] and run["stopped_at"] is None:
+                    run["stopped_at"] = name
+            elif record["status"] == "failed" and run["failed"] is None and not stage.best_effort:
+                run["failed"] = name
+            logger.info(f"Stage {name} {record['status']} in {record['seconds']:.3f} seconds")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                scheduled = False
+                for name, stage in list(pending.items()):
+                    statuses = [run["stages"].get(dependency, {}).get("status")
+                                for dependency in stage.after]
+                    if None in statuses:
+                        continue
+                    del pending[name]
+                    scheduled = True
+                    blocked = [dependency for dependency in stage.after
+                               if run["stages"][dependency]["status"] not in ("succeeded", "skipped")
+                               or (self.stages[dependency].gate and not results[dependency])]
+                    if blocked:
+                        settle(name, {"status": "not_run", "seconds": 0.0})
+                    elif self._is_unchanged(stage, state):
+                        settle(name, {"status": "skipped", "seconds": 0.0,
+                                      "result": state["stages"][name]["result"]})
+                    else:
+                        logger.info(f"Running stage {name}")
+                        known = dict(state["files"])
+                        future = executor.submit(self._run_stage, stage, dict(results), known)
+                        running[future] = (name, known)
+
+                if not running:
+                    if pending and not scheduled:
+                        raise ValueError(f"Dependency cycle between stages {sorted(pending)}")
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, known = running.pop(future)
+                    record = future.result()
+                    state["files"].update(known)
+                    if record["status"] == "failed":
+                        state["stages"][name] = {"status": "failed", "error": record["error"]}
+                    else:
+                        state["stages"][name] = {key: record[key] for key in
+                                                 ("status", "result", "inputs", "outputs")}
+                    self._save_state(state)
+                    settle(name, record)
+
+        # forget the hashes of files which no longer exist
+        state["files"] = {path: recorded for path, recorded in state["files"].items()
+                          if os.path.exists(path)}
+        self._save_state(state)
+
+        run["seconds"] = time.time() - run["started_at"]
+        with open(self.runs_path, 'a') as f:
+            f.write(json.dumps(run) + '\n')
+        if self.metrics_path is not None:
+            metrics.REGISTRY.append_to(self.metrics_path)
+        return dict(run, results=results)
@@ -0,0 +1,168 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to run fullprocess.py as a long-running
+daemon instead of a cron job: modules, config and the deployed model stay
+loaded, and the pipeline runs within seconds of new files landing in
+input_folder_path. The folder is watched with inotify when the optional
+inotify_simple package is installed, and polled otherwise. Bursts of
+arrivals are debounced into one run.
+"""
+
+import argparse
+import logging
+import os
+import time
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+import configuration
+import diagnostics
+import fullprocess
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger()
+
+# seconds without new arrivals before a burst of files triggers a run
+DEBOUNCE_SECONDS = 2.0
+# longest a steady stream of arrivals can delay a run
+MAX_DEBOUNCE_SECONDS = 30.0
+# seconds between two scans of the folder when polling
+POLL_SECONDS = 1.0
+
+#############Classes to watch the input folder
+class PollingWatcher:
+    """
+    Detect new or modified files by comparing the size and mtime
+    of the files of a folder between scans
+    """
+
+    def __init__(self, folder_path, poll_seconds=POLL_SECONDS):
+        self.folder_path = folder_path
+        self.poll_seconds = poll_seconds
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        if os.path.isdir(self.folder_path):
+            for entry in os.scandir(self.folder_path):
+                if entry.is_file():
+                    stat = entry.stat()
+                    snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def wait(self, timeout):
+        """
+        Wait for files to be added or modified
+        Input: timeout in seconds
+        Output: True if the folder changed before the timeout
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            snapshot = self._scan()
+            changed = snapshot != self._snapshot
+            self._snapshot = snapshot
+            remaining = deadline - time.monotonic()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.poll_seconds, remaining))
+
+
+class InotifyWatcher:
+    """
+    Detect files written, moved or deleted in a folder with inotify
+    """
+
+    def __init__(self, folder_path):
+        self.inotify = INotify()
+        self.inotify.add_watch(folder_path, flags.CLOSE_WRITE | flags.MOVED_TO |
+                               flags.MOVED_FROM | flags.DELETE)
+
+    def wait(self, timeout):
+        """
+        Wait for files to be added or modified
+        Input: timeout in seconds
+        Output: True if the folder changed before the timeout
+        """
+        return bool(self.inotify.read(timeout=int(timeout * 1000)))
+
+
+def make_watcher(folder_path, polling=False, poll_seconds=POLL_SECONDS):
+    """
+    Watch a folder with inotify when available, by polling otherwise
+    Input: folder to watch, True to force polling, seconds between scans
+    Output: a watcher with a wait(timeout) method
+    """
+    if INotify is not None and not polling:
+        logger.info(f"Watching {folder_path} with inotify")
+        return InotifyWatcher(folder_path)
+    logger.info(f"Polling {folder_path} every {poll_seconds} seconds")
+    return PollingWatcher(folder_path, poll_seconds)
+
+#############Functions to run the daemon
+def warm_up():
+    """
+    Import the modules of every pipeline step, which the one-shot
+    fullprocess.py only imports when a step runs, and load the deployed model
+    Input: None
+    Output: None
+    """
+    import ingestion, training, scoring, deployment, drift, reporting
+    import matplotlib.pyplot
+    import sklearn.linear_model
+    import sklearn.metrics
+    model_cache = diagnostics.get_production_model()
+    if os.path.exists(model_cache.model_path):
+        model_cache.get()
+
+def run_daemon(watcher, debounce_seconds=DEBOUNCE_SECONDS,
+               max_debounce_seconds=MAX_DEBOUNCE_SECONDS, idle_seconds=60.0):
+    """
+    Run the pipeline once at start, then after each debounced burst of
+    changes in the input folder. Runs are single-flight through the lock
+    of fullprocess.py, shared with cron runs.
+    Input: folder watcher, quiet seconds closing a burst, longest
+    debounce, seconds between wake-ups while idle
+    Output: None, runs until interrupted
+    """
+    # later runs reuse the loaded modules and model until a new one is deployed
+    warm_up()
+
+    pending = True
+    while True:
+        if pending:
+            starttime = now = time.monotonic()
+            # wait until the folder stays quiet for debounce_seconds
+            while now - starttime < max_debounce_seconds:
+                if not watcher.wait(debounce_seconds):
+                    break
+                now = time.monotonic()
+            logger.info("Running the pipeline")
+            outcome = fullprocess.run_pipeline()
+            logger.info(f"Pipeline run ended with: {outcome}")
+            pending = outcome == "locked"
+            if pending:
+                # another run holds the lock, try again after it
+                time.sleep(debounce_seconds)
+            continue
+        pending = watcher.wait(idle_seconds)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--polling', action='store_true',
+                        help='poll the input folder even if inotify is available')
+    parser.add_argument('--poll-seconds', type=float, default=POLL_SECONDS)
+    parser.add_argument('--debounce-seconds', type=float, default=DEBOUNCE_SECONDS)
+    parser.add_argument('--max-debounce-seconds', type=float, default=MAX_DEBOUNCE_SECONDS)
+    args = parser.parse_args()
+
+    watcher = make_watcher(configuration.config_path('input_folder_path'), args.polling, args.poll_seconds)
+    try:
+        run_daemon(watcher, args.debounce_seconds, args.max_debounce_seconds)
+    except KeyboardInterrupt:
+        logger.info("Pipeline daemon stopped")
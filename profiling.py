@@ -0,0 +1,275 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to profile the master dataset in one
+vectorised pass: count, null count, mean, std, min/max, quantiles and a
+histogram per column. Profiles are built from mergeable partial aggregates
+(one per ingested source file), persisted next to the dataset and keyed
+by its content hash.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+import dataset
+from sourcemanifest import load_manifest
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger()
+
+PROFILE_FILE = 'datasetprofile.json'
+PARTIALS_FOLDER = 'profilepartials'
+# centroids kept by the quantile sketch of a column; quantiles are exact
+# while a column has at most this many distinct values
+SKETCH_SIZE = 1000
+HISTOGRAM_BINS = 10
+QUANTILES = [0.25, 0.5, 0.75]
+# rows per chunk when profiling the whole dataset in one pass
+PROFILE_CHUNK_ROWS = 1 << 20
+
+#############Functions for the quantile sketch
+def _compress_sketch(values, weights, size=SKETCH_SIZE):
+    """
+    Merge equal values, then merge neighbouring centroids into at most
+    size centroids of about equal weight
+    """
+    values, inverse = np.unique(values, return_inverse=True)
+    weights = np.bincount(inverse, weights=weights)
+    if len(values) <= size:
+        return values, weights
+    cumulative = np.cumsum(weights)
+    groups = np.minimum(((cumulative - weights / 2) / cumulative[-1] * size).astype(int),
+                        size - 1)
+    group_weights = np.bincount(groups, weights=weights)
+    group_values = np.bincount(groups, weights=values * weights)
+    used = group_weights > 0
+    return group_values[used] / group_weights[used], group_weights[used]
+
+def sketch_quantile(sketch, q):
+    """
+    Estimate a quantile from a sketch, interpolating linearly between
+    ranks as pandas does; exact while the sketch holds every distinct value
+    Input: list of [value, weight] centroids sorted by value, quantile in [0, 1]
+    Output: estimated quantile, None for an empty sketch
+    """
+    if not sketch:
+        return None
+    values, weights = np.asarray(sketch, dtype=np.float64).T
+    cumulative = np.cumsum(weights)
+    rank = (cumulative[-1] - 1) * q
+    lower, upper = np.floor(rank), np.ceil(rank)
+    lower_value = values[min(np.searchsorted(cumulative, lower, side='right'), len(values) - 1)]
+    upper_value = values[min(np.searchsorted(cumulative, upper, side='right'), len(values) - 1)]
+    return float(lower_value + (rank - lower) * (upper_value - lower_value))
+
+#############Functions for partial aggregates
+def column_partial(values):
+    """
+    Aggregate one column chunk into a mergeable partial
+    Input: numpy array of a numeric column
+    Output: A dictionary of count, nulls, mean, m2, min, max and sketch
+    """
+    values = np.asarray(values, dtype=np.float64)
+    present = values[~np.isnan(values)]
+    partial = {"count": len(present), "nulls": len(values) - len(present),
+               "mean": 0.0, "m2": 0.0, "min": None, "max": None, "sketch": []}
+    if len(present):
+        mean = present.mean()
+        sketch_values, sketch_weights = _compress_sketch(present, np.ones(len(present)))
+        partial.update(mean=float(mean),
+                       m2=float(((present - mean) ** 2).sum()),
+                       min=float(present.min()), max=float(present.max()),
+                       sketch=np.column_stack([sketch_values, sketch_weights]).tolist())
+    return partial
+
+def merge_column_partials(left, right):
+    """
+    Merge the partials of two chunks of a column (Chan et al. for the variance)
+    Input: two column partials
+    Output: column partial of both chunks
+    """
+    if "mean" not in left:
+        # string column, only counts are aggregated
+        return {"count": left["count"] + right["count"],
+                "nulls": left["nulls"] + right["nulls"]}
+    if right["count"] == 0:
+        return dict(left, nulls=left["nulls"] + right["nulls"])
+    if left["count"] == 0:
+        return dict(right, nulls=left["nulls"] + right["nulls"])
+
+    count = left["count"] + right["count"]
+    delta = right["mean"] - left["mean"]
+    sketch = np.asarray(left["sketch"] + right["sketch"], dtype=np.float64)
+    sketch_values, sketch_weights = _compress_sketch(sketch[:, 0], sketch[:, 1])
+    return {
+        "count": count,
+        "nulls": left["nulls"] + right["nulls"],
+        "mean": left["mean"] + delta * right["count"] / count,
+        "m2": left["m2"] + right["m2"] + delta ** 2 * left["count"] * right["count"] / count,
+        "min": min(left["min"], right["min"]),
+        "max": max(left["max"], right["max"]),
+        "sketch": np.column_stack([sketch_values, sketch_weights]).tolist(),
+    }
+
+def dataframe_partial(df):
+    """
+    Aggregate the rows of a dataframe into a mergeable partial
+    Input: dataframe with the dataset columns
+    Output: A dictionary of "rows" and a partial per column
+    """
+    columns = {}
+    for name in df.columns:
+        if not pd.api.types.is_numeric_dtype(df[name]):
+            nulls = int(df[name].isna().sum())
+            columns[name] = {"count": len(df) - nulls, "nulls": nulls}
+        else:
+            columns[name] = column_partial(df[name].to_numpy(dtype=np.float64, na_value=np.nan))
+    return {"rows": len(df), "columns": columns}
+
+def merge_partials(left, right):
+    """
+    Merge the partials of two sets of rows
+    Input: two partials, left may be None
+    Output: partial of both sets of rows
+    """
+    if left is None:
+        return right
+    return {"rows": left["rows"] + right["rows"],
+            "columns": {name: merge_column_partials(partial, right["columns"][name])
+                        for name, partial in left["columns"].items()}}
+
+def partial_key(filepath, sha256):
+    """
+    Key of the partial of an ingested source file; the path is part of it
+    because two files with the same content keep different rows after dedup
+    Input: path and content hash of the source file
+    Output: hex key
+    """
+    return hashlib.sha256(f"{filepath}\n{sha256}".encode()).hexdigest()
+
+def save_partial(key, partial, folder_path=None):
+    """
+    Save the partial of an ingested source file
+    Input: partial_key() of the source file, partial, folder holding the dataset
+    Output: partial written to profilepartials/<key>.json
+    """
+    partials_path = os.path.join(dataset.output_folder(folder_path), PARTIALS_FOLDER)
+    os.makedirs(partials_path, exist_ok=True)
+    with open(os.path.join(partials_path, f'{key}.json'), 'w') as f:
+        json.dump(partial, f)
+
+def load_partial(key, folder_path=None):
+    """
+    Load the partial of an ingested source file
+    Input: partial_key() of the source file, folder holding the dataset
+    Output: partial, None if it was never saved
+    """
+    partial_path = os.path.join(dataset.output_folder(folder_path),
+                                PARTIALS_FOLDER, f'{key}.json')
+    if not os.path.exists(partial_path):
+        return None
+    with open(partial_path, 'r') as f:
+        return json.load(f)
+
+#############Functions to build the profile
+def finalize(partial, dataset_hash):
+    """
+    Turn a partial of the whole dataset into its profile
+    Input: partial, content hash of the dataset
+    Output: A dictionary of "dataset_hash", "rows" and statistics per column
+    """
+    columns = {}
+    for name, column in partial["columns"].items():
+        stats = {"count": column["count"], "nulls": column["nulls"]}
+        if "mean" in column:
+            count = column["count"]
+            stats.update(
+                mean=column["mean"] if count else None,
+                std=float(np.sqrt(column["m2"] / (count - 1))) if count > 1 else None,
+                min=column["min"], max=column["max"],
+                quantiles={str(q): sketch_quantile(column["sketch"], q) for q in QUANTILES})
+            stats["median"] = stats["quantiles"]["0.5"]
+            if count:
+                values, weights = np.asarray(column["sketch"], dtype=np.float64).T
+                counts, edges = np.histogram(values, bins=HISTOGRAM_BINS, weights=weights,
+                                             range=(column["min"], column["max"]))
+                stats["histogram"] = {"edges": edges.tolist(), "counts": counts.tolist()}
+        columns[name] = stats
+    return {"dataset_hash": dataset_hash, "rows": partial["rows"], "columns": columns}
+
+def _partials_from_manifest(schema, folder_path=None):
+    # the per-file partials cover the dataset only if every ingested file
+    # has one and their rows add up to the rows of the dataset
+    manifest = load_manifest(folder_path)
+    partial = None
+    for filepath, entry in manifest.items():
+        file_partial = load_partial(partial_key(filepath, entry["sha256"]), folder_path)
+        if file_partial is None:
+            return None
+        partial = merge_partials(partial, file_partial)
+    if partial is None or partial["rows"] != schema["rows"]:
+        return None
+    return partial
+
+def _scan_dataset(schema, folder_path=None):
+    # one vectorised pass over the memory-mapped columns, chunk by chunk
+    partial = None
+    for start in range(0, max(schema["rows"], 1), PROFILE_CHUNK_ROWS):
+        stop = min(start + PROFILE_CHUNK_ROWS, schema["rows"])
+        columns = {}
+        for column in schema["columns"]:
+            values = dataset.load_column(column["name"], folder_path)[start:stop]
+            if column["dtype"] == 'category':
+                nulls = int((values == -1).sum())
+                columns[column["name"]] = {"count": len(values) - nulls, "nulls": nulls}
+            else:
+                columns[column["name"]] = column_partial(values)
+        partial = merge_partials(partial, {"rows": stop - start, "columns": columns})
+    return partial
+
+_profile_lock = threading.Lock()
+_profile_cache = {}
+
+def dataset_profile(folder_path=None):
+    """
+    Get the profile of the master dataset, from memory or from
+    datasetprofile.json while the dataset content hash is unchanged,
+    otherwise from the per-file partials or one pass over the dataset
+    Input: folder holding the dataset, defaults to output_folder_path
+    Output: A dictionary of "dataset_hash", "rows" and statistics per column
+    """
+    folder_path = dataset.output_folder(folder_path)
+    schema = dataset.read_schema(folder_path)
+    dataset_hash = schema["content_hash"]
+    cached = _profile_cache.get(folder_path)
+    if cached is not None and cached["dataset_hash"] == dataset_hash:
+        return cached
+
+    with _profile_lock:
+        profile_path = os.path.join(folder_path, PROFILE_FILE)
+        profile = None
+        if os.path.exists(profile_path):
+            with open(profile_path, 'r') as f:
+                profile = json.load(f)
+        if profile is None or profile["dataset_hash"] != dataset_hash:
+            partial = _partials_from_manifest(schema, folder_path)
+            if partial is None:
+                logger.info(f"Profiling the master dataset of {folder_path} in one pass")
+                partial = _scan_dataset(schema, folder_path)
+            # keep the column order of the dataset
+            partial["columns"] = {column["name"]: partial["columns"][column["name"]]
+                                  for column in schema["columns"]}
+            profile = finalize(partial, dataset_hash)
+            tmp_path = profile_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(profile, f, indent=2)
+            os.replace(tmp_path, profile_path)
+        _profile_cache[folder_path] = profile
+        return profile
@@ -0,0 +1,203 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to keep the deployed models as a registry
+of immutable releases: each deployment copies the model, its score, the
+ingested files and a release.json of metadata into a content-hashed
+releases/<id> folder, then switches the `current` symlink to it with an
+atomic rename. Readers resolve `current` once and read one whole release,
+and rolling back only switches the symlink to an earlier release and pins
+it, so later deployments do not replace it until it is unpinned.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+
+from fingerprint import file_sha256
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger()
+
+RELEASES_FOLDER = 'releases'
+CURRENT_LINK = 'current'
+RELEASE_FILE = 'release.json'
+# log of the activations of releases
+HISTORY_FILE = 'releasehistory.jsonl'
+# release id written by a rollback, deployments leave `current` alone while it exists
+PIN_FILE = 'pinned'
+
+#############Functions to read the registry
+def current_release(registry_folder):
+    """
+    Get the release the `current` pointer is on
+    Input: folder of the registry (prod_deployment_path)
+    Output: id of the current release, None before the first release
+    """
+    pointer = os.path.join(registry_folder, CURRENT_LINK)
+    if os.path.islink(pointer):
+        return os.path.basename(os.readlink(pointer))
+    if os.path.isfile(pointer):
+        # platforms without symlinks keep the id in a file
+        with open(pointer, 'r') as f:
+            return f.read().strip()
+    return None
+
+def pinned_release(registry_folder):
+    """
+    Input: folder of the registry
+    Output: id of the release pinned by a rollback, None if not pinned
+    """
+    pin_path = os.path.join(registry_folder, PIN_FILE)
+    if not os.path.exists(pin_path):
+        return None
+    with open(pin_path, 'r') as f:
+        return f.read().strip() or None
+
+def release_folder(registry_folder, release_id):
+    """
+    Input: folder of the registry, id of a release
+    Output: folder of the release
+    """
+    return os.path.join(registry_folder, RELEASES_FOLDER, release_id)
+
+def deployed_folder(registry_folder):
+    """
+    Get the folder holding the files of the deployed model
+    Input: folder of the registry (prod_deployment_path)
+    Output: folder of the current release, or registry_folder itself for
+    a deployment made before the registry (files copied into it)
+    """
+    release_id = current_release(registry_folder)
+    if release_id is None:
+        return registry_folder
+    return release_folder(registry_folder, release_id)
+
+def read_release(registry_folder, release_id):
+    """
+    Input: folder of the registry, id of a release
+    Output: A dictionary of the release metadata (id, created_at, files
+    with their sha256, metadata)
+    """
+    with open(os.path.join(release_folder(registry_folder, release_id), RELEASE_FILE), 'r') as f:
+        return json.load(f)
+
+def list_releases(registry_folder):
+    """
+    List the releases of the registry, oldest first
+    Input: folder of the registry
+    Output: list of release metadata dictionaries
+    """
+    releases_path = os.path.join(registry_folder, RELEASES_FOLDER)
+    if not os.path.isdir(releases_path):
+        return []
+    releases = [read_release(registry_folder, release_id)
+                for release_id in os.listdir(releases_path)
+                if os.path.exists(os.path.join(releases_path, release_id, RELEASE_FILE))]
+    return sorted(releases, key=lambda release: release["created_at"])
+
+#############Functions to publish and activate releases
+def activate_release(registry_folder, release_id):
+    """
+    Point `current` at a release with an atomic rename of a new symlink
+    Input: folder of the registry, id of a release
+    Output: None
+    """
+    if not os.path.isdir(release_folder(registry_folder, release_id)):
+        raise ValueError(f"Unknown release {release_id}")
+    pointer = os.path.join(registry_folder, CURRENT_LINK)
+    tmp_pointer = f"{pointer}.{uuid.uuid4().hex}.tmp"
+    try:
+        os.symlink(os.path.join(RELEASES_FOLDER, release_id), tmp_pointer)
+    except (OSError, NotImplementedError):
+        with open(tmp_pointer, 'w') as f:
+            f.write(release_id)
+    os.replace(tmp_pointer, pointer)
+    with open(os.path.join(registry_folder, HISTORY_FILE), 'a') as f:
+        f.write(json.dumps({"release": release_id, "activated_at": time.time()}) + '\n')
+    logger.info(f"Release {release_id} is now current")
+
+def publish_release(filepaths, registry_folder, metadata=None):
+    """
+    Copy files into a new immutable release and make it current, unless
+    a rollback pinned another release.
+    The release id is a hash of the file names and contents, so publishing
+    the same files again only switches back to the existing release.
+    Input: list of file paths, folder of the registry, dictionary of metadata
+    Output: id of the release
+    """
+    files = {os.path.basename(path): file_sha256(path) for path in filepaths}
+    digest = hashlib.sha256()
+    for name in sorted(files):
+        digest.update(f"{name}\n{files[name]}\n".encode())
+    release_id = digest.hexdigest()[:16]
+
+    releases_path = os.path.join(registry_folder, RELEASES_FOLDER)
+    if not os.path.isdir(release_folder(registry_folder, release_id)):
+        # the release is built in a temporary folder and renamed into place
+        os.makedirs(releases_path, exist_ok=True)
+        tmp_folder = os.path.join(releases_path, f".{uuid.uuid4().hex}.tmp")
+        os.makedirs(tmp_folder)
+        for path in filepaths:
+            shutil.copy(path, tmp_folder)
+        release = {"id": release_id, "created_at": time.time(),
+                   "files": files, "metadata": metadata or {}}
+        with open(os.path.join(tmp_folder, RELEASE_FILE), 'w') as f:
+            json.dump(release, f, indent=2)
+        os.rename(tmp_folder, release_folder(registry_folder, release_id))
+        logger.info(f"Published release {release_id}")
+    pinned = pinned_release(registry_folder)
+    if pinned is not None and pinned != release_id:
+        logger.warning(f"Release {pinned} is pinned, release {release_id} is not made current; "
+                       f"`python deployment.py --unpin` to deploy again")
+        return release_id
+    activate_release(registry_folder, release_id)
+    return release_id
+
+def pin_release(registry_folder, release_id):
+    """
+    Keep a release current: publish_release() leaves the pointer alone
+    while the pin exists
+    Input: folder of the registry, id of the release
+    Output: None
+    """
+    pin_path = os.path.join(registry_folder, PIN_FILE)
+    with open(pin_path + '.tmp', 'w') as f:
+        f.write(release_id)
+    os.replace(pin_path + '.tmp', pin_path)
+    logger.info(f"Release {release_id} is pinned")
+
+def unpin_release(registry_folder):
+    """
+    Let deployments make their releases current again
+    Input: folder of the registry
+    Output: id of the release which was pinned, None if not pinned
+    """
+    release_id = pinned_release(registry_folder)
+    if release_id is not None:
+        os.remove(os.path.join(registry_folder, PIN_FILE))
+        logger.info(f"Release {release_id} is no longer pinned")
+    return release_id
+
+def rollback(registry_folder, release_id=None):
+    """
+    Switch `current` back to an earlier release and pin it, only the
+    pointer changes
+    Input: folder of the registry, id of the release, default to the
+    release published before the current one
+    Output: id of the release now current
+    """
+    if release_id is None:
+        releases = [release["id"] for release in list_releases(registry_folder)]
+        current = current_release(registry_folder)
+        if current not in releases or releases.index(current) == 0:
+            raise ValueError("No earlier release to roll back to")
+        release_id = releases[releases.index(current) - 1]
+    activate_release(registry_folder, release_id)
+    pin_release(registry_folder, release_id)
+    return release_id
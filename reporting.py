@@ -8,27 +8,18 @@ related to the ML model's performance.
 import pickle
 import pandas as pd
 import numpy as np
-from sklearn import metrics
-
-import matplotlib.pyplot as plt
 import json
 import os
 import logging
 
+import configuration
+import dataset
 from diagnostics import model_predictions
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger()
 
-###############Load config.json and get path variables
-with open('config.json','r') as f:
-    config = json.load(f) 
-
-dataset_csv_path = os.path.join(os.getcwd(), config['output_folder_path']) 
-test_data_path = os.path.join(os.getcwd(), config['test_data_path'])
-output_model_path = os.path.join(os.getcwd(), config['output_model_path']) 
-
 ##############Function for reporting
 def score_model():
     """
@@ -40,12 +31,18 @@ def score_model():
     Output: save confusion matrix plot to a file 
     """
     logger.info(f"Starting score_model")
+    # matplotlib and sklearn are only imported when a report is plotted
+    import matplotlib.pyplot as plt
+    from sklearn import metrics
+    
+    test_data_path = configuration.config_path('test_data_path')
+    output_model_path = configuration.config_path('output_model_path')
     
     logger.info(f"Retrieving testdata.csv from {test_data_path}")
-    test_df = pd.read_csv(os.path.join(test_data_path, "testdata.csv"))
+    test_df = dataset.read_csv(os.path.join(test_data_path, "testdata.csv"))
     
     y_pred = model_predictions(test_df)
-    y_true = test_df['exited']
+    y_true = test_df[dataset.TARGET_COLUMN]
 
     # calculate confusion matrix
     cm = metrics.confusion_matrix(y_true, y_pred)
@@ -54,6 +51,8 @@ def score_model():
     # Save confusion matrix plot to a file
     logger.info(f"confusionmatrix2.png is stored in {output_model_path}")
     plt.savefig(os.path.join(output_model_path, "confusionmatrix2.png") )
+    # the pipeline daemon reports on every redeployment, in the same process
+    plt.close(disp.figure_)
     
 
 if __name__ == '__main__':
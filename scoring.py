@@ -8,53 +8,162 @@ in production against a test dataset
 import pandas as pd
 import pickle
 import os
-from sklearn import metrics
 import json
 import logging
+import threading
+
+import configuration
+import dataset
+from fingerprint import file_sha256, file_signature
 
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger()
 
-#################Load config.json and get path variables
-with open('config.json','r') as f:
-    config = json.load(f) 
+SCORE_CACHE_FILE = 'scorecache.json'
+# metrics computed from the same predictions of the test data
+SCORE_METRICS = ['f1', 'precision', 'recall', 'auc']
+# scores kept in scorecache.json, the oldest are dropped first
+MAX_CACHED_SCORES = 256
+
+#################Functions for the score cache
+_cache_lock = threading.Lock()
+# path -> (file signature, content hash), so unchanged files are not rehashed
+_hash_cache = {}
+# model folder -> {"<model hash>:<test data hash>": {metric: score}}
+_score_cache = {}
+
+def _content_hash(filepath):
+    signature = file_signature(filepath)
+    cached = _hash_cache.get(filepath)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    sha256 = file_sha256(filepath)
+    _hash_cache[filepath] = (signature, sha256)
+    return sha256
+
+def _load_score_cache(model_folder):
+    if model_folder not in _score_cache:
+        cache_path = os.path.join(model_folder, SCORE_CACHE_FILE)
+        scores = {}
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as f:
+                scores = json.load(f)
+        _score_cache[model_folder] = scores
+    return _score_cache[model_folder]
 
-test_data_path = os.path.join(os.getcwd(), config['test_data_path'])
-output_model_path = os.path.join(os.getcwd(), config['output_model_path']) 
+def _save_score_cache(model_folder, scores):
+    while len(scores) > MAX_CACHED_SCORES:
+        scores.pop(next(iter(scores)))
+    cache_path = os.path.join(model_folder, SCORE_CACHE_FILE)
+    tmp_path = cache_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(scores, f, indent=2)
+    os.replace(tmp_path, cache_path)
+
+def _write_latest_score(score_path, f1_score):
+    # rewritten only when it holds another score, e.g. after a model
+    # change A -> B -> A served from the cache, so its hash stays stable
+    content = f"F1 score =  {f1_score}"
+    if os.path.exists(score_path):
+        with open(score_path, 'r') as f:
+            if f.read() == content:
+                return
+    logger.info(f"F1 score =  {f1_score} store as {score_path}\n")
+    with open(score_path, "w") as f:
+        f.write(content)
+
+def clear_score_cache(model_folder=None):
+    """
+    Forget the cached scores of a model folder, in memory and on disk
+    Input: folder of the model, defaults to output_model_path of config.json
+    Output: None
+    """
+    model_folder = model_folder or configuration.config_path('output_model_path')
+    with _cache_lock:
+        _score_cache.pop(model_folder, None)
+        cache_path = os.path.join(model_folder, SCORE_CACHE_FILE)
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+
+def compute_scores(model, df):
+    """
+    Compute every metric of SCORE_METRICS from one prediction pass
+    Input: trained model, test dataframe
+    Output: A dictionary of the score per metric
+    """
+    # sklearn is only imported on a score cache miss
+    from sklearn import metrics
+    
+    x_df = df[dataset.FEATURE_COLUMNS]
+    y_df = df[dataset.TARGET_COLUMN]
+    probabilities = model.predict_proba(x_df)[:, 1]
+    predicted = model.classes_[(probabilities > 0.5).astype(int)]
+    scores = {
+        "f1": metrics.f1_score(y_df, predicted),
+        "precision": metrics.precision_score(y_df, predicted, zero_division=0),
+        "recall": metrics.recall_score(y_df, predicted, zero_division=0),
+        # AUC is undefined when the test data holds a single class
+        "auc": (metrics.roc_auc_score(y_df, probabilities)
+                if y_df.nunique() > 1 else None),
+    }
+    return {metric: None if score is None else float(score)
+            for metric, score in scores.items()}
 
 #################Function for model scoring
-def score_model():
+def score_metrics(test_folder=None, model_folder=None):
+    """
+    This function scores the trained model against the test data,
+    memoised by the content hashes of the model and of the test data:
+    repeat calls are answered from memory or from scorecache.json,
+    and latestscore.txt is written only when it holds another score
+    Input: folders of the test data and of the model,
+    default to test_data_path and output_model_path of config.json
+    Output: A dictionary of the score per metric of SCORE_METRICS
+    """
+    test_folder = test_folder or configuration.config_path('test_data_path')
+    model_folder = model_folder or configuration.config_path('output_model_path')
+    test_path = os.path.join(test_folder, 'testdata.csv')
+    model_path = os.path.join(model_folder, "trainedmodel.pkl")
+    score_path = os.path.join(model_folder, "latestscore.txt")
+
+    with _cache_lock:
+        key = f"{_content_hash(model_path)}:{_content_hash(test_path)}"
+        scores = _load_score_cache(model_folder)
+        cached = scores.get(key)
+        if cached is not None:
+            logger.info(f"Scores of {model_path} served from the score cache")
+            _write_latest_score(score_path, cached["f1"])
+            return dict(cached)
+
+        logger.info(f"Loading testdata.csv from {test_folder}")
+        df = dataset.read_csv(test_path)
+
+        logger.info(f"Loading trainedmodel.pkl from {model_folder}")
+        with open(model_path, "rb") as f:
+            model = pickle.load(f)
+
+        cached = compute_scores(model, df)
+        f1_score = cached["f1"]
+        logger.info(f"From scoring.py --- f1_score: {f1_score}")
+
+        _write_latest_score(score_path, f1_score)
+
+        scores[key] = cached
+        _save_score_cache(model_folder, scores)
+        return dict(cached)
+
+def score_model(test_folder=None, model_folder=None):
     """
     This function take a trained model, load test data, 
     and calculate an F1 score for the model relative to the test data
-    Input: None
+    Input: folders of the test data and of the model,
+    default to test_data_path and output_model_path of config.json
     Output: an F1 score for the model corresponding to the test data 
     which is written into latestscore.txt file
     """
     logger.info(f"Starting score_model")
-    
-    logger.info(f"Loading testdata.csv from {test_data_path}")
-    df = pd.read_csv(os.path.join(test_data_path, 'testdata.csv'))
-    
-    logger.info(f"Loading trainedmodel.pkl from {output_model_path}")
-    model_path = os.path.join(output_model_path, "trainedmodel.pkl")
-    model = pickle.load(open(model_path, "rb"))
-
-    #features = ["lastmonth_activity", "lastyear_activity", "number_of_employees"]
-    df = df.drop(columns=['corporation'])
-    x_df = df.copy()
-    y_df = x_df.pop("exited")
-    predicted = model.predict(x_df)
-    f1_score = metrics.f1_score(predicted, y_df)
-    logger.info(f"From scoring.py --- f1_score: {f1_score}")
-    
-    with open(os.path.join(output_model_path, "latestscore.txt"), "w") as f:
-        logger.info(
-            f"F1 score =  {f1_score} store as latestscore.txt in {output_model_path}\n")
-        f.write(f"F1 score =  {f1_score}")
-    
-    return f1_score
+    return score_metrics(test_folder, model_folder)["f1"]
     
 if __name__ == '__main__':
     logger.info("Invoking scoring.py")
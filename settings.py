@@ -1,4 +1,15 @@
 from os import environ 
 
 SECRET_KEY = environ.get('SECRET_KEY')
-#API_KEY = environ.get('API_KEY')
\ No newline at end of file
+#API_KEY = environ.get('API_KEY')
+
+# Seconds the last /diagnostics result is served before a new run
+DIAGNOSTICS_TTL_SECONDS = float(environ.get('DIAGNOSTICS_TTL_SECONDS', 600))
+
+# Micro-batching of inline /prediction requests
+PREDICTION_BATCHING = environ.get('PREDICTION_BATCHING', 'false').lower() == 'true'
+PREDICTION_BATCH_WINDOW_MS = float(environ.get('PREDICTION_BATCH_WINDOW_MS', 5))
+PREDICTION_BATCH_MAX_ROWS = int(environ.get('PREDICTION_BATCH_MAX_ROWS', 256))
+
+# Load the deployed model at startup instead of on the first request
+PRELOAD_MODEL = environ.get('PRELOAD_MODEL', 'false').lower() == 'true'
@@ -0,0 +1,82 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to keep the manifest of ingested source
+files and to find new or changed source files. It only needs the standard
+library, so checking for new data does not import pandas.
+"""
+
+import glob
+import json
+import os
+
+import configuration
+from fingerprint import file_sha256, file_signature
+
+MANIFEST_FILE = 'ingestedmanifest.json'
+
+#############Functions for the source-file manifest
+def load_manifest(folder_path=None):
+    """
+    Load the manifest of previously ingested source files
+    Input: folder holding the manifest, defaults to output_folder_path
+    Output:
+    A dictionary of file path -> "size", "mtime_ns", "sha256" and "rows"
+    An empty dictionary if nothing has been ingested yet
+    """
+    folder_path = folder_path or configuration.config_path('output_folder_path')
+    manifest_path = os.path.join(folder_path, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, 'r') as f:
+        return json.load(f)['files']
+
+def save_manifest(manifest, folder_path=None):
+    """
+    Save the manifest of ingested source files
+    Input: manifest dictionary, folder holding the manifest
+    Output: manifest written to ingestedmanifest.json
+    """
+    folder_path = folder_path or configuration.config_path('output_folder_path')
+    manifest_path = os.path.join(folder_path, MANIFEST_FILE)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump({"files": manifest}, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+def find_new_files(input_folder=None, manifest=None):
+    """
+    Compare the source csv files against the manifest.
+    The content hash is only computed when size or mtime have moved,
+    so an unchanged folder is checked with metadata alone.
+    Input: source folder, manifest (loaded from output_folder_path if None)
+    Output:
+    new_files: csv files which have never been ingested
+    changed_files: csv files whose content differs from the ingested one
+    fingerprints: dictionary of file path -> fingerprint for both lists
+    """
+    input_folder = input_folder or configuration.config_path('input_folder_path')
+    if manifest is None:
+        manifest = load_manifest()
+
+    new_files, changed_files, fingerprints = [], [], {}
+    for file in sorted(glob.glob(f'{input_folder}/*.csv')):
+        signature = file_signature(file)
+        recorded = manifest.get(file)
+        if (recorded is not None
+                and recorded['size'] == signature['size']
+                and recorded['mtime_ns'] == signature['mtime_ns']):
+            continue
+
+        signature['sha256'] = file_sha256(file)
+        if recorded is None:
+            new_files.append(file)
+        elif recorded['sha256'] != signature['sha256']:
+            changed_files.append(file)
+        else:
+            # touched but identical content: only refresh the metadata
+            recorded.update(signature)
+            continue
+        fingerprints[file] = signature
+
+    return new_files, changed_files, fingerprints
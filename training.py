@@ -5,47 +5,92 @@ Description: This script is used to train a logistic regression model
 """
 
 import pandas as pd
+import numpy as np
 import pickle
 import os
-from sklearn.linear_model import LogisticRegression
 import json
+import argparse
 import logging
 
+import configuration
+import dataset
+import drift
+import linearmodel
+import registry
+
 logging.basicConfig(level=logging.INFO,
                     format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger()
 
-###################Load config.json and get path variables
-with open('config.json','r') as f:
-    config = json.load(f) 
+# default of the search argument, read from config.json when training
+FROM_CONFIG = object()
+
+# parameters of the logistic regression, the hyperparameter search
+# overrides C, penalty, solver and class_weight
+MODEL_PARAMS = dict(C=1.0, class_weight=None, dual=False, fit_intercept=True,
+                    intercept_scaling=1, l1_ratio=None, max_iter=100,
+                    n_jobs=None, penalty='l2',
+                    random_state=0, solver='liblinear', tol=0.0001, verbose=0,
+                    warm_start=False)
 
-dataset_csv_path = os.path.join(os.getcwd(), config['output_folder_path']) 
-output_model_path = os.path.join(os.getcwd(), config['output_model_path']) 
+# defaults of the out-of-core trainer, used when the training_chunk_rows
+# setting of config.json is set
+TRAINING_EPOCHS = 5
+SGD_PARAMS = dict(alpha=0.0001, penalty='l2', fit_intercept=True,
+                  learning_rate='optimal', random_state=0)
 
 #################Function for training the model
-def train_model():
+def make_model(**params):
+    """
+    Create an unfitted LogisticRegression model
+    Input: parameters overriding MODEL_PARAMS
+    Output: A LogisticRegression model
+    """
+    # sklearn is only imported when a model is trained
+    from sklearn.linear_model import LogisticRegression
+    
+    return LogisticRegression(**{**MODEL_PARAMS, **params})
+
+def train_model(dataset_folder=None, model_folder=None, search=FROM_CONFIG,
+                chunk_rows=FROM_CONFIG):
     """
     Trained a LogisticRegression model
-    Input: None
+    Input: folders of the master dataset and of the model,
+    default to output_folder_path and output_model_path of config.json;
+    settings of a hyperparameter search (see tuning.py), default to the
+    hyperparameter_search setting of config.json, None to fit MODEL_PARAMS;
+    rows per chunk to train out-of-core instead (see train_model_out_of_core),
+    default to the training_chunk_rows setting of config.json
     Output: A trained LogisticRegression model and stored it into model_path
     """
+    dataset_folder = dataset.output_folder(dataset_folder)
+    model_folder = model_folder or configuration.config_path('output_model_path')
+    if search is FROM_CONFIG:
+        search = configuration.config_value('hyperparameter_search')
+    if chunk_rows is FROM_CONFIG:
+        chunk_rows = configuration.config_value('training_chunk_rows')
+    if chunk_rows:
+        if search:
+            logger.info(f'Training out-of-core, the hyperparameter search is skipped')
+        return train_model_out_of_core(
+            dataset_folder, model_folder, chunk_rows,
+            epochs=configuration.config_value('training_epochs', TRAINING_EPOCHS),
+            warm_start=configuration.config_value('training_warm_start', True))
     
-    #use this logistic regression for training
-    logger.info(f'Starting to train a Logistic regression model')
-    
-    model = LogisticRegression(C=1.0, class_weight=None, dual=False, fit_intercept=True,
-                    intercept_scaling=1, l1_ratio=None, max_iter=100,
-                    multi_class='auto', n_jobs=None, penalty='l2',
-                    random_state=0, solver='liblinear', tol=0.0001, verbose=0,
-                    warm_start=False)
+    logger.info(f'Reading ingested data from the master dataset of {dataset_folder}')
+    x_df, y_df = dataset.load_features_and_target(dataset_folder)
     
-    logger.info(f'Reading ingested data from finaldata.csv of {dataset_csv_path}')
-    df = pd.read_csv(os.path.join(dataset_csv_path, "finaldata.csv"))
+    params = {}
+    if search:
+        #select C, penalty, solver and class_weight by cross-validated F1,
+        #the leaderboard of the candidates goes to leaderboard.json
+        import tuning
+        logger.info(f'Searching the hyperparameters of the Logistic regression model')
+        params, _ = tuning.search_hyperparameters(x_df, y_df, search, model_folder)
     
-    #features = ["lastmonth_activity", "lastyear_activity", "number_of_employees"]
-    df = df.drop(columns=['corporation'])
-    x_df = df.copy()
-    y_df = x_df.pop("exited")
+    #use this logistic regression for training
+    logger.info(f'Starting to train a Logistic regression model')
+    model = make_model(**params)
     
     #fit the logistic regression to your data
     logger.info(f'fit the logistic regression to the ingested data')
@@ -55,10 +100,157 @@ def train_model():
     model.fit(x_df, y_df)
     
     #write the trained model to your workspace in a file called trainedmodel.pkl
-    logger.info(f'write the trained model to a file called: trainedmodel.pkl of {output_model_path}')
-    pickle.dump(model, open(os.path.join(output_model_path, "trainedmodel.pkl"), "wb"))
+    logger.info(f'write the trained model to a file called: trainedmodel.pkl of {model_folder}')
+    pickle.dump(model, open(os.path.join(model_folder, "trainedmodel.pkl"), "wb"))
+    
+    #export the coefficients to trainedmodel.json, scored with NumPy only
+    logger.info(f'write the coefficients of the model to trainedmodel.json of {model_folder}')
+    linearmodel.export_linear_model(model, model_folder)
+    
+    #store the feature distributions the model was trained on,
+    #the reference of the feature drift screening
+    logger.info(f'write the reference feature distributions to referenceprofile.json of {model_folder}')
+    drift.save_reference_profile(x_df, model_folder)
     
 
+#################Functions for out-of-core training
+def _log_loss_name():
+    import sklearn
+    
+    # the logistic loss of SGDClassifier was renamed "log_loss" in
+    # scikit-learn 1.1, and "log" removed in 1.3
+    version = tuple(int(part) for part in sklearn.__version__.split('.')[:2])
+    return 'log_loss' if version >= (1, 1) else 'log'
+
+def _feature_chunks(dataset_folder, chunk_rows, order=None):
+    # rows of the memory-mapped feature and target columns, chunk by chunk;
+    # only the current chunk is held in memory
+    columns = [dataset.load_column(name, dataset_folder) for name in dataset.FEATURE_COLUMNS]
+    target = dataset.load_column(dataset.TARGET_COLUMN, dataset_folder)
+    starts = range(0, len(target), chunk_rows)
+    for start in (starts if order is None else np.asarray(starts)[order]):
+        stop = start + chunk_rows
+        yield (np.column_stack([column[start:stop] for column in columns]).astype(np.float64),
+               np.asarray(target[start:stop]))
+
+def feature_moments(dataset_folder, chunk_rows):
+    """
+    Stream the mean and variance of the features over the master dataset,
+    merging the moments of each chunk (Chan et al., Welford per chunk)
+    Input: folder of the master dataset, number of rows per chunk
+    Output: number of rows, arrays of the mean and of the variance of the features
+    """
+    count, mean, m2 = 0, 0.0, 0.0
+    for x, _ in _feature_chunks(dataset_folder, chunk_rows):
+        chunk_mean = x.mean(axis=0)
+        chunk_m2 = ((x - chunk_mean) ** 2).sum(axis=0)
+        total = count + len(x)
+        delta = chunk_mean - mean
+        mean = mean + delta * len(x) / total
+        m2 = m2 + chunk_m2 + delta ** 2 * count * len(x) / total
+        count = total
+    return count, np.asarray(mean), np.asarray(m2) / count
+
+def _deployed_coefficients(scaler):
+    # coefficients of the deployed model, on the features as standardized
+    # by scaler, or None when no compatible model is deployed
+    model_path = os.path.join(registry.deployed_folder(configuration.config_path('prod_deployment_path')),
+                              'trainedmodel.pkl')
+    if not os.path.exists(model_path):
+        return None
+    with open(model_path, 'rb') as f:
+        deployed = pickle.load(f)
+    try:
+        coef, intercept = linearmodel.linear_coefficients(deployed)
+    except AttributeError:
+        return None
+    if len(coef) != len(scaler.mean_):
+        return None
+    return coef * scaler.scale_, intercept + coef @ scaler.mean_
+
+def train_model_out_of_core(dataset_folder=None, model_folder=None, chunk_rows=100000,
+                            epochs=TRAINING_EPOCHS, warm_start=True):
+    """
+    Train a logistic regression out-of-core: SGDClassifier.partial_fit over
+    chunks of the memory-mapped master dataset, standardized with streamed
+    feature moments, so memory is bounded by the chunk size
+    Input: folders of the master dataset and of the model, number of rows
+    per chunk, passes over the dataset, whether to start from the
+    coefficients of the model deployed in prod_deployment_path
+    Output: A Pipeline of a StandardScaler and a SGDClassifier
+    stored into model_path; ValueError if epochs or chunk_rows is below 1
+    or the master dataset is empty
+    """
+    from sklearn.linear_model import SGDClassifier
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import StandardScaler
+    
+    if epochs < 1:
+        raise ValueError(f"epochs must be at least 1, got {epochs}")
+    if chunk_rows < 1:
+        raise ValueError(f"chunk_rows must be at least 1, got {chunk_rows}")
+    dataset_folder = dataset.output_folder(dataset_folder)
+    model_folder = model_folder or configuration.config_path('output_model_path')
+    #a model fitted on no rows has no classes_ to export
+    if dataset.read_schema(dataset_folder)['rows'] == 0:
+        raise ValueError(f"the master dataset of {dataset_folder} has no rows to train on")
+    logger.info(f'Starting to train a SGD logistic regression model out-of-core, '
+                f'{chunk_rows} rows per chunk')
+    
+    #first pass: mean and variance of the features
+    rows, mean, var = feature_moments(dataset_folder, chunk_rows)
+    scaler = StandardScaler()
+    scaler.mean_, scaler.var_ = mean, var
+    scaler.scale_ = np.where(var > 0, np.sqrt(var), 1.0)
+    scaler.n_features_in_ = len(mean)
+    scaler.n_samples_seen_ = rows
+    scaler.feature_names_in_ = np.asarray(dataset.FEATURE_COLUMNS, dtype=object)
+    
+    model = SGDClassifier(loss=_log_loss_name(), **SGD_PARAMS)
+    if warm_start:
+        coefficients = _deployed_coefficients(scaler)
+        if coefficients is not None:
+            logger.info(f'Starting from the coefficients of the deployed model')
+            model.coef_ = coefficients[0].reshape(1, -1)
+            model.intercept_ = np.asarray([coefficients[1]], dtype=np.float64)
+    
+    #next passes: partial_fit chunk by chunk, in a shuffled order
+    classes = np.asarray([0, 1])
+    rng = np.random.default_rng(SGD_PARAMS['random_state'])
+    chunks = -(-rows // chunk_rows)
+    for epoch in range(epochs):
+        for x, y in _feature_chunks(dataset_folder, chunk_rows, rng.permutation(chunks)):
+            shuffle = rng.permutation(len(y))
+            x = (x - scaler.mean_) / scaler.scale_
+            model.partial_fit(x[shuffle], y[shuffle], classes=classes)
+        logger.info(f'Epoch {epoch + 1} of {epochs} done')
+    
+    model = Pipeline([('scaler', scaler), ('model', model)])
+    logger.info(f'write the trained model to a file called: trainedmodel.pkl of {model_folder}')
+    with open(os.path.join(model_folder, "trainedmodel.pkl"), "wb") as f:
+        pickle.dump(model, f)
+    linearmodel.export_linear_model(model, model_folder)
+    
+    #reference distributions, from one memory-mapped column at a time
+    logger.info(f'write the reference feature distributions to referenceprofile.json of {model_folder}')
+    drift.save_reference_profile({name: dataset.load_column(name, dataset_folder)
+                                  for name in dataset.FEATURE_COLUMNS}, model_folder)
+    return model
+
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--search', choices=['grid', 'random'],
+                        help='search the hyperparameters, overriding the method of config.json')
+    parser.add_argument('--workers', type=int, help='worker processes of the search')
+    args = parser.parse_args()
+    
+    search = FROM_CONFIG
+    if args.search:
+        search = dict(configuration.config_value('hyperparameter_search') or {},
+                      method=args.search)
+        if args.workers:
+            search['workers'] = args.workers
+    
     logger.info(f'Executing training.py:')
-    train_model()    
\ No newline at end of file
+    train_model(search=search)
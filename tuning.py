@@ -0,0 +1,270 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used to search the hyperparameters of the
+logistic regression (C, penalty, solver, class_weight) by grid or random
+search with stratified k-fold cross-validation on a process pool.
+The features, target and fold assignment are written once to .npy files
+which every worker memory-maps, so the dataset is loaded only once.
+Candidates falling well behind the best one are stopped early.
+"""
+
+import numpy as np
+import json
+import os
+import random
+import logging
+import tempfile
+import timeit
+import warnings
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+logging.basicConfig(level=logging.INFO,
+                    format="%(asctime)s - %(levelname)s - %(message)s")
+logger = logging.getLogger()
+
+LEADERBOARD_FILE = 'leaderboard.json'
+
+# searched when the hyperparameter_search setting of config.json has no "space"
+DEFAULT_SEARCH_SPACE = {
+    'C': [0.01, 0.1, 1.0, 10.0, 100.0],
+    'penalty': ['l1', 'l2'],
+    'solver': ['liblinear', 'lbfgs', 'saga'],
+    'class_weight': [None, 'balanced'],
+}
+# penalties supported by each solver, other combinations are not searched
+SOLVER_PENALTIES = {
+    'liblinear': {'l1', 'l2'},
+    'lbfgs': {'l2'},
+    'newton-cg': {'l2'},
+    'newton-cholesky': {'l2'},
+    'sag': {'l2'},
+    'saga': {'l1', 'l2'},
+}
+DEFAULT_FOLDS = 5
+# a candidate is stopped once, after min_folds folds, its mean F1 trails
+# the best finished candidate by more than the margin
+DEFAULT_EARLY_STOPPING_MARGIN = 0.1
+DEFAULT_MIN_FOLDS = 2
+
+# set in each worker process by _init_worker
+_features = None
+_target = None
+_folds = None
+_best_f1 = None
+
+#############Functions to list the candidates
+def candidate_params(space=None, method='grid', n_iter=20, random_state=0):
+    """
+    List the hyperparameter candidates of a search
+    Input: dictionary of parameter name to list of values, "grid" or
+    "random", number of random candidates, seed of the random search
+    Output: list of parameter dictionaries, without the solver and
+    penalty combinations the solver does not support; a parameter which
+    is not searched keeps its value of training.MODEL_PARAMS
+    """
+    import training
+
+    space = dict(DEFAULT_SEARCH_SPACE if space is None else space)
+    names = sorted(space)
+    grid = [dict(zip(names, values)) for values in product(*(space[name] for name in names))]
+    defaults = training.MODEL_PARAMS
+    grid = [params for params in grid
+            if params.get('penalty', defaults['penalty'])
+            in SOLVER_PENALTIES.get(params.get('solver', defaults['solver']), {'l2'})]
+    if method == 'grid':
+        return grid
+    if method != 'random':
+        raise ValueError(f"Unknown search method {method}, expected grid or random")
+
+    # random search draws C log-uniformly between the smallest and largest
+    # listed values, the other parameters from their lists
+    rng = random.Random(random_state)
+    candidates = []
+    for params in rng.sample(grid, min(n_iter, len(grid))):
+        params = dict(params)
+        if 'C' in space and len(space['C']) > 1:
+            low, high = np.log10(min(space['C'])), np.log10(max(space['C']))
+            params['C'] = float(10 ** rng.uniform(low, high))
+        candidates.append(params)
+    return candidates
+
+def assign_folds(y, folds=DEFAULT_FOLDS, random_state=0):
+    """
+    Assign each row to a stratified cross-validation fold
+    Input: target values, number of folds, seed of the shuffling
+    Output: int8 array of the fold of each row; the number of folds is
+    lowered to the size of the smallest class
+    """
+    from sklearn.model_selection import StratifiedKFold
+
+    y = np.asarray(y)
+    smallest_class = np.unique(y, return_counts=True)[1].min()
+    folds = min(folds, smallest_class)
+    if folds < 2:
+        raise ValueError("Cross-validation needs at least 2 rows of each class")
+    assignment = np.empty(len(y), dtype=np.int8)
+    splitter = StratifiedKFold(n_splits=folds, shuffle=True, random_state=random_state)
+    for fold, (_, test_index) in enumerate(splitter.split(np.zeros(len(y)), y)):
+        assignment[test_index] = fold
+    return assignment
+
+#############Functions for early stopping
+def _stopping_fold(scores, best_f1, early_stopping_margin, min_folds):
+    """
+    Input: F1 scores of the evaluated folds of a candidate, best mean F1
+    of the finished candidates, early stopping margin and minimum folds
+    Output: number of folds after which the candidate stops, None if it does not
+    """
+    if early_stopping_margin is None:
+        return None
+    for folds in range(min_folds, len(scores) + 1):
+        if np.mean(scores[:folds]) < best_f1 - early_stopping_margin:
+            return folds
+    return None
+
+def replay_early_stopping(results, candidates, early_stopping_margin, min_folds, evaluate):
+    """
+    Decide early stopping as a serial search would, in candidate order:
+    the workers stop against whichever candidates happened to finish
+    first, so the results would otherwise depend on timing
+    Input: results of _evaluate_candidate in candidate order, their
+    parameters, early stopping margin and minimum folds, function
+    evaluating every fold of a candidate
+    Output: results in candidate order; a candidate stopped too early is
+    evaluated again, and the folds a serial search would skip are dropped
+    """
+    best_f1 = -1.0
+    replayed = []
+    for params, result in zip(candidates, results):
+        stop = _stopping_fold(result['fold_f1'], best_f1, early_stopping_margin, min_folds)
+        if result['status'] == 'stopped' and stop != len(result['fold_f1']):
+            result = evaluate(params)
+            stop = _stopping_fold(result['fold_f1'], best_f1, early_stopping_margin, min_folds)
+        if stop is not None:
+            scores = result['fold_f1'][:stop]
+            result = dict(result, status='stopped', fold_f1=scores,
+                          mean_f1=float(np.mean(scores)), std_f1=float(np.std(scores)))
+        else:
+            best_f1 = max(best_f1, result['mean_f1'])
+        replayed.append(result)
+    return replayed
+
+#############Functions run by the workers
+def _init_worker(features_path, target_path, folds_path, best_f1):
+    # memory-map the shared arrays once per worker, every worker
+    # reads the same pages of the OS cache
+    global _features, _target, _folds, _best_f1
+    _features = np.load(features_path, mmap_mode='r')
+    _target = np.load(target_path, mmap_mode='r')
+    _folds = np.load(folds_path, mmap_mode='r')
+    _best_f1 = best_f1
+
+def _evaluate_candidate(params, early_stopping_margin=DEFAULT_EARLY_STOPPING_MARGIN,
+                        min_folds=DEFAULT_MIN_FOLDS):
+    """
+    Cross-validate one candidate on the shared folds
+    Input: parameters of the model, early stopping margin and minimum folds
+    Output: A dictionary of the parameters, F1 score of each evaluated fold,
+    mean and std F1, fit time in seconds and status (finished or stopped)
+    """
+    from sklearn.exceptions import ConvergenceWarning
+    from sklearn.metrics import f1_score
+    import training
+
+    scores, fit_seconds = [], 0.0
+    status = 'finished'
+    for fold in range(int(_folds.max()) + 1):
+        train_index = np.flatnonzero(_folds != fold)
+        test_index = np.flatnonzero(_folds == fold)
+        model = training.make_model(**params)
+        starttime = timeit.default_timer()
+        with warnings.catch_warnings():
+            # an unconverged fit is still scored like any other
+            warnings.simplefilter('ignore', ConvergenceWarning)
+            model.fit(_features[train_index], _target[train_index])
+        fit_seconds += timeit.default_timer() - starttime
+        scores.append(float(f1_score(_target[test_index], model.predict(_features[test_index]),
+                                     zero_division=0)))
+        if _stopping_fold(scores, _best_f1.value, early_stopping_margin, min_folds) == len(scores):
+            status = 'stopped'
+            break
+
+    mean_f1 = float(np.mean(scores))
+    if status == 'finished':
+        with _best_f1.get_lock():
+            _best_f1.value = max(_best_f1.value, mean_f1)
+    return {"params": params, "status": status, "mean_f1": mean_f1,
+            "std_f1": float(np.std(scores)), "fold_f1": scores,
+            "fit_seconds": fit_seconds}
+
+#############Function for the hyperparameter search
+def search_hyperparameters(x_df, y_df, search=None, model_folder=None):
+    """
+    Cross-validate the candidates of a grid or random search on a process pool
+    Input: features and target of the master dataset, dictionary of the
+    search settings (method, space, n_iter, folds, workers, random_state,
+    early_stopping_margin, min_folds), folder to write leaderboard.json to
+    Output: parameters of the candidate with the best mean F1,
+    and the leaderboard of every candidate ranked by mean F1
+    """
+    search = dict(search or {})
+    method = search.get('method', 'grid')
+    candidates = candidate_params(search.get('space'), method,
+                                  search.get('n_iter', 20), search.get('random_state', 0))
+    folds = assign_folds(y_df, search.get('folds', DEFAULT_FOLDS), search.get('random_state', 0))
+    workers = search.get('workers') or os.cpu_count() or 1
+    margin = search.get('early_stopping_margin', DEFAULT_EARLY_STOPPING_MARGIN)
+    min_folds = search.get('min_folds', DEFAULT_MIN_FOLDS)
+    logger.info(f"{method} search over {len(candidates)} candidates, "
+                f"{int(folds.max()) + 1}-fold cross-validation on {workers} workers")
+
+    starttime = timeit.default_timer()
+    best_f1 = mp.Value('d', -1.0)
+    with tempfile.TemporaryDirectory() as shared_folder:
+        paths = [os.path.join(shared_folder, name) for name in
+                 ('features.npy', 'target.npy', 'folds.npy')]
+        np.save(paths[0], np.ascontiguousarray(x_df, dtype=np.float64))
+        np.save(paths[1], np.asarray(y_df))
+        np.save(paths[2], folds)
+        initargs = (*paths, best_f1)
+        if workers <= 1:
+            _init_worker(*initargs)
+            results = [_evaluate_candidate(params, margin, min_folds) for params in candidates]
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=initargs) as executor:
+                futures = [executor.submit(_evaluate_candidate, params, margin, min_folds)
+                           for params in candidates]
+                results = [future.result() for future in futures]
+            # a candidate stopped too early is evaluated again in this process
+            _init_worker(*initargs)
+            results = replay_early_stopping(
+                results, candidates, margin, min_folds,
+                lambda params: _evaluate_candidate(params, None, min_folds))
+
+    # finished candidates first, then by mean F1, ties by candidate order
+    order = sorted(range(len(results)),
+                   key=lambda index: (results[index]['status'] != 'finished',
+                                      -results[index]['mean_f1'], index))
+    results = [results[index] for index in order]
+    for rank, result in enumerate(results, start=1):
+        result['rank'] = rank
+    best = results[0]
+    logger.info(f"Best candidate {best['params']} with mean F1 {best['mean_f1']:.4f}")
+
+    leaderboard = {
+        "method": method,
+        "scoring": "f1",
+        "folds": int(folds.max()) + 1,
+        "rows": int(len(folds)),
+        "search_seconds": timeit.default_timer() - starttime,
+        "best_params": best['params'],
+        "candidates": results,
+    }
+    if model_folder is not None:
+        with open(os.path.join(model_folder, LEADERBOARD_FILE), 'w') as f:
+            json.dump(leaderboard, f, indent=2)
+    return best['params'], leaderboard
@@ -0,0 +1,11 @@
+"""
+Author: Thanh Ta
+Date: March, 2024
+Description: This script is used as the production WSGI entry point:
+the application is built with the deployed model and the dataset profile
+preloaded, e.g. `gunicorn -c gunicorn.conf.py wsgi:application`
+"""
+
+from app import create_app
+
+application = create_app(preload=True)